@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+"""Offline benchmarks of presto_client and prestogres against a fake coordinator.
+
+Usage:
+    python bench.py [--scenario NAME ...] [--rows N] [--page-rows N] [--types T,T,...]
+                    [--unavailable N] [--page-delay SEC] [--json-heavy] [--compression gzip]
+                    [--faults N]
+
+Each scenario runs in a child process so that peak memory (max RSS) is
+measured per scenario. The fake coordinator runs in this process.
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [HERE, os.path.join(HERE, "..", "pgsql")]
+
+import fake_presto
+
+SCENARIOS = ["query_results", "client_run", "client_run_spill", "client_stream", "fetch_presto_query_results", "setup_system_catalog", "setup_system_catalog_lazy", "multi_coordinator", "coalesced_queries"]
+
+JSON_HEAVY_TYPES = ["bigint", "map(varchar,bigint)", "array(bigint)", "row(a bigint,b varchar,c array(bigint))", "varchar"]
+
+def _peak_rss_bytes():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return rss
+    return rss * 1024  # kilobytes on Linux
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def _fetch_server_stats(server):
+    import httplib
+    conn = httplib.HTTPConnection(server)
+    conn.request("GET", "/v1/bench/stats")
+    return json.loads(conn.getresponse().read())
+
+def _consume(iterator, start):
+    first_row_latency = None
+    rows = 0
+    for row in iterator:
+        if first_row_latency is None:
+            first_row_latency = time.time() - start
+        rows += 1
+    return rows, first_row_latency
+
+def run_query_results(server, options):
+    import presto_client
+    start = time.time()
+    query = presto_client.Client(server=server, user="bench", **options).query("select * from bench")
+    try:
+        rows, first_row_latency = _consume(query.results(), start)
+    finally:
+        query.close()
+    return rows, start, first_row_latency
+
+def run_client_run(server, options):
+    import presto_client
+    start = time.time()
+    columns, rows = presto_client.Client(server=server, user="bench", **options).run("select * from bench")
+    return len(rows), start, None
+
+def run_client_run_spill(server, options):
+    import presto_client
+    options = dict(options)
+    spill_bytes = options.pop("spill_bytes", 8*1024*1024)
+    start = time.time()
+    columns, rows = presto_client.Client(server=server, user="bench", **options).run(
+            "select * from bench", spill_bytes=spill_bytes)
+    count = sum(1 for row in rows)
+    rows.close()
+    return count, start, None
+
+def run_client_stream(server, options):
+    import presto_client
+    start = time.time()
+    columns, rows = presto_client.Client(server=server, user="bench", **options).stream("select * from bench")
+    count, first_row_latency = _consume(rows, start)
+    return count, start, first_row_latency
+
+def run_fetch_presto_query_results(server, options):
+    import plpy
+    import prestogres
+    plpy.reset()
+    if "prefetch_pages" in options:
+        plpy.settings["prestogres.prefetch_pages"] = str(options["prefetch_pages"])
+    if "compression" in options:
+        plpy.settings["prestogres.compression"] = options["compression"]
+    if "spool_max_bytes" in options:
+        plpy.settings["prestogres.spool_max_bytes"] = str(options["spool_max_bytes"])
+    start = time.time()
+    prestogres.start_presto_query(server, "bench", "hive", "default", "presto_fetch", "select * from bench")
+    rows, first_row_latency = _consume(prestogres.fetch_presto_query_results(), start)
+    return rows, start, first_row_latency
+
+def run_setup_system_catalog(server, options):
+    import plpy
+    import prestogres
+    plpy.reset()
+    start = time.time()
+    prestogres.setup_system_catalog(server, "bench", "hive", "default", "bench")
+    statements = sum(statement.count(";\n") + 1 for statement in plpy.executed)
+    return statements, start, None
+
+def run_setup_system_catalog_lazy(server, options):
+    import plpy
+    import prestogres
+    plpy.reset()
+    plpy.settings["prestogres.catalog_mode"] = "lazy"
+    start = time.time()
+    prestogres.setup_system_catalog(server, "bench", "hive", "schema_0", "bench")
+    statements = sum(statement.count(";\n") + 1 for statement in plpy.executed)
+    return statements, start, None
+
+def run_multi_coordinator(server, options):
+    # the benchmark coordinator, a busy coordinator with queued queries and a
+    # coordinator refusing connections. statements should go to the first one
+    import socket
+    import presto_client
+    options = dict(options)
+    queries = options.pop("coordinator_queries", 10)
+    busy = fake_presto.FakePrestoServer(fake_presto.FakePrestoConfig(rows=100, cluster_queued=50)).start()
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    dead = "%s:%d" % sock.getsockname()
+    sock.close()
+    try:
+        client = presto_client.Client(server=";".join([dead, busy.address, server]), user="bench", **options)
+        start = time.time()
+        count = 0
+        for i in xrange(queries):
+            columns, rows = client.run("select * from bench")
+            count += len(rows)
+        print >>sys.stderr, "multi_coordinator: %d of %d statements went to the busy coordinator" % \
+                (busy.stats["queries"], queries)
+    finally:
+        busy.stop()
+    return count, start, None
+
+def _run_coalesced_backend(server, directory, start_at, results):
+    import plpy
+    import prestogres
+    plpy.reset()
+    plpy.settings["prestogres.coalesce_queries"] = "on"
+    plpy.settings["prestogres.coalesce_dir"] = directory
+    time.sleep(max(start_at - time.time(), 0))
+    prestogres.start_presto_query(server, "bench", "hive", "default", "presto_fetch", "select * from bench")
+    results.put(sum(1 for row in prestogres.fetch_presto_query_results()))
+
+def run_coalesced_queries(server, options):
+    # backends running the same statement at once. one of them runs it on Presto
+    import multiprocessing
+    import shutil
+    import tempfile
+    backends = options.get("coalesce_backends", 8)
+    directory = tempfile.mkdtemp(prefix="prestogres-bench-")
+    before = _fetch_server_stats(server)
+    try:
+        results = multiprocessing.Queue()
+        start = time.time()
+        processes = [multiprocessing.Process(target=_run_coalesced_backend, args=(server, directory, start + 0.5, results))
+                for i in xrange(backends)]
+        for process in processes:
+            process.start()
+        count = sum(results.get() for process in processes)
+        for process in processes:
+            process.join()
+    finally:
+        shutil.rmtree(directory)
+    print >>sys.stderr, "coalesced_queries: %d statements ran %d Presto queries" % \
+            (backends, _fetch_server_stats(server)["queries"] - before["queries"])
+    return count, start + 0.5, None
+
+def run_child(args):
+    options = json.loads(args.child_options)
+    runner = globals()["run_" + args.child]
+    before = _fetch_server_stats(args.server)
+    rows, start, first_row_latency = runner(args.server, options)
+    elapsed = time.time() - start
+    after = _fetch_server_stats(args.server)
+    print json.dumps({
+        "rows": rows,
+        "elapsed": elapsed,
+        "first_row_latency": first_row_latency,
+        "bytes": after["bytes"] - before["bytes"],
+        "requests": (after["pages"] + after["unavailable"] + after["queries"] + after["faults"]) - \
+                (before["pages"] + before["unavailable"] + before["queries"] + before["faults"]),
+        "peak_rss": _peak_rss_bytes(),
+        "cpu": _cpu_time(),
+        })
+
+def run_scenario(name, server, options):
+    cmd = [sys.executable, os.path.abspath(__file__), "--child", name, "--server", server,
+           "--child-options", json.dumps(options)]
+    output = subprocess.check_output(cmd)
+    return json.loads(output.strip().splitlines()[-1])
+
+def format_result(name, result):
+    elapsed = result["elapsed"]
+    first = result["first_row_latency"]
+    return "%-28s %10d %12.0f %10s %10.1f %8d %9.1f %7.2f" % (
+            name, result["rows"], result["rows"] / elapsed if elapsed > 0 else 0,
+            "%.1f" % (first * 1000) if first is not None else "-",
+            result["bytes"] / 1024.0 / 1024.0, result["requests"],
+            result["peak_rss"] / 1024.0 / 1024.0, result["cpu"])
+
+def main():
+    parser = argparse.ArgumentParser(description="presto_client and prestogres benchmarks")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS)
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--page-rows", type=int, default=5000)
+    parser.add_argument("--types", default="bigint,varchar,double,boolean,date")
+    parser.add_argument("--json-heavy", action="store_true", help="use map, array and row columns")
+    parser.add_argument("--unavailable", type=int, default=0, help="503 responses before each page")
+    parser.add_argument("--page-delay", type=float, default=0.0, help="seconds to wait before each page")
+    parser.add_argument("--faults", type=int, default=0, help="dropped connections before each page")
+    parser.add_argument("--queued-pages", type=int, default=0, help="pages without data before results")
+    parser.add_argument("--schemas", type=int, default=10)
+    parser.add_argument("--tables", type=int, default=100, help="tables per schema")
+    parser.add_argument("--columns", type=int, default=20, help="columns per table")
+    parser.add_argument("--prefetch-pages", type=int)
+    parser.add_argument("--spill-bytes", type=int, help="memory limit of client_run_spill")
+    parser.add_argument("--spool-max-bytes", type=int, help="prestogres.spool_max_bytes of fetch_presto_query_results")
+    parser.add_argument("--compression", choices=["gzip", "deflate"], help="request compressed pages")
+    parser.add_argument("--compression-level", type=int, default=6, help="compression level of the fake coordinator")
+    parser.add_argument("--coordinator-queries", type=int, default=10, help="statements of multi_coordinator")
+    parser.add_argument("--coalesce-backends", type=int, default=8, help="backends of coalesced_queries")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--child-options", help=argparse.SUPPRESS)
+    parser.add_argument("--server", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return run_child(args)
+
+    config = fake_presto.FakePrestoConfig(
+            rows=args.rows, page_rows=args.page_rows,
+            column_types=JSON_HEAVY_TYPES if args.json_heavy else args.types.split(","),
+            service_unavailable=args.unavailable, page_delay=args.page_delay,
+            queued_pages=args.queued_pages, schemas=args.schemas,
+            tables_per_schema=args.tables, columns_per_table=args.columns,
+            compression_level=args.compression_level, connection_faults=args.faults)
+    server = fake_presto.FakePrestoServer(config).start()
+
+    options = {}
+    if args.prefetch_pages is not None:
+        options["prefetch_pages"] = args.prefetch_pages
+    if args.spill_bytes is not None:
+        options["spill_bytes"] = args.spill_bytes
+    if args.compression is not None:
+        options["compression"] = args.compression
+    if args.spool_max_bytes is not None:
+        options["spool_max_bytes"] = args.spool_max_bytes
+
+    print "%-28s %10s %12s %10s %10s %8s %9s %7s" % ("scenario", "rows", "rows/sec", "first(ms)", "MB", "requests", "rss(MB)", "cpu(s)")
+    try:
+        for name in args.scenario or SCENARIOS:
+            scenario_options = options
+            if name == "multi_coordinator":
+                scenario_options = dict(options, coordinator_queries=args.coordinator_queries)
+            elif name == "coalesced_queries":
+                scenario_options = dict(options, coalesce_backends=args.coalesce_backends)
+            print format_result(name, run_scenario(name, server.address, scenario_options))
+            sys.stdout.flush()
+    finally:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+"""Fake Presto coordinator serving /v1/statement for benchmarks and tests.
+
+Results are generated on the fly: information_schema.schemata and
+information_schema.columns queries return a synthetic catalog and any
+other query returns rows of the configured column types.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import base64
+import copy
+import json
+import re
+import socket
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+COLUMNS_QUERY_PATTERN = re.compile(r"information_schema\.columns(?:.*table_schema (=|in) \(?((?:'(?:[^']|'')*'(?:, )?)+))?", re.IGNORECASE | re.DOTALL)
+LITERAL_PATTERN = re.compile(r"'((?:[^']|'')*)'")
+SCHEMATA_QUERY_PATTERN = re.compile(r"information_schema\.schemata", re.IGNORECASE)
+# queries sent by replay.py start with a comment identifying the recorded shape
+REPLAY_QUERY_PATTERN = re.compile(r"^/\* replay:(\w+) \*/")
+
+class FakePrestoConfig(object):
+    def __init__(self, rows=10000, page_rows=1000, column_types=("bigint", "varchar", "double"),
+            service_unavailable=0, page_delay=0.0, queued_pages=0,
+            schemas=4, tables_per_schema=50, columns_per_table=20, compression_level=6,
+            cluster_queued=0, connection_faults=0, fault_pages=None):
+        self.rows = rows
+        self.page_rows = page_rows
+        self.column_types = list(column_types)
+        self.service_unavailable = service_unavailable  # 503 responses before each page
+        self.page_delay = page_delay  # seconds to wait before each page
+        self.queued_pages = queued_pages  # pages without data before the first data
+        self.schemas = schemas
+        self.tables_per_schema = tables_per_schema
+        self.columns_per_table = columns_per_table
+        self.compression_level = compression_level  # gzip/deflate level if requested. 0 disables it
+        self.cluster_queued = cluster_queued  # queued queries reported by /v1/cluster
+        # connections dropped before each page is served. drops alternate between
+        # closing without a response and closing in the middle of the body
+        self.connection_faults = connection_faults
+        self.fault_pages = fault_pages  # tokens of pages with connection faults. None means all pages
+
+def _generate_value(column_type, i):
+    if column_type in ("bigint", "integer", "tinyint", "smallint"):
+        return i
+    elif column_type == "double":
+        return i * 0.5
+    elif column_type == "boolean":
+        return i % 2 == 0
+    elif column_type == "date":
+        return "2015-01-%02d" % (i % 28 + 1)
+    elif column_type == "timestamp":
+        return "2015-01-%02d 12:34:56.789" % (i % 28 + 1)
+    elif column_type == "varbinary":
+        return base64.b64encode("bytes-%d" % i)
+    elif column_type.startswith("array"):
+        return [i, i + 1, i + 2, i + 3]
+    elif column_type.startswith("map"):
+        return {"key-a": i, "key-b": i * 2, "key-c": "value-%d" % i}
+    elif column_type.startswith("row"):
+        return [i, "field-%d" % i, [i, i + 1]]
+    else:
+        return "value-%d" % i
+
+class FakeQuery(object):
+    def __init__(self, query_id, config, columns, row_generator, total_rows):
+        self.query_id = query_id
+        self.config = config
+        self.columns = columns
+        self.row_generator = row_generator
+        self.total_rows = total_rows
+        self.unavailable = {}  # token -> remaining 503 responses
+        self.faults = {}  # token -> remaining dropped connections
+        self.cancelled = False
+        self.finished = False
+
+    @property
+    def running(self):
+        return not self.cancelled and not self.finished
+
+    def page_count(self):
+        data_pages = (self.total_rows + self.config.page_rows - 1) // self.config.page_rows
+        return 1 + self.config.queued_pages + data_pages
+
+    def page(self, token, base_uri):
+        dic = OrderedDict()
+        dic["id"] = self.query_id
+        dic["infoUri"] = "%s/v1/query/%s" % (base_uri, self.query_id)
+        if token + 1 < self.page_count():
+            dic["nextUri"] = "%s/v1/statement/%s/%d" % (base_uri, self.query_id, token + 1)
+        else:
+            self.finished = True
+        if token > self.config.queued_pages:
+            dic["columns"] = [OrderedDict([("name", name), ("type", t)]) for name, t in self.columns]
+            start = (token - self.config.queued_pages - 1) * self.config.page_rows
+            end = min(start + self.config.page_rows, self.total_rows)
+            dic["data"] = [self.row_generator(i) for i in xrange(start, end)]
+        dic["stats"] = OrderedDict([
+            ("state", "RUNNING" if "nextUri" in dic else "FINISHED"),
+            ("scheduled", token > self.config.queued_pages),
+            ("nodes", 1),
+            ("totalSplits", self.page_count()),
+            ("queuedSplits", 0),
+            ("runningSplits", 1 if "nextUri" in dic else 0),
+            ("completedSplits", token),
+            ("userTimeMillis", token),
+            ("cpuTimeMillis", token),
+            ("wallTimeMillis", token),
+            ("processedRows", 0),
+            ("processedBytes", 0),
+            ])
+        return json.dumps(dic, separators=(",", ":"))
+
+class FakePrestoHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1  # send headers and body in one write to avoid delayed ACK stalls
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.stats["connections"] += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def finish(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass  # the connection was dropped on purpose
+
+    def _compress(self, body):
+        level = self.server.config.compression_level
+        accept = [e.strip() for e in self.headers.get("Accept-Encoding", "").split(",")]
+        if level <= 0 or not body:
+            return None, body
+        if "gzip" in accept:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            return "gzip", compressor.compress(body) + compressor.flush()
+        elif "deflate" in accept:
+            return "deflate", zlib.compress(body, level)
+        return None, body
+
+    def _drop_connection(self, body, truncate):
+        if truncate:
+            # send headers and a part of the body
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+        self.close_connection = 1
+        self.connection.shutdown(socket.SHUT_RDWR)
+
+    def _send(self, status, body=""):
+        encoding, body = self._compress(body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.stats["bytes"] += len(body)
+
+    def _base_uri(self):
+        return "http://%s:%d" % self.server.server_address
+
+    def do_POST(self):
+        sql = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path != "/v1/statement":
+            return self._send(404)
+        self.server.stats["queries"] += 1
+        query = self.server.create_query(sql, self.headers)
+        self._send(200, query.page(0, self._base_uri()))
+
+    def do_GET(self):
+        if self.path == "/v1/bench/stats":
+            return self._send(200, json.dumps(self.server.stats))
+        if self.path == "/v1/cluster":
+            self.server.stats["cluster"] += 1
+            running = sum(1 for query in self.server.queries.values() if query.running)
+            return self._send(200, json.dumps({
+                "runningQueries": running,
+                "blockedQueries": 0,
+                "queuedQueries": self.server.config.cluster_queued,
+                "activeWorkers": 1,
+                }))
+        m = re.match(r"^(?:https?://[^/]+)?/v1/statement/([^/]+)/(\d+)$", self.path)
+        query = m and self.server.queries.get(m.group(1))
+        if query is None:
+            return self._send(404)
+        token = int(m.group(2))
+        config = query.config
+
+        remaining = query.unavailable.setdefault(token, config.service_unavailable)
+        if remaining > 0:
+            query.unavailable[token] = remaining - 1
+            self.server.stats["unavailable"] += 1
+            return self._send(503)
+
+        # the client requests pages in order even after reconnecting
+        sequence_id = self.headers.get("X-Presto-Page-Sequence-Id")
+        if sequence_id is not None and int(sequence_id) != token:
+            return self._send(409, "page sequence %s doesn't match token %d" % (sequence_id, token))
+
+        if config.page_delay:
+            time.sleep(config.page_delay)
+        body = query.page(token, self._base_uri())
+
+        if config.fault_pages is None or token in config.fault_pages:
+            remaining = query.faults.setdefault(token, config.connection_faults)
+        else:
+            remaining = 0
+        if remaining > 0:
+            query.faults[token] = remaining - 1
+            self.server.stats["faults"] += 1
+            return self._drop_connection(body, remaining % 2 == 0)
+
+        self.server.stats["pages"] += 1
+        self._send(200, body)
+
+    def do_DELETE(self):
+        m = re.match(r"^(?:https?://[^/]+)?/v1/statement/([^/]+)/(\d+)$", self.path)
+        query = m and self.server.queries.get(m.group(1))
+        if query is not None:
+            query.cancelled = True
+            self.server.stats["cancels"] += 1
+        self._send(204)
+
+class FakePrestoServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128  # accept many concurrent clients (e.g. presto_async_client)
+
+    def __init__(self, config=None, address=("127.0.0.1", 0)):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakePrestoHandler)
+        self.config = config or FakePrestoConfig()
+        self.queries = {}
+        self.shapes = {}  # replay id -> FakePrestoConfig of the query
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.stats = {"connections": 0, "queries": 0, "pages": 0, "unavailable": 0, "cancels": 0, "bytes": 0, "cluster": 0,
+                "faults": 0}
+        self.thread = None
+
+    @property
+    def address(self):
+        return "%s:%d" % self.server_address
+
+    def create_query(self, sql, headers):
+        with self.lock:
+            self.sequence += 1
+            query_id = "20150101_000000_%05d_fake" % self.sequence
+        config = self.config
+
+        m = REPLAY_QUERY_PATTERN.match(sql)
+        shape = self.shapes.get(m.group(1)) if m else None
+        if shape is not None:
+            config = shape
+            columns = [("c%d" % i, t) for i, t in enumerate(config.column_types)]
+            types = config.column_types
+            generator = lambda i: [_generate_value(t, i) for t in types]
+            total = config.rows
+        elif SCHEMATA_QUERY_PATTERN.search(sql):
+            columns = [("schema_name", "varchar")]
+            generator = lambda i: ["information_schema"] if i == config.schemas else ["schema_%d" % i]
+            total = config.schemas + 1
+        elif COLUMNS_QUERY_PATTERN.search(sql):
+            m = COLUMNS_QUERY_PATTERN.search(sql)
+            columns = [("table_name", "varchar"), ("column_name", "varchar"), ("is_nullable", "varchar"), ("data_type", "varchar")]
+            types = ["bigint", "varchar", "double", "boolean", "date", "array<bigint>"]
+            per_schema = config.tables_per_schema * config.columns_per_table
+            # all schemas, a schema (= 'name') or listed schemas (in ('name', ...))
+            if m.group(1) is None:
+                schemas = ["schema_%d" % i for i in xrange(config.schemas)]
+            else:
+                names = set(name.replace("''", "'") for name in LITERAL_PATTERN.findall(m.group(2)))
+                schemas = [name for name in ("schema_%d" % i for i in xrange(config.schemas)) if name in names]
+            def generator(i):
+                row = ["table_%d" % (i % per_schema // config.columns_per_table), "column_%d" % (i % config.columns_per_table),
+                       "YES", types[i % len(types)]]
+                if m.group(1) != "=":
+                    row.insert(0, schemas[i // per_schema])
+                return row
+            if m.group(1) != "=":
+                columns.insert(0, ("table_schema", "varchar"))
+            total = per_schema * len(schemas)
+        else:
+            columns = [("c%d" % i, t) for i, t in enumerate(config.column_types)]
+            types = config.column_types
+            generator = lambda i: [_generate_value(t, i) for t in types]
+            total = config.rows
+
+        query = FakeQuery(query_id, config, columns, generator, total)
+        self.queries[query_id] = query
+        return query
+
+    def add_shape(self, shape_id, **overrides):
+        """Results of queries starting with /* replay:shape_id */ use the
+        configuration overwritten by overrides."""
+        shape = copy.copy(self.config)
+        for name, value in overrides.items():
+            setattr(shape, name, value)
+        self.shapes[str(shape_id)] = shape
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="fake-presto")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
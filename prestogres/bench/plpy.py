@@ -0,0 +1,154 @@
+"""Minimal stand-in of the plpy module of PL/Python for running prestogres.py
+outside of PostgreSQL. Statements are recorded in executed, and queries that
+prestogres.py depends on return plausible results.
+"""
+
+import json
+import re
+import time
+
+executed = []
+settings = {}
+warnings = []
+
+# state of pg_temp used by start_presto_query
+temp_function_result_type = [None]
+temp_function_security_definer = [None]
+
+# schemas in which tables are created, and now() of the transaction. tests
+# roll back a transaction by clearing the former and changing the latter
+schemas_with_tables = set()
+transaction_started_at = ["2015-01-01 00:00:00+00"]
+
+# values of sequences incremented by nextval
+sequences = {}
+
+# rows inserted from JSON arrays by materialize_presto_query, and owners of tables
+# it looks up to replace them
+inserted_rows = []
+table_owners = {}
+
+class SPIError(Exception):
+    pass
+
+class Error(Exception):
+    pass
+
+def quote_ident(name):
+    return '"%s"' % name.replace('"', '""')
+
+def quote_literal(value):
+    return "'%s'" % value.replace("'", "''")
+
+def quote_nullable(value):
+    if value is None:
+        return "NULL"
+    return quote_literal(value)
+
+class Result(list):
+    """Rows returned by execute. nrows is the number of processed rows."""
+
+    def __init__(self, rows=(), nrows=None):
+        list.__init__(self, rows)
+        self._nrows = len(self) if nrows is None else nrows
+
+    def nrows(self):
+        return self._nrows
+
+class Plan(object):
+    def __init__(self, sql, types):
+        self.sql = sql
+        self.types = types
+
+def prepare(sql, types=None):
+    return Plan(sql, types)
+
+_probe_types = []
+
+def execute(query, args=None, limit=0):
+    sql = query.sql if isinstance(query, Plan) else query
+    executed.append(sql)
+
+    if "pg_catalog.pg_settings" in sql:
+        return [{"name": name, "setting": value} for name, value in settings.items()]
+    if "current_setting('TimeZone')" in sql:
+        return [{"time_zone": "UTC", "search_path": ["$user", "public"], "application_name": "",
+                 "result_type": temp_function_result_type[0],
+                 "security_definer": temp_function_security_definer[0]}]
+    if "current_setting('search_path')" in sql:
+        return [{"search_path": ["$user", "public"]}]
+    if "pg_catalog.pg_sleep(" in sql:
+        time.sleep(args[0])
+        return [{"pg_sleep": None}]
+    if "from pg_catalog.pg_locks" in sql:
+        return [{"queued": 0, "priority_queued": 0}]
+    if "pg_catalog.now()::text as now" in sql:
+        return [{"now": transaction_started_at[0],
+                 "schema_names": [name for name in args[0] if name in schemas_with_tables]}]
+    if "as evictions" in sql and "from evicted" in sql:
+        return [{"evictions": 0}]
+    m = re.match(r"select pg_catalog\.nextval\('([^']+)'\)$", sql)
+    if m:
+        sequences[m.group(1)] = sequences.get(m.group(1), 0) + 1
+        return [{"nextval": sequences[m.group(1)]}]
+    if "from prestogres_catalog.result_cache_hits" in sql:
+        stats = {"entries": 0, "bytes": 0}
+        for name in re.findall(r"from prestogres_catalog\.result_cache_(\w+)\) as", sql):
+            stats[name] = sequences.get("prestogres_catalog.result_cache_" + name, 0)
+        return [stats]
+    if sql == "select session_user as name":
+        return [{"name": "test"}]
+    if "pg_catalog.pg_get_userbyid(relowner) as owner" in sql:
+        return [{"owner": table_owners[args[0]]}] if args[0] in table_owners else []
+    if "from pg_catalog.json_array_elements($1::json)" in sql:
+        rows = json.loads(args[0])
+        inserted_rows.extend(rows)
+        return Result([], len(rows))
+    if "current_database()" in sql:
+        return [{"current_database": "postgres"}]
+    if "prestogres_type_probe" in sql and sql.startswith("create"):
+        _probe_types[:] = re.findall(r'"c\d+" ([^,\n]+)', sql)
+        return []
+    if "pg_catalog.format_type" in sql and "prestogres_type_probe" in sql:
+        return [{"attnum": i + 1, "column_type": t} for i, t in enumerate(_probe_types)]
+
+    schemas_with_tables.update(re.findall(r'create table "((?:[^"]|"")+)"\.', sql))
+
+    m = re.search(r"create function pg_temp\.\S+\(\)\s+returns setof pg_temp\.\"([^\"]+)\"", sql)
+    if m:
+        temp_function_result_type[0] = m.group(1)
+        temp_function_security_definer[0] = "security definer" in sql
+    return []
+
+def cursor(query, args=None):
+    return iter(execute(query, args))
+
+def error(message):
+    raise Error(message)
+
+def warning(message):
+    warnings.append(message)
+
+def notice(message):
+    pass
+
+def log(message):
+    pass
+
+def info(message):
+    pass
+
+def debug(message):
+    pass
+
+def reset():
+    del executed[:]
+    del warnings[:]
+    settings.clear()
+    temp_function_result_type[0] = None
+    temp_function_security_definer[0] = None
+    schemas_with_tables.clear()
+    sequences.clear()
+    del inserted_rows[:]
+    table_owners.clear()
+    transaction_started_at[0] = "2015-01-01 00:00:00+00"
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""Replays statements captured by prestogres.capture_file against a fake coordinator.
+
+Usage:
+    python replay.py CAPTURE_FILE [--speed X] [--concurrency N] [--limit N]
+                     [--set prestogres.NAME=VALUE ...]
+
+Each statement runs through prestogres.start_presto_query and
+fetch_presto_query_results in one of N worker processes which stand for
+PostgreSQL backends. The fake coordinator returns results of the recorded
+shape: the same column types, rows and pages with the recorded latency of
+pages. Statements start at their recorded offsets divided by --speed
+(0 starts them back to back), and wait for a free worker as they would for
+a pooled backend.
+
+Rejected statements and statements which failed before returning columns
+are skipped. Statements answered by the result cache run on the fake
+coordinator.
+"""
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [HERE, os.path.join(HERE, "..", "pgsql")]
+
+import fake_presto
+from bench import _cpu_time, _peak_rss_bytes
+
+def load_capture(path, limit=None):
+    """Returns (records, skipped) of replayable statements sorted by start time."""
+    records = []
+    skipped = 0
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if record.get("state") == "REJECTED" or not record.get("columns"):
+                skipped += 1
+                continue
+            records.append(record)
+    records.sort(key=lambda record: record["ts"])
+    if limit is not None:
+        skipped += max(len(records) - limit, 0)
+        records = records[:limit]
+    return records, skipped
+
+def shape_of(record):
+    """FakePrestoConfig overrides that reproduce the results of a record."""
+    rows = record.get("rows") or 0
+    # the first page is the response of POST
+    data_pages = max((record.get("pages") or 1) - 1, 1)
+    fetch_ms = record.get("fetch_ms") or 0.0
+    return {
+        "rows": rows,
+        "page_rows": max(int(math.ceil(rows / float(data_pages))), 1),
+        "page_delay": fetch_ms / data_pages / 1000.0,
+        "queued_pages": 0,
+        "column_types": [column_type for name, column_type in record["columns"]],
+    }
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(math.ceil(p / 100.0 * len(values))) - 1, len(values) - 1)]
+
+def worker(server, settings, tasks, results):
+    import plpy
+    import prestogres
+    plpy.reset()
+    plpy.settings.update(settings)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        shape_id, scheduled_at, record = task
+        started_at = time.time()
+        rows = 0
+        error = None
+        try:
+            prestogres.start_presto_query(server, record.get("user") or "replay", record.get("catalog") or "hive",
+                    record.get("schema") or "default", "presto_fetch",
+                    "/* replay:%s */ %s" % (shape_id, record["query"]))
+            for row in prestogres.fetch_presto_query_results():
+                rows += 1
+        except Exception as e:
+            error = "%s: %s" % (type(e).__name__, e)
+        finished_at = time.time()
+        del plpy.executed[:]
+        results.put(("statement", finished_at - scheduled_at, finished_at - started_at, rows, error))
+
+    results.put(("worker", _peak_rss_bytes(), _cpu_time()))
+
+def main():
+    parser = argparse.ArgumentParser(description="replay a workload captured by prestogres.capture_file")
+    parser.add_argument("capture_file")
+    parser.add_argument("--speed", type=float, default=1.0, help="speed relative to the recorded workload. 0 means as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=8, help="number of backends")
+    parser.add_argument("--limit", type=int, help="replay only the first N statements")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE", help="prestogres.* setting of backends")
+    args = parser.parse_args()
+
+    records, skipped = load_capture(args.capture_file, args.limit)
+    if not records:
+        print "no statements to replay (%d skipped)" % skipped
+        return
+
+    settings = dict(setting.split("=", 1) for setting in args.set)
+
+    server = fake_presto.FakePrestoServer()
+    for i, record in enumerate(records):
+        server.add_shape(i, **shape_of(record))
+
+    # fork workers before the coordinator starts serving in this process
+    tasks = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=worker, args=(server.address, settings, tasks, results))
+            for i in xrange(args.concurrency)]
+    for process in workers:
+        process.daemon = True
+        process.start()
+    server.start()
+
+    try:
+        start = time.time()
+        first_ts = records[0]["ts"]
+        for i, record in enumerate(records):
+            scheduled_at = start
+            if args.speed > 0:
+                scheduled_at += (record["ts"] - first_ts) / args.speed
+                delay = scheduled_at - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            tasks.put((i, scheduled_at, record))
+        for process in workers:
+            tasks.put(None)
+
+        latencies = []
+        run_times = []
+        total_rows = 0
+        errors = []
+        peak_rss = []
+        cpu = 0.0
+        while len(peak_rss) < len(workers):
+            result = results.get()
+            if result[0] == "statement":
+                latency, run_time, rows, error = result[1:]
+                latencies.append(latency)
+                run_times.append(run_time)
+                total_rows += rows
+                if error is not None:
+                    errors.append(error)
+            else:
+                peak_rss.append(result[1])
+                cpu += result[2]
+        elapsed = time.time() - start
+        for process in workers:
+            process.join()
+    finally:
+        server.stop()
+
+    print "statements:  %d (%d errors, %d skipped)" % (len(latencies), len(errors), skipped)
+    print "elapsed:     %.2f s" % elapsed
+    print "throughput:  %.1f statements/s, %.0f rows/s" % (len(latencies) / elapsed, total_rows / elapsed)
+    print "latency(ms): p50 %.1f  p90 %.1f  p99 %.1f  max %.1f  (including waits for a backend)" % tuple(
+            percentile(latencies, p) * 1000 for p in (50, 90, 99, 100))
+    print "run(ms):     p50 %.1f  p90 %.1f  p99 %.1f  max %.1f" % tuple(
+            percentile(run_times, p) * 1000 for p in (50, 90, 99, 100))
+    print "backend rss: max %.1f MB  avg %.1f MB  cpu %.2f s" % (
+            max(peak_rss) / 1024.0 / 1024.0, sum(peak_rss) / float(len(peak_rss)) / 1024.0 / 1024.0, cpu)
+    for error in sorted(set(errors))[:10]:
+        print "error:       %s" % error
+
+if __name__ == "__main__":
+    main()
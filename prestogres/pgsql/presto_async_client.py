@@ -0,0 +1,417 @@
+"""asyncio client of Presto for Python 3.6 or later.
+
+AsyncClient and AsyncQuery have the same semantics as Client and Query of
+presto_client and share its response decoding, paging and retry policies, so
+that one process can run many statements concurrently in an event loop:
+
+    client = AsyncClient(server="localhost:8080", user="warmer", catalog="hive")
+    columns, rows = await client.run("select 1")
+
+    async with await client.query("select * from t") as query:
+        async for row in query:
+            ...
+
+    await client.close()
+
+This module isn't loaded by PL/Python, which runs presto_client on Python 2.
+"""
+
+import asyncio
+import time
+
+from presto_client import (
+    PagingScheduler, PrestoClientException, PrestoHeaders, PrestoHttpException, PrestoQueryException,
+    QueryMetrics, QueryResults, StatementClient, decompress_body)
+
+class AsyncHttpConnection(object):
+    """HTTP/1.1 keep-alive connection using asyncio streams."""
+
+    def __init__(self, server, timeout):
+        host, _, port = server.partition(":")
+        self.host = host
+        self.port = int(port) if port else 80
+        self.server = server
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+
+    @property
+    def is_open(self):
+        return self.writer is not None and not self.reader.at_eof()
+
+    async def request(self, method, uri, body=None, headers={}):
+        """Sends a request and returns (status, body, transferred bytes) tuple.
+        Compressed bodies are decompressed."""
+        return await asyncio.wait_for(self._request(method, uri, body, headers), self.timeout)
+
+    async def _request(self, method, uri, body, headers):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        lines = ["%s %s HTTP/1.1" % (method, uri), "Host: %s" % self.server]
+        for name, value in headers.items():
+            lines.append("%s: %s" % (name, value))
+        lines.append("Content-Length: %d" % (len(body) if body is not None else 0))
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        if body:
+            self.writer.write(body)
+        await self.writer.drain()
+
+        status, keep_alive, content_encoding, body = await self._read_response()
+        if not keep_alive:
+            self.close()
+        return status, decompress_body(body, content_encoding), len(body)
+
+    async def _read_response(self):
+        reader = self.reader
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by %s" % self.server)
+        version, status = status_line.decode("latin-1").split(" ", 2)[:2]
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    # skip trailers
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)  # CRLF
+            body = b"".join(chunks)
+        elif "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+        else:
+            body = await reader.read()
+            keep_alive = False
+
+        return int(status), keep_alive, headers.get("content-encoding"), body
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.reader = None
+
+class AsyncConnectionPool(object):
+    """Idle keep-alive connections keyed by coordinator address."""
+
+    def __init__(self, max_idle_connections=16):
+        self.max_idle_connections = max_idle_connections
+        self.idle = {}  # (server, timeout) -> [connection]
+
+    def get(self, server, timeout):
+        """Returns (connection, reused) tuple."""
+        entries = self.idle.get((server, timeout), [])
+        while entries:
+            conn = entries.pop()
+            if conn.is_open:
+                return conn, True
+            conn.close()
+        return AsyncHttpConnection(server, timeout), False
+
+    def put(self, conn, server, timeout):
+        entries = self.idle.setdefault((server, timeout), [])
+        if conn.is_open and len(entries) < self.max_idle_connections:
+            entries.append(conn)
+        else:
+            conn.close()
+
+    def clear(self):
+        for entries in self.idle.values():
+            for conn in entries:
+                conn.close()
+        self.idle.clear()
+
+class AsyncStatementClient(object):
+    """Counterpart of StatementClient. Use `await AsyncStatementClient.start(...)`."""
+
+    def __init__(self, http_client, query, connection_pool=None, reused=False, **options):
+        self.http_client = http_client
+        self.query = query
+        self.options = options
+        self.connection_pool = connection_pool
+        self.reused = reused
+        self.scheduler = PagingScheduler(
+                max_wait=options.get("max_wait", 1.0),
+                page_size=options.get("page_size", 1024*1024),
+                max_page_size=options.get("max_page_size", 16*1024*1024))
+
+        self.closed = False
+        self.exception = None
+        self.results = None
+        self.page_sequence_id = 0  # number of pages received
+        self.metrics = QueryMetrics()
+
+    @classmethod
+    async def start(cls, http_client, query, **kwargs):
+        client = cls(http_client, query, **kwargs)
+        await client._post_query_request()
+        return client
+
+    async def _post_query_request(self):
+        headers = StatementClient.query_request_headers(self.options)
+
+        try:
+            status, body, transferred = await self._request("POST", "/v1/statement", self.query, headers)
+        except BaseException:
+            self._release_connection(False)
+            raise
+
+        if status != 200:
+            self._release_connection(False)
+            raise PrestoHttpException(status, "Failed to start query: %s" % body.decode("utf-8", "replace"))
+
+        fetched_at = time.time()
+        self.results = QueryResults.decode_body(body.decode("utf-8"))
+        self.page_sequence_id = 1
+        self.metrics.submit_time = fetched_at - self.metrics.started_at
+        self.metrics.page_received(self.results, 0.0, time.time() - fetched_at, len(body), transferred)
+
+        if not self.has_next:
+            self._release_connection(True)
+
+    async def _request(self, method, uri, body=None, headers={}):
+        try:
+            return await self.http_client.request(method, uri, body, headers)
+        except (OSError, asyncio.IncompleteReadError):
+            if not self.reused:
+                raise
+            # a pooled keep-alive connection was closed by the server.
+            # retry once using a new connection.
+            self.http_client.close()
+            self.reused = False
+            return await self.http_client.request(method, uri, body, headers)
+
+    def _release_connection(self, reusable):
+        http_client = self.http_client
+        if http_client is None:
+            return
+        self.http_client = None
+        if reusable and self.connection_pool is not None:
+            self.connection_pool.put(http_client, self.options["server"], http_client.timeout)
+        else:
+            http_client.close()
+
+    @property
+    def is_query_failed(self):
+        return self.results.error is not None
+
+    @property
+    def is_query_succeeded(self):
+        return self.results.error is None and self.exception is None and not self.closed
+
+    @property
+    def has_next(self):
+        return self.results.next_uri is not None
+
+    async def advance(self):
+        if self.closed or not self.has_next:
+            return False
+
+        uri = self.results.next_uri
+        scheduler = self.scheduler
+        start = scheduler.start_fetch()
+        retry_timeout = self.options.get("retry_timeout", 2*60*60)
+        max_reconnects = self.options.get("max_reconnects", 5)
+        reconnects = 0
+
+        while True:
+            headers = StatementClient.HEADERS.copy()
+            headers.update(scheduler.request_headers())
+            headers.update(StatementClient.compression_headers(self.options))
+            headers[PrestoHeaders.PRESTO_PAGE_SEQUENCE_ID] = str(self.page_sequence_id)
+            fetch_start = time.time()
+            try:
+                status, body, transferred = await self._request("GET", uri, headers=headers)
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                if reconnects >= max_reconnects or self.closed:
+                    self.exception = e
+                    self._release_connection(False)
+                    raise
+                # request the same page again using a new connection (see StatementClient.advance)
+                reconnects += 1
+                self.metrics.reconnects += 1
+                self.http_client.close()
+                self.reused = False
+                await asyncio.sleep(scheduler.backoff())
+                continue
+            except BaseException as e:
+                self.exception = e
+                self._release_connection(False)
+                raise
+
+            if status == 200 and body:
+                fetched_at = time.time()
+                scheduler.page_received(fetch_start, len(body))
+                self.results = QueryResults.decode_body(body.decode("utf-8"))
+                self.page_sequence_id += 1
+                self.metrics.page_received(self.results, fetched_at - start, time.time() - fetched_at, len(body), transferred)
+                if not self.has_next:
+                    self._release_connection(True)
+                return True
+
+            if status != 503:  # retry on 503 Service Unavailable
+                self.exception = PrestoHttpException(status, "Error fetching next at %s returned %s: %s" % \
+                        (uri, status, body.decode("utf-8", "replace")))
+                self._release_connection(False)
+                raise self.exception
+
+            if (time.time() - start) > retry_timeout or self.closed:
+                break
+
+            self.metrics.retries += 1
+            await asyncio.sleep(scheduler.backoff())
+
+        self.exception = PrestoHttpException(408, "Error fetching next")
+        self._release_connection(False)
+        raise self.exception
+
+    async def cancel_leaf_stage(self):
+        if self.results.next_uri is not None and self.http_client is not None:
+            try:
+                status, body, transferred = await self._request("DELETE", self.results.next_uri)
+            except BaseException:
+                self._release_connection(False)
+                raise
+            return status // 100 == 2
+        return False
+
+    async def close(self):
+        if self.closed:
+            return
+        # set first because close may be called concurrently, for example by
+        # __aexit__ and finalization of an abandoned results() iterator
+        self.closed = True
+        try:
+            await self.cancel_leaf_stage()
+        finally:
+            self._release_connection(False)
+
+class AsyncQuery(object):
+    @classmethod
+    async def start(cls, query, connection_pool=None, **options):
+        timeout = options.get("http_timeout", 300)
+        if connection_pool is not None:
+            http_client, reused = connection_pool.get(options["server"], timeout)
+        else:
+            http_client, reused = AsyncHttpConnection(options["server"], timeout), False
+        client = await AsyncStatementClient.start(http_client, query,
+                connection_pool=connection_pool, reused=reused, **options)
+        return AsyncQuery(client)
+
+    def __init__(self, client):
+        self.client = client
+
+    async def _wait_for_columns(self):
+        while self.client.results.columns is None and await self.client.advance():
+            pass
+
+    async def _wait_for_data(self):
+        while self.client.results.data is None and await self.client.advance():
+            pass
+
+    async def columns(self):
+        await self._wait_for_columns()
+
+        if not self.client.is_query_succeeded:
+            self._raise_error()
+
+        return self.client.results.columns
+
+    async def results(self):
+        """Async iterator of rows. The query is closed when the rows are exhausted,
+        iteration fails or the consuming task is cancelled. An async generator
+        isn't closed by break, so callers which stop early close the query using
+        async with or await query.close()."""
+        try:
+            await self._wait_for_data()
+
+            client = self.client
+
+            if not client.is_query_succeeded:
+                self._raise_error()
+
+            if await self.columns() is None:
+                raise PrestoClientException("Query %s has no columns" % client.results.id)
+
+            metrics = client.metrics
+            results = client.results
+            while True:
+                # long-polled pages may not include data even if the query is running
+                if results.data is not None:
+                    for row in results.data:
+                        yield row
+                wait_start = time.time()
+                has_next = await client.advance()
+                metrics.wait_time += time.time() - wait_start
+                if not has_next:
+                    break
+                results = client.results
+
+            if client.is_query_failed:
+                self._raise_error()
+        finally:
+            await self.close()
+
+    def __aiter__(self):
+        return self.results()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def cancel(self):
+        await self.client.cancel_leaf_stage()
+
+    async def close(self):
+        await self.client.close()
+
+    def _raise_error(self):
+        if self.client.closed:
+            raise PrestoClientException("Query aborted by user")
+        elif self.client.exception is not None:
+            raise self.client.exception
+        elif self.client.is_query_failed:
+            results = self.client.results
+            error = results.error
+            if error is None:
+                raise PrestoQueryException("Query %s failed: (unknown reason)" % results.id, None, None, None)
+            raise PrestoQueryException("Query %s failed: %s" % (results.id, error.message), results.id, error.error_code, error.failure_info)
+
+class AsyncClient(object):
+    def __init__(self, **options):
+        self.options = options
+        self.connection_pool = AsyncConnectionPool() if options.pop("keep_alive", True) else None
+
+    async def query(self, query):
+        return await AsyncQuery.start(query, connection_pool=self.connection_pool, **self.options)
+
+    async def run(self, query):
+        q = await self.query(query)
+        try:
+            columns = await q.columns()
+            if columns is None:
+                return [], []
+            return columns, [row async for row in q.results()]
+        finally:
+            await q.close()
+
+    async def close(self):
+        if self.connection_pool is not None:
+            self.connection_pool.clear()
@@ -1,10 +1,20 @@
 import os
-import httplib
+import collections
+import random
+import re
+import select
+import socket
+import tempfile
+import threading
 import time
+import zlib
 
 try: import simplejson as json
 except ImportError: import json
 
+try: import httplib
+except ImportError: import http.client as httplib  # Python 3 (presto_async_client)
+
 VERSION = "0.1.0"
 
 class ClientSession(object):
@@ -17,6 +27,8 @@ class ClientSession(object):
         self.debug = debug
 
 class StatementStats(object):
+    __slots__ = ("state", "scheduled", "nodes", "total_splits", "queued_splits", "running_splits", "completed_splits", "user_time_millis", "cpu_time_millis", "wall_time_millis", "processed_rows", "processed_bytes")
+
     def __init__(self, state=None, scheduled=None, nodes=None, total_splits=None, queued_splits=None, running_splits=None, completed_splits=None, user_time_millis=None, cpu_time_millis=None, wall_time_millis=None, processed_rows=None, processed_bytes=None):
         self.state = state
         self.scheduled = scheduled
@@ -51,6 +63,8 @@ class StatementStats(object):
                 )
 
 class Column(object):
+    __slots__ = ("name", "type")
+
     def __init__(self, name, type):
         self.name = name
         self.type = type
@@ -63,6 +77,8 @@ class Column(object):
                 )
 
 class ErrorLocation(object):
+    __slots__ = ("line_number", "column_number")
+
     def __init__(self, line_number, column_number):
         self.line_number = line_number
         self.column_number = column_number
@@ -75,6 +91,8 @@ class ErrorLocation(object):
                 )
 
 class FailureInfo(object):
+    __slots__ = ("type", "message", "cause", "suppressed", "stack", "error_location")
+
     def __init__(self, type=None, message=None, cause=None, suppressed=None, stack=None, error_location=None):
         self.type = type
         self.message = message
@@ -89,12 +107,14 @@ class FailureInfo(object):
                 type=dic.get("type"),
                 message=dic.get("message"),
                 cause=dic.get("cause"),
-                suppressed=map(FailureInfo.decode_dict, dic["suppressed"]) if "suppressed" in dic else None,
+                suppressed=[FailureInfo.decode_dict(d) for d in dic["suppressed"]] if "suppressed" in dic else None,
                 stack=dic.get("stack"),
                 error_location=ErrorLocation.decode_dict(dic["errorLocation"]) if "errorLocation" in dic else None,
                 )
 
 class QueryError(object):
+    __slots__ = ("message", "sql_state", "error_code", "error_location", "failure_info")
+
     def __init__(self, message=None, sql_state=None, error_code=None, error_location=None, failure_info=None):
         self.message = message
         self.sql_state = sql_state
@@ -112,16 +132,69 @@ class QueryError(object):
                 failure_info=FailureInfo.decode_dict(dic["failureInfo"]) if "failureInfo" in dic else None,
                 )
 
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+DATA_KEY_PATTERN = re.compile(r'"data"[ \t\n\r]*:[ \t\n\r]*')
+STATS_KEY_PATTERN = re.compile(r'"stats"[ \t\n\r]*:')
+
+json_decoder = json.JSONDecoder()
+
+class PageRows(object):
+    """Rows of a page decoded one by one from the JSON array at body[start:end]."""
+
+    __slots__ = ("body", "start", "end")
+
+    def __init__(self, body, start, end):
+        self.body = body
+        self.start = start
+        self.end = end
+
+    def __iter__(self):
+        body = self.body
+        raw_decode = json_decoder.raw_decode
+        skip = JSON_WHITESPACE.match
+        pos = skip(body, self.start + 1).end()  # skip [
+        if body[pos] == "]":
+            return
+        while True:
+            row, pos = raw_decode(body, pos)
+            yield row
+            pos = skip(body, pos).end()
+            if body[pos] != ",":
+                return  # ]
+            pos = skip(body, pos + 1).end()
+
 class QueryResults(object):
+    __slots__ = ("id", "info_uri", "partial_cache_uri", "next_uri", "data", "_columns", "_stats", "_error")
+
     def __init__(self, id, info_uri=None, partial_cache_uri=None, next_uri=None, columns=None, data=None, stats=None, error=None):
         self.id = id
         self.info_uri = info_uri
         self.partial_cache_uri = partial_cache_uri
         self.next_uri = next_uri
-        self.columns = columns
         self.data = data
-        self.stats = stats
-        self.error = error
+        # columns, stats and error can be raw dicts decoded on first access
+        self._columns = columns
+        self._stats = stats
+        self._error = error
+
+    @property
+    def columns(self):
+        columns = self._columns
+        if columns and isinstance(columns[0], dict):
+            columns = self._columns = [Column.decode_dict(c) for c in columns]
+        return columns
+
+    @property
+    def stats(self):
+        if isinstance(self._stats, dict):
+            self._stats = StatementStats.decode_dict(self._stats)
+        return self._stats
+
+    @property
+    def error(self):
+        if isinstance(self._error, dict):
+            self._error = QueryError.decode_dict(self._error)
+        return self._error
 
     @classmethod
     def decode_dict(cls, dic):
@@ -130,12 +203,155 @@ class QueryResults(object):
                 info_uri=dic.get("infoUri"),
                 partial_cache_uri=dic.get("partialCancelUri"),
                 next_uri=dic.get("nextUri"),
-                columns=map(Column.decode_dict, dic["columns"]) if "columns" in dic else None,
+                columns=dic.get("columns"),
                 data=dic.get("data"),
-                stats=StatementStats.decode_dict(dic["stats"]) if "stats" in dic else None,
-                error=QueryError.decode_dict(dic["error"]) if "error" in dic else None,
+                stats=dic.get("stats"),
+                error=dic.get("error"),
                 )
 
+    @classmethod
+    def decode_body(cls, body):
+        """Decodes a response body without building the data array.
+
+        Presto writes data after id, nextUri and columns, followed by stats and
+        error. The parts around data are decoded as small JSON documents and data
+        becomes PageRows that decodes rows lazily. Falls back to decoding the
+        whole body if the layout is different.
+        """
+        m = DATA_KEY_PATTERN.search(body)
+        if m is None or body[m.end()] != "[":
+            return cls.decode_dict(json.loads(body))
+
+        data_start = m.end()
+        stats_pos = body.rfind('"stats"')
+        if stats_pos <= data_start or STATS_KEY_PATTERN.match(body, stats_pos) is None:
+            return cls.decode_dict(json.loads(body))
+
+        comma = body.rfind(",", data_start, stats_pos)
+        data_end = body.rfind("]", data_start, comma) + 1
+        if comma < 0 or data_end <= data_start or body[data_end:stats_pos].strip() != ",":
+            return cls.decode_dict(json.loads(body))
+
+        try:
+            head = body[:m.start()].rstrip()
+            if head.endswith(","):
+                head = head[:-1]
+            dic = json.loads(head + "}")
+            dic.update(json.loads("{" + body[stats_pos:]))
+        except ValueError:
+            # "data" or "stats" appeared in an unexpected place
+            return cls.decode_dict(json.loads(body))
+
+        dic["data"] = PageRows(body, data_start, data_end)
+        return cls.decode_dict(dic)
+
+# Content-Encoding values which can be requested using the compression option
+CONTENT_ENCODINGS = ("gzip", "deflate")
+
+# size of compressed response bodies read at once
+DECOMPRESS_CHUNK_SIZE = 64*1024
+
+class DeflateDecompressor(object):
+    """Decompressor of Content-Encoding: deflate. The body should be in zlib
+    format but some servers send raw deflate data without the zlib header.
+    Decompresses it as raw deflate data if the first chunk has no zlib header.
+    """
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj()
+        self.started = False
+
+    def decompress(self, data):
+        if not self.started and data:
+            self.started = True
+            try:
+                return self.decompressor.decompress(data)
+            except zlib.error:
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self.decompressor.decompress(data)
+
+    def flush(self):
+        return self.decompressor.flush()
+
+def _decompressor(content_encoding):
+    if content_encoding is None:
+        return None
+    content_encoding = content_encoding.strip().lower()
+    if content_encoding == "gzip":
+        # +32 detects either gzip or zlib header
+        return zlib.decompressobj(32 + zlib.MAX_WBITS)
+    if content_encoding == "deflate":
+        return DeflateDecompressor()
+    return None
+
+def read_body(response):
+    """Reads body of a response decompressing it as it arrives if it's compressed.
+    Returns (body, transferred bytes) tuple."""
+    decompressor = _decompressor(response.getheader("Content-Encoding"))
+    if decompressor is None:
+        body = response.read()
+        return body, len(body)
+    chunks = []
+    transferred = 0
+    while True:
+        chunk = response.read(DECOMPRESS_CHUNK_SIZE)
+        if not chunk:
+            break
+        transferred += len(chunk)
+        chunks.append(decompressor.decompress(chunk))
+    chunks.append(decompressor.flush())
+    return b"".join(chunks), transferred
+
+def decompress_body(body, content_encoding):
+    """Decompresses a whole response body according to its Content-Encoding."""
+    decompressor = _decompressor(content_encoding)
+    if decompressor is None:
+        return body
+    return decompressor.decompress(body) + decompressor.flush()
+
+class QueryMetrics(object):
+    """Timings and counters of a statement measured on the client side.
+
+    Times are seconds. time_to_* are measured from started_at. fetch_time is
+    time spent in requests of pages including retries, and wait_time is time
+    the consumer of Query.results waited for pages (smaller than fetch_time if
+    pages are prefetched). bytes is the size of decompressed bodies and
+    transferred_bytes is the size received from the network. reconnects is the
+    number of pages requested again after the connection was dropped.
+    """
+
+    __slots__ = ("started_at", "submit_time", "time_to_first_page", "time_to_columns", "time_to_first_data",
+            "pages", "fetch_time", "decode_time", "wait_time", "bytes", "transferred_bytes", "retries", "reconnects")
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.submit_time = None
+        self.time_to_first_page = None
+        self.time_to_columns = None
+        self.time_to_first_data = None
+        self.pages = 0
+        self.fetch_time = 0.0
+        self.decode_time = 0.0
+        self.wait_time = 0.0
+        self.bytes = 0
+        self.transferred_bytes = 0
+        self.retries = 0
+        self.reconnects = 0
+
+    def page_received(self, results, fetch_time, decode_time, body_bytes, transferred_bytes):
+        now = time.time()
+        self.pages += 1
+        self.fetch_time += fetch_time
+        self.decode_time += decode_time
+        self.bytes += body_bytes
+        self.transferred_bytes += transferred_bytes
+        if self.time_to_first_page is None:
+            self.time_to_first_page = now - self.started_at
+        if self.time_to_columns is None and results._columns is not None:
+            self.time_to_columns = now - self.started_at
+        if self.time_to_first_data is None and results.data is not None:
+            self.time_to_first_data = now - self.started_at
+
 class PrestoException(Exception):
     pass
 
@@ -147,6 +363,10 @@ class PrestoHttpException(PrestoException):
 class PrestoClientException(PrestoException):
     pass
 
+class PrestoConnectionException(PrestoException):
+    """Raised if a coordinator couldn't be connected. Nothing was sent to it."""
+    pass
+
 class PrestoQueryException(PrestoException):
     def __init__(self, message, query_id, error_code, failure_info):
         PrestoException.__init__(self, message)
@@ -167,46 +387,393 @@ class PrestoHeaders(object):
     PRESTO_MAX_SIZE = "X-Presto-Max-Size"
     PRESTO_PAGE_SEQUENCE_ID = "X-Presto-Page-Sequence-Id"
 
+class HttpConnectionPool(object):
+    """Per-process pool of keep-alive HTTP connections keyed by coordinator address."""
+
+    def __init__(self, max_idle_connections=4, max_idle_time=30):
+        self.max_idle_connections = max_idle_connections
+        self.max_idle_time = max_idle_time
+        self.lock = threading.Lock()
+        self.idle = {}  # (server, timeout) -> [(connection, released_at)]
+
+    def get(self, server, timeout):
+        """Returns (connection, reused) tuple."""
+        key = (server, timeout)
+        now = time.time()
+        with self.lock:
+            entries = self.idle.get(key, [])
+            while entries:
+                conn, released_at = entries.pop()
+                if now - released_at <= self.max_idle_time and HttpConnectionPool._is_alive(conn):
+                    return conn, True
+                conn.close()
+        return httplib.HTTPConnection(host=server, timeout=timeout), False
+
+    def put(self, conn, server, timeout):
+        if conn.sock is None:
+            # closed by the server (Connection: close) or by an error
+            return
+        key = (server, timeout)
+        now = time.time()
+        with self.lock:
+            entries = self.idle.setdefault(key, [])
+            self._evict(entries, now)
+            if len(entries) >= self.max_idle_connections:
+                conn.close()
+                return
+            entries.append((conn, now))
+
+    def clear(self):
+        with self.lock:
+            for entries in self.idle.values():
+                for conn, released_at in entries:
+                    conn.close()
+            self.idle.clear()
+
+    def _evict(self, entries, now):
+        alive = []
+        for conn, released_at in entries:
+            if now - released_at <= self.max_idle_time:
+                alive.append((conn, released_at))
+            else:
+                conn.close()
+        entries[:] = alive
+
+    @staticmethod
+    def _is_alive(conn):
+        if conn.sock is None:
+            return False
+        try:
+            # an idle keep-alive socket becomes readable only when the server
+            # closed it (EOF) or sent something unexpected
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+connection_pool = HttpConnectionPool()
+
+SERVER_LIST_SEPARATOR = re.compile(r"[\s,;]+")
+
+def parse_servers(server):
+    """Returns a list of coordinator addresses given as a list or a string separated
+    by commas, semicolons or whitespace."""
+    if isinstance(server, (list, tuple)):
+        return list(server)
+    return [s for s in SERVER_LIST_SEPARATOR.split(server) if s]
+
+def _connect(http_client):
+    try:
+        http_client.connect()
+    except (httplib.HTTPException, socket.error) as e:
+        http_client.close()
+        raise PrestoConnectionException("Failed to connect to %s:%d: %s" % (http_client.host, http_client.port, e))
+
+class CoordinatorState(object):
+    __slots__ = ("server", "cluster_queued", "cluster_running", "cluster_stats_at",
+            "in_flight", "queued", "latency", "failures", "unhealthy_until", "refreshing")
+
+    def __init__(self, server):
+        self.server = server
+        self.cluster_queued = 0  # queued queries reported by /v1/cluster
+        self.cluster_running = 0  # running queries reported by /v1/cluster
+        self.cluster_stats_at = 0
+        self.in_flight = 0  # statements of this process running on it
+        self.queued = 0  # statements of this process in QUEUED state
+        self.latency = None  # moving average of seconds to submit a statement
+        self.failures = 0  # consecutive connection failures
+        self.unhealthy_until = 0
+        self.refreshing = False  # /v1/cluster is being requested
+
+class CoordinatorRouter(object):
+    """Chooses a coordinator for new statements among several ones.
+
+    Healthy coordinators are ordered by queued queries, then running queries,
+    then latency of submitting statements. Queued and running queries are the
+    cluster-wide numbers of /v1/cluster refreshed every stats_interval seconds
+    plus the statements this process started since. /v1/cluster is requested
+    by a background thread so that a slow coordinator doesn't delay statements;
+    they are ordered by the last known numbers meanwhile. A coordinator that fails
+    to accept a statement is skipped for retry_interval seconds, doubling up to
+    max_retry_interval while it keeps failing.
+    """
+
+    def __init__(self, stats_interval=5.0, stats_timeout=1.0, retry_interval=1.0,
+            max_retry_interval=60.0, latency_weight=0.3):
+        self.stats_interval = stats_interval
+        self.stats_timeout = stats_timeout
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.latency_weight = latency_weight
+        self.lock = threading.Lock()
+        self.coordinators = {}  # server -> CoordinatorState
+
+    def _state(self, server):
+        state = self.coordinators.get(server)
+        if state is None:
+            state = self.coordinators[server] = CoordinatorState(server)
+        return state
+
+    def order(self, servers):
+        """Returns servers in the order to try."""
+        now = time.time()
+        with self.lock:
+            states = [self._state(server) for server in servers]
+            healthy = [state for state in states if state.unhealthy_until <= now]
+            for state in healthy:
+                if not state.refreshing and now - state.cluster_stats_at >= self.stats_interval:
+                    state.refreshing = True
+                    thread = threading.Thread(target=self._refresh_cluster_stats, args=(state,))
+                    thread.daemon = True
+                    thread.start()
+        healthy.sort(key=lambda state: (
+            state.cluster_queued + state.queued,
+            state.cluster_running + state.in_flight,
+            state.latency or 0.0))
+        unhealthy = sorted([state for state in states if state not in healthy],
+                key=lambda state: state.unhealthy_until)
+        return [state.server for state in healthy + unhealthy]
+
+    def _refresh_cluster_stats(self, state):
+        now = time.time()
+        conn = httplib.HTTPConnection(state.server, timeout=self.stats_timeout)
+        try:
+            conn.request("GET", "/v1/cluster", None, StatementClient.HEADERS)
+            response = conn.getresponse()
+            body = response.read()
+        except (httplib.HTTPException, socket.error):
+            self.request_failed(state.server)
+            return
+        finally:
+            conn.close()
+            with self.lock:
+                state.refreshing = False
+        stats = None
+        if response.status == 200:
+            try:
+                stats = json.loads(body)
+            except ValueError:
+                pass
+        with self.lock:
+            state.cluster_stats_at = now
+            if stats is not None:
+                # the process's own statements are counted in both until the next refresh
+                state.cluster_queued = stats.get("queuedQueries", 0) + stats.get("blockedQueries", 0)
+                state.cluster_running = stats.get("runningQueries", 0)
+
+    def request_succeeded(self, server, latency):
+        with self.lock:
+            state = self._state(server)
+            state.failures = 0
+            state.unhealthy_until = 0
+            if state.latency is None:
+                state.latency = latency
+            else:
+                state.latency += (latency - state.latency) * self.latency_weight
+
+    def request_failed(self, server):
+        with self.lock:
+            state = self._state(server)
+            state.failures += 1
+            interval = min(self.retry_interval * (2 ** (state.failures - 1)), self.max_retry_interval)
+            state.unhealthy_until = time.time() + interval
+            state.cluster_stats_at = 0
+
+    def statement_started(self, server):
+        with self.lock:
+            self._state(server).in_flight += 1
+
+    def statement_queued(self, server, queued):
+        with self.lock:
+            self._state(server).queued += 1 if queued else -1
+
+    def statement_finished(self, server, queued):
+        with self.lock:
+            state = self._state(server)
+            state.in_flight -= 1
+            if queued:
+                state.queued -= 1
+
+coordinator_router = CoordinatorRouter()
+
+class PagingScheduler(object):
+    """Decides long-poll wait and page size of the next page request, and backoff of retries."""
+
+    def __init__(self, max_wait=1.0, page_size=1024*1024, max_page_size=16*1024*1024, backoff_base=0.05, backoff_max=2.0):
+        self.max_wait = max_wait
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.attempts = 0
+        self.last_page_bytes = 0
+        self.last_page_received_at = None
+        self.last_fetch_time = 0
+
+    def request_headers(self):
+        return {
+                PrestoHeaders.PRESTO_MAX_WAIT: "%dms" % int(self.max_wait * 1000),
+                PrestoHeaders.PRESTO_MAX_SIZE: "%dB" % self.page_size,
+                }
+
+    def start_fetch(self):
+        now = time.time()
+        if self.last_page_received_at is not None:
+            # the consumer keeps up if it asked for the next page faster than
+            # the network delivered the last one. ask for larger pages then
+            # because the round trips are the bottleneck.
+            consumer_time = now - self.last_page_received_at
+            if consumer_time < self.last_fetch_time and self.last_page_bytes * 2 >= self.page_size:
+                self.page_size = min(self.page_size * 2, self.max_page_size)
+        self.attempts = 0
+        return now
+
+    def page_received(self, fetch_start, body_bytes):
+        now = time.time()
+        self.last_page_bytes = body_bytes
+        self.last_page_received_at = now
+        self.last_fetch_time = now - fetch_start
+
+    def backoff(self):
+        # exponential backoff with jitter so that queued queries don't poll
+        # the coordinator at the same time
+        delay = min(self.backoff_max, self.backoff_base * (2 ** self.attempts))
+        self.attempts += 1
+        return random.uniform(delay / 2, delay)
+
 class StatementClient(object):
     HEADERS = {
             "User-Agent": "presto-python/%s" % VERSION
             }
 
-    def __init__(self, http_client, query, **options):
+    def __init__(self, http_client, query, connection_pool=None, reused=False, router=None, **options):
         self.http_client = http_client
         self.query = query
         self.options = options
+        self.connection_pool = connection_pool
+        self.reused = reused
+        self.router = router
+        self.routed = False  # counted as in-flight by router
+        self.router_queued = False
+        self.scheduler = PagingScheduler(
+                max_wait=options.get("max_wait", 1.0),
+                page_size=options.get("page_size", 1024*1024),
+                max_page_size=options.get("max_page_size", 16*1024*1024))
 
         self.closed = False
+        self.interrupted = False  # set by another thread to stop retrying
         self.exception = None
         self.results = None
+        self.page_sequence_id = 0  # number of pages received
+        self.metrics = QueryMetrics()
         self._post_query_request()
 
+    @classmethod
+    def query_request_headers(cls, options):
+        headers = cls.HEADERS.copy()
+
+        if options.get("user") is not None:
+            headers[PrestoHeaders.PRESTO_USER] = options["user"]
+        if options.get("source") is not None:
+            headers[PrestoHeaders.PRESTO_SOURCE] = options["source"]
+        if options.get("catalog") is not None:
+            headers[PrestoHeaders.PRESTO_CATALOG] = options["catalog"]
+        if options.get("schema") is not None:
+            headers[PrestoHeaders.PRESTO_SCHEMA] = options["schema"]
+        if options.get("time_zone") is not None:
+            headers[PrestoHeaders.PRESTO_TIME_ZONE] = options["time_zone"]
+        if options.get("language") is not None:
+            headers[PrestoHeaders.PRESTO_LANGUAGE] = options["language"]
+        headers.update(cls.compression_headers(options))
+
+        return headers
+
+    @classmethod
+    def compression_headers(cls, options):
+        compression = options.get("compression")
+        if isinstance(compression, dict):
+            # per coordinator
+            compression = compression.get(options["server"])
+        if not compression:
+            return {}
+        if compression not in CONTENT_ENCODINGS:
+            raise PrestoClientException("Unsupported compression: %s" % compression)
+        return {"Accept-Encoding": compression}
+
     def _post_query_request(self):
-        headers = StatementClient.HEADERS.copy()
-
-        if self.options.get("user") is not None:
-            headers[PrestoHeaders.PRESTO_USER] = self.options["user"]
-        if self.options.get("source") is not None:
-            headers[PrestoHeaders.PRESTO_SOURCE] = self.options["source"]
-        if self.options.get("catalog") is not None:
-            headers[PrestoHeaders.PRESTO_CATALOG] = self.options["catalog"]
-        if self.options.get("schema") is not None:
-            headers[PrestoHeaders.PRESTO_SCHEMA] = self.options["schema"]
-        if self.options.get("time_zone") is not None:
-            headers[PrestoHeaders.PRESTO_TIME_ZONE] = self.options["time_zone"]
-        if self.options.get("language") is not None:
-            headers[PrestoHeaders.PRESTO_LANGUAGE] = self.options["language"]
-
-        self.http_client.request("POST", "/v1/statement", self.query, headers)
-        response = self.http_client.getresponse()
-        body = response.read()
+        headers = StatementClient.query_request_headers(self.options)
+
+        try:
+            response = self._request("POST", "/v1/statement", self.query, headers)
+            body, transferred = read_body(response)
+        except Exception:
+            self._release_connection(False)
+            raise
+
+        if self.router is not None and response.status == 200:
+            self.router.request_succeeded(self.options["server"], time.time() - self.metrics.started_at)
 
         if response.status != 200:
+            self._release_connection(False)
             raise PrestoHttpException(response.status, "Failed to start query: %s" % body)
 
-        dic = json.loads(body)
-        self.results = QueryResults.decode_dict(dic)
+        fetched_at = time.time()
+        self.results = QueryResults.decode_body(body)
+        self.page_sequence_id = 1
+        self.metrics.submit_time = fetched_at - self.metrics.started_at
+        self.metrics.page_received(self.results, 0.0, time.time() - fetched_at, len(body), transferred)
+
+        if self.router is not None:
+            self.router.statement_started(self.options["server"])
+            self.routed = True
+            self._update_router_state()
+
+        if not self.has_next:
+            self._release_connection(True)
+
+    def _update_router_state(self):
+        stats = self.results.stats
+        queued = stats is not None and stats.state == "QUEUED"
+        if queued != self.router_queued:
+            self.router_queued = queued
+            self.router.statement_queued(self.options["server"], queued)
+
+    def _finish_routing(self):
+        if self.routed:
+            self.routed = False
+            self.router.statement_finished(self.options["server"], self.router_queued)
+
+    def _request(self, method, uri, body=None, headers={}):
+        sent = False
+        try:
+            self.http_client.request(method, uri, body, headers)
+            sent = True
+            return self.http_client.getresponse()
+        except (httplib.HTTPException, socket.error):
+            # the server may have accepted a POST before the connection was
+            # closed. retrying it could start the query twice
+            if not self.reused or (sent and method not in ("GET", "DELETE")):
+                raise
+            # a pooled keep-alive connection was closed by the server after
+            # the health check. retry once using a new connection.
+            self.http_client.close()
+            self.reused = False
+            _connect(self.http_client)
+            self.http_client.request(method, uri, body, headers)
+            return self.http_client.getresponse()
+
+    def _release_connection(self, reusable):
+        # the connection is released when the statement finishes or fails
+        self._finish_routing()
+        http_client = self.http_client
+        if http_client is None:
+            return
+        self.http_client = None
+        if reusable and self.connection_pool is not None:
+            self.connection_pool.put(http_client, self.options["server"], http_client.timeout)
+        else:
+            http_client.close()
 
     @property
     def is_query_failed(self):
@@ -225,58 +792,212 @@ class StatementClient(object):
             return False
 
         uri = self.results.next_uri
-        start = time.time()
-        attempts = 0
+        scheduler = self.scheduler
+        start = scheduler.start_fetch()
+        retry_timeout = self.options.get("retry_timeout", 2*60*60)
+        max_reconnects = self.options.get("max_reconnects", 5)
+        reconnects = 0
 
         while True:
+            headers = StatementClient.HEADERS.copy()
+            headers.update(scheduler.request_headers())
+            headers.update(StatementClient.compression_headers(self.options))
+            headers[PrestoHeaders.PRESTO_PAGE_SEQUENCE_ID] = str(self.page_sequence_id)
+            fetch_start = time.time()
             try:
-                self.http_client.request("GET", uri)
+                response = self._request("GET", uri, headers=headers)
+                body, transferred = read_body(response)
+            except (httplib.HTTPException, socket.error) as e:
+                if reconnects >= max_reconnects or self.closed or self.interrupted:
+                    self.exception = e
+                    self._release_connection(False)
+                    raise
+                # the connection was dropped. request the same page again using a
+                # new connection. Presto returns the same results for the same
+                # token, so rows are never skipped nor duplicated.
+                reconnects += 1
+                self.metrics.reconnects += 1
+                self.http_client.close()
+                self.reused = False
+                time.sleep(scheduler.backoff())
+                continue
             except Exception as e:
                 self.exception = e
+                self._release_connection(False)
                 raise
 
-            response = self.http_client.getresponse()
-            body = response.read()
-
             if response.status == 200 and body:
-                self.results = QueryResults.decode_dict(json.loads(body))
+                fetched_at = time.time()
+                scheduler.page_received(fetch_start, len(body))
+                self.results = QueryResults.decode_body(body)
+                self.page_sequence_id += 1
+                self.metrics.page_received(self.results, fetched_at - start, time.time() - fetched_at, len(body), transferred)
+                if self.routed:
+                    self._update_router_state()
+                if not self.has_next:
+                    self._release_connection(True)
                 return True
 
             if response.status != 503:  # retry on 503 Service Unavailable
                 # deterministic error
                 self.exception = PrestoHttpException(response.status, "Error fetching next at %s returned %s: %s" % (uri, response.status, body))  # TODO error class
+                self._release_connection(False)
                 raise self.exception
 
-            if (time.time() - start) > 2*60*60 or self.closed:
+            if (time.time() - start) > retry_timeout or self.closed or self.interrupted:
                 break
 
+            self.metrics.retries += 1
+
+            time.sleep(scheduler.backoff())
+
         self.exception = PrestoHttpException(408, "Error fetching next")  # TODO error class
+        self._release_connection(False)
         raise self.exception
 
     def cancel_leaf_stage(self):
-        if self.results.next_uri is not None:
-            self.http_client.request("DELETE", self.results.next_uri)
-            response = self.http_client.getresponse()
-            response.read()
-            return response.status / 100 == 2
+        if self.results.next_uri is not None and self.http_client is not None:
+            try:
+                response = self._request("DELETE", self.results.next_uri)
+                response.read()
+            except Exception:
+                self._release_connection(False)
+                raise
+            return response.status // 100 == 2
         return False
 
     def close(self):
         if self.closed:
             return
 
-        cancel_leaf_stage(self)
+        try:
+            self.cancel_leaf_stage()
+        finally:
+            self.closed = True
+            self._release_connection(True)
 
-        self.closed = True
+class PagePrefetcher(object):
+    """Fetches next pages of a StatementClient in a background thread.
+
+    At most max_pages pages and max_bytes bytes of response bodies are buffered
+    (but at least 1 page). The consumer must not touch client.results until
+    stop() returns.
+    """
+
+    def __init__(self, client, max_pages, max_bytes):
+        self.client = client
+        self.max_pages = max_pages
+        self.max_bytes = max_bytes
+
+        self.cond = threading.Condition()
+        self.pages = collections.deque()  # (results, bytes)
+        self.buffered_bytes = 0
+        self.finished = False
+        self.stopped = False
+        self.exception = None
+
+        self.thread = threading.Thread(target=self._run, name="presto-prefetch")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _is_full(self):
+        return self.pages and (len(self.pages) >= self.max_pages or self.buffered_bytes >= self.max_bytes)
+
+    def _run(self):
+        client = self.client
+        try:
+            while True:
+                with self.cond:
+                    while not self.stopped and self._is_full():
+                        self.cond.wait()
+                    if self.stopped:
+                        return
+
+                if not client.advance():
+                    return
+
+                page_bytes = client.scheduler.last_page_bytes
+                with self.cond:
+                    self.pages.append((client.results, page_bytes))
+                    self.buffered_bytes += page_bytes
+                    self.cond.notify_all()
+        except Exception as e:
+            self.exception = e
+        finally:
+            with self.cond:
+                self.finished = True
+                self.cond.notify_all()
+
+    def next_page(self):
+        """Returns the next QueryResults, or None if there are no more pages."""
+        with self.cond:
+            while not self.pages and not self.finished:
+                # wait with timeout so that KeyboardInterrupt can break it
+                self.cond.wait(1.0)
+            if self.pages:
+                results, page_bytes = self.pages.popleft()
+                self.buffered_bytes -= page_bytes
+                self.cond.notify_all()
+                return results
+            if self.exception is not None:
+                raise self.exception
+            return None
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.pages.clear()
+            self.buffered_bytes = 0
+            self.cond.notify_all()
+        self.client.interrupted = True
+        self.thread.join()
+        self.client.interrupted = False
 
 class Query(object):
     @classmethod
     def start(cls, query, **options):
-        http_client = httplib.HTTPConnection(host=options["server"], timeout=options.get("http_timeout", 300))
-        return Query(StatementClient(http_client, query, **options))
+        pool = options.pop("connection_pool", connection_pool)
+        router = options.pop("router", coordinator_router)
+        servers = parse_servers(options["server"])
+        if len(servers) == 1:
+            options["server"] = servers[0]
+            return cls._start(query, pool, None, options)
+
+        # try coordinators in the order of load and fail over to the next one
+        # if a coordinator isn't available. errors after the statement was
+        # sent are raised because the coordinator may be running it
+        error = None
+        for server in router.order(servers):
+            options["server"] = server
+            try:
+                return cls._start(query, pool, router, options)
+            except PrestoConnectionException as e:
+                router.request_failed(server)
+                error = e
+            except PrestoHttpException as e:
+                if e.status != 503:
+                    raise
+                router.request_failed(server)
+                error = e
+        if error is None:
+            raise PrestoException("no coordinator available: %s" % (", ".join(servers) or "empty server list"))
+        raise error
+
+    @classmethod
+    def _start(cls, query, pool, router, options):
+        timeout = options.get("http_timeout", 300)
+        if options.get("keep_alive", True) and pool is not None:
+            http_client, reused = pool.get(options["server"], timeout)
+        else:
+            pool = None
+            http_client, reused = httplib.HTTPConnection(host=options["server"], timeout=timeout), False
+        if not reused:
+            _connect(http_client)
+        return Query(StatementClient(http_client, query, connection_pool=pool, reused=reused, router=router, **options))
 
     def __init__(self, client):
         self.client = client
+        self.prefetcher = None
 
     def _wait_for_columns(self):
         while self.client.results.columns is None and self.client.advance():
@@ -295,6 +1016,12 @@ class Query(object):
         return self.client.results.columns
 
     def results(self):
+        for data in self.pages():
+            for row in data:
+                yield row
+
+    def pages(self):
+        """Returns an iterator of rows of each page (a PageRows or a list)."""
         self._wait_for_data()
 
         client = self.client
@@ -305,24 +1032,46 @@ class Query(object):
         if self.columns() is None:
             raise PrestoException("Query %s has no columns" % client.results.id)
 
-        while True:
-            if client.results.data is None:
-                break
+        # the prefetcher advances client.results as soon as it starts. take the
+        # current page before it
+        metrics = client.metrics
+        results = client.results
+
+        prefetch_pages = client.options.get("prefetch_pages", 0)
+        if prefetch_pages > 0 and client.has_next:
+            self.prefetcher = PagePrefetcher(client, prefetch_pages, client.options.get("prefetch_bytes", 32*1024*1024))
+            next_page = self.prefetcher.next_page
+        else:
+            next_page = self._next_page
+
+        while results is not None:
+            # long-polled pages may not include data even if the query is running
+            if results.data is not None:
+                yield results.data
+            wait_start = time.time()
+            results = next_page()
+            metrics.wait_time += time.time() - wait_start
+
+        if client.is_query_failed:
+            self._raise_error()
 
-            for row in client.results.data:
-                yield row
+    def _next_page(self):
+        if self.client.advance():
+            return self.client.results
+        return None
 
-            if not client.advance():
-                break
-
-            if client.results.data is None:
-                break
+    def _stop_prefetcher(self):
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
 
     def cancel(self):
+        self._stop_prefetcher()
         self.client.cancel_leaf_stage()
 
     def close(self):
-        self.client.cancel_leaf_stage()
+        self._stop_prefetcher()
+        self.client.close()
 
     def _raise_error(self):
         if self.client.closed:
@@ -336,6 +1085,114 @@ class Query(object):
                 raise PrestoQueryException("Query %s failed: (unknown reason)" % results.id, None, None)
             raise PrestoQueryException("Query %s failed: %s" % (results.id, error.message), results.id, error.error_code, error.failure_info)
 
+class QueryRowIterator(object):
+    """Iterator of rows of a query that closes the query when all rows are read,
+    when reading fails, or when close() is called."""
+
+    def __init__(self, query):
+        self.query = query
+        self.results = query.results()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.query is None:
+            raise StopIteration
+        try:
+            return next(self.results)
+        except:
+            self.close()
+            raise
+
+    __next__ = next
+
+    def close(self):
+        if self.query is not None:
+            self.query.close()
+            self.query = None
+            self.results = None
+
+    def __del__(self):
+        self.close()
+
+class PageSpool(object):
+    """Collects pages of rows in memory and spills them to a temporary file
+    once their total JSON size exceeds max_bytes.
+
+    Pages are kept as JSON text and decoded when rows are iterated, so memory
+    usage is bounded by max_bytes plus one page. Iterating a spool again
+    replays the rows from the beginning. If compress is True, pages in the
+    file are compressed by zlib.
+    """
+
+    def __init__(self, max_bytes, compress=False):
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.pages = []
+        self.bytes = 0
+        self.file = None
+
+    def add(self, data):
+        if isinstance(data, PageRows):
+            text = data.body[data.start:data.end]
+        else:
+            text = json.dumps(data)
+        self.bytes += len(text)
+        if self.file is None:
+            self.pages.append(text)
+            if self.bytes > self.max_bytes:
+                self._spill()
+        else:
+            self._write(text)
+
+    def _spill(self):
+        self.file = tempfile.TemporaryFile(prefix="presto-spool-")
+        for text in self.pages:
+            self._write(text)
+        self.pages = None
+
+    def _write(self, text):
+        if not isinstance(text, bytes):
+            text = text.encode("utf-8")
+        if self.compress:
+            text = zlib.compress(text, 1)
+        # length-prefixed because JSON text may include newlines
+        self.file.write(("%d\n" % len(text)).encode("ascii"))
+        self.file.write(text)
+
+    def _read_pages(self):
+        f = self.file
+        f.flush()
+        f.seek(0)
+        while True:
+            line = f.readline()
+            if not line:
+                return
+            text = f.read(int(line))
+            if self.compress:
+                text = zlib.decompress(text)
+            yield text
+
+    @property
+    def spilled(self):
+        return self.file is not None
+
+    def __iter__(self):
+        if self.file is None:
+            pages = self.pages
+        else:
+            pages = self._read_pages()
+        for text in pages:
+            for row in PageRows(text, 0, len(text)):
+                yield row
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.pages = []
+
 class Client(object):
     def __init__(self, **options):
         self.options = options
@@ -343,15 +1200,43 @@ class Client(object):
     def query(self, query):
         return Query.start(query, **self.options)
 
-    def run(self, query):
+    def run(self, query, spill_bytes=None):
+        """Runs a query and returns (columns, rows).
+
+        If spill_bytes is set, rows are returned as a PageSpool which keeps up to
+        spill_bytes of pages in memory and the rest in a temporary file.
+        """
         q = Query.start(query, **self.options)
         try:
             columns = q.columns()
             if columns is None:
                 return [], []
-            rows = []
-            map(rows.append, q.results())
-            return columns, rows
+            if spill_bytes is None:
+                return columns, list(q.results())
+            spool = PageSpool(spill_bytes)
+            try:
+                for data in q.pages():
+                    spool.add(data)
+            except:
+                spool.close()
+                raise
+            return columns, spool
         finally:
             q.close()
 
+    def stream(self, query):
+        """Runs a query and returns (columns, row iterator) without collecting rows.
+
+        The query is closed when the iterator is exhausted or closed.
+        """
+        q = Query.start(query, **self.options)
+        try:
+            columns = q.columns()
+        except:
+            q.close()
+            raise
+        if columns is None:
+            q.close()
+            return [], iter([])
+        return columns, QueryRowIterator(q)
+
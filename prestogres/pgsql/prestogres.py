@@ -1,10 +1,19 @@
 import plpy
 import presto_client
-from collections import namedtuple
+from collections import deque, namedtuple, OrderedDict
 from copy import copy
+import base64
+import errno
+import fcntl
+import gzip
+import hashlib
+import os
+import sys
+import tempfile
 import time
 import json
 import re
+import weakref
 
 # Maximum length for identifiers (e.g. table names, column names, function names)
 # defined in pg_config_manual.h
@@ -12,6 +21,92 @@ PG_NAMEDATALEN = 64
 
 JSON_TYPE_PATTERN = re.compile("^(?:row|array|map)(?![a-zA-Z])", re.IGNORECASE)
 
+# Default values of prestogres.* parameters. They can be overwritten in postgresql.conf.
+DEFAULT_SETTINGS = {
+    # number of result pages fetched from Presto in background while rows are returned
+    # to PostgreSQL. 0 disables prefetching. PL/Python holds the GIL while PostgreSQL
+    # processes returned rows, so the background thread runs only while this module
+    # waits for Presto or another page. Enable it only if that's measured to help.
+    "prestogres.prefetch_pages": "0",
+    # maximum total size of prefetched pages in bytes
+    "prestogres.prefetch_bytes": "33554432",
+    # seconds to reuse results of a query from prestogres_catalog.result_cache.
+    # 0 disables the result cache.
+    "prestogres.result_cache_ttl": "0",
+    # maximum total size of cached results in bytes. least recently used entries are evicted.
+    "prestogres.result_cache_max_bytes": "268435456",
+    # results larger than this size in bytes are not cached
+    "prestogres.result_cache_max_entry_bytes": "16777216",
+    # number of schemas of which table definitions are fetched by a Presto query at
+    # setup_system_catalog
+    "prestogres.catalog_fetch_batch_size": "100",
+    # queries which take longer than this in milliseconds are logged with their latency
+    # breakdown. -1 disables logging.
+    "prestogres.slow_query_log_min_duration": "-1",
+    # Content-Encoding requested for result pages: gzip, deflate or none. comma-separated
+    # server=encoding entries set it per coordinator, e.g. "none,presto-remote:8080=gzip".
+    "prestogres.compression": "none",
+    # maximum number of Presto queries running at once across all backends. 0 means unlimited.
+    "prestogres.max_running_queries": "0",
+    # maximum number of Presto queries running at once per Presto user. 0 means unlimited.
+    "prestogres.max_running_queries_per_user": "0",
+    # comma-separated client sources (application_name) of the priority lane
+    "prestogres.priority_sources": "",
+    # slots of max_running_queries only the priority lane can use
+    "prestogres.priority_reserved_queries": "0",
+    # milliseconds to wait for a slot before the query is rejected
+    "prestogres.admission_timeout": "60000",
+    # directory of the files locked by running queries. relative to the data directory
+    "prestogres.admission_dir": "prestogres_admission",
+    # "full" creates tables of all schemas at login. "lazy" creates tables of schemas on
+    # search_path only and other schemas without tables. Their tables are created when a
+    # query references the schema, psql's \d reads pg_class or prestogres_catalog.load_schema
+    # is called.
+    "prestogres.catalog_mode": "full",
+    # seconds to reuse schemas and columns of a Presto catalog saved in
+    # prestogres.catalog_snapshot_dir by any backend. 0 disables snapshots.
+    "prestogres.catalog_snapshot_ttl": "0",
+    # directory of catalog snapshots. relative to the data directory
+    "prestogres.catalog_snapshot_dir": "prestogres_catalog",
+    # maximum size of results in bytes read from Presto into a temporary file before
+    # rows are returned, so that the query finishes on Presto even if the client reads
+    # rows slowly. remaining pages are read as rows are returned. 0 disables spooling.
+    "prestogres.spool_max_bytes": "0",
+    # file to append statements given to start_presto_query with their settings, result
+    # shapes and timings as JSON lines. bench/replay.py replays them. empty disables it.
+    "prestogres.capture_file": "",
+    # number of query fingerprints of which compatibility rewrites are cached per backend.
+    # 0 disables the cache.
+    "prestogres.rewrite_cache_size": "1000",
+    # "on" lets backends running the same query at the same time share one Presto query.
+    # the first backend runs it and writes its rows to a file in prestogres.coalesce_dir,
+    # and the others read rows from the file. queries are the same if they'd share an
+    # entry of the result cache.
+    "prestogres.coalesce_queries": "off",
+    # directory of the files of coalesced queries. relative to the data directory
+    "prestogres.coalesce_dir": "prestogres_coalesce",
+    # milliseconds a backend keeps reading rows of a coalesced query for the others
+    # after its client stopped reading them. the others fail after this.
+    "prestogres.coalesce_drain_timeout": "5000",
+}
+
+# PostgreSQL result types of which values never include \0 characters
+NON_STRING_RESULT_TYPES = set([
+    "bigint", "integer", "smallint", "double precision", "real", "boolean",
+    "date", "time", "time with time zone", "timestamp", "timestamp with time zone",
+    "interval year to month", "interval day to second"])
+
+# statements of which results can be cached
+CACHEABLE_QUERY_PATTERN = re.compile("^(?:select|with|show|describe)(?![a-z0-9_])")
+
+# escape strings (E'...'), standard strings and dollar-quoted strings ($tag$...$tag$)
+STRING_LITERAL = r"""(?<![\w$])[eE]'(?:[^'\\]|\\.|'')*'|'(?:[^']|'')*'|(?<![\w$])\$(?P<tag>(?:[a-zA-Z_][a-zA-Z0-9_]*)?)\$.*?\$(?P=tag)\$"""
+QUOTED_PATTERN = re.compile(STRING_LITERAL + r'|"(?:[^"]|"")*"', re.DOTALL)
+STRING_LITERAL_PATTERN = re.compile(STRING_LITERAL, re.DOTALL)
+# identifier followed by "." and another identifier
+QUALIFIER_PATTERN = re.compile(r'("(?:[^"]|"")*"|[a-zA-Z_][a-zA-Z0-9_$]*)(?=\s*\.\s*["a-zA-Z_])')
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
 # See the document about system column names: http://www.postgresql.org/docs/9.3/static/ddl-system-columns.html
 SYSTEM_COLUMN_NAMES = set(["oid", "tableoid", "xmin", "cmin", "xmax", "cmax", "ctid"])
 
@@ -67,8 +162,9 @@ def _rename_duplicated_column_names(column_names, where):
     return renamed
 
 # build CREATE TEMPORARY TABLE statement
-def _build_create_temp_table_sql(table_name, column_names, column_types):
-    create_sql = ["create temporary table %s (\n  " % plpy.quote_ident(table_name)]
+def _build_create_temp_table_sql(table_name, column_names, column_types, if_not_exists=False):
+    create_sql = ["create temporary table %s%s (\n  " % \
+            ("if not exists " if if_not_exists else "", plpy.quote_ident(table_name))]
 
     first = True
     for column_name, column_type in zip(column_names, column_types):
@@ -103,15 +199,353 @@ def _build_create_table(schema_name, table_name, column_names, column_types, not
     alter_sql.append("\n)")
     return ''.join(alter_sql)
 
-def _get_session_time_zone():
-    rows = plpy.execute("show timezone")
-    return rows[0].values()[0]
+_settings = None
+
+# prestogres.* parameters are read from pg_settings once per backend process
+def _get_setting(name):
+    global _settings
+    if _settings is None:
+        settings = DEFAULT_SETTINGS.copy()
+        for row in plpy.execute("select name, setting from pg_catalog.pg_settings where name like 'prestogres.%'"):
+            settings[row["name"]] = row["setting"]
+        _settings = settings
+    return _settings[name]
+
+def _get_compression(presto_server):
+    default = None
+    compressions = {}
+    for entry in _get_setting("prestogres.compression").split(","):
+        server, sep, encoding = entry.rpartition("=")
+        if not sep:
+            if default is None:
+                default = encoding.strip()
+        else:
+            compressions[server.strip()] = encoding.strip()
+
+    # presto_server can be a list of coordinators
+    servers = presto_client.parse_servers(presto_server)
+    compressions = dict([(server, compressions.get(server, default)) for server in servers])
+    for server, compression in compressions.items():
+        if compression == "none" or not compression:
+            compressions[server] = None
+    if len(servers) == 1:
+        return compressions[servers[0]]
+    return compressions
+
+def _new_client(presto_server, presto_user, presto_catalog, presto_schema, time_zone, source=None):
+    return presto_client.Client(server=presto_server, user=presto_user, source=source,
+            catalog=presto_catalog, schema=presto_schema, time_zone=time_zone,
+            prefetch_pages=int(_get_setting("prestogres.prefetch_pages")),
+            prefetch_bytes=int(_get_setting("prestogres.prefetch_bytes")),
+            compression=_get_compression(presto_server))
 
 def _get_session_search_path_array():
     rows = plpy.execute("select ('{' || current_setting('search_path') || '}')::text[]")
     return rows[0].values()[0]
 
-NULL_PATTERN = dict({'\0':None})
+# get time zone, search_path, application_name and the name of result type of the
+# fetch function (None if the function doesn't exist) in one round trip. settings are
+# read for every query so that SET commands take effect without invalidation.
+def _get_session_state(function_name):
+    plan = _get_plan(
+        "select pg_catalog.current_setting('TimeZone') as time_zone,"
+        " ('{' || pg_catalog.current_setting('search_path') || '}')::text[] as search_path,"
+        " pg_catalog.current_setting('application_name') as application_name,"
+        " (select t.typname from pg_catalog.pg_proc p"
+        "  join pg_catalog.pg_type t on t.oid = p.prorettype"
+        "  where p.proname = $1 and p.pronargs = 0"
+        "  and p.pronamespace = pg_catalog.pg_my_temp_schema()) as result_type,"
+        " (select p.prosecdef from pg_catalog.pg_proc p"
+        "  where p.proname = $1 and p.pronargs = 0"
+        "  and p.pronamespace = pg_catalog.pg_my_temp_schema()) as security_definer", ["text"])
+    return plpy.execute(plan, [function_name])[0]
+
+# name of the temporary table used as the result type of the fetch function.
+# the same result shape uses the same name so that the function can be reused.
+def _result_type_name(function_name, column_names, column_types):
+    signature = "\0".join(column_names) + "\0\0" + "\0".join(column_types)
+    return "%s_%s" % (function_name, hashlib.sha1(signature.encode("utf-8")).hexdigest()[:16])
+
+_plans = {}
+
+# plpy.prepare saves plans for the life of the backend process
+def _get_plan(sql, types):
+    plan = _plans.get(sql)
+    if plan is None:
+        plan = _plans[sql] = plpy.prepare(sql, types)
+    return plan
+
+# collapse whitespace and case of a query excepting string literals and quoted identifiers
+def _normalize_query(query):
+    parts = []
+    pos = 0
+    for m in QUOTED_PATTERN.finditer(query):
+        parts.append(WHITESPACE_PATTERN.sub(" ", query[pos:m.start()]).lower())
+        parts.append(m.group(0))
+        pos = m.end()
+    parts.append(WHITESPACE_PATTERN.sub(" ", query[pos:]).lower())
+    return "".join(parts).strip().rstrip(";").rstrip()
+
+# returns None if results of the query should not be cached
+def _result_cache_key(presto_server, presto_user, presto_catalog, presto_schema, time_zone, query):
+    normalized = _normalize_query(query)
+    if not CACHEABLE_QUERY_PATTERN.match(normalized):
+        return None
+    key = "\0".join([presto_server, presto_user, presto_catalog, presto_schema, time_zone, normalized])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+# first key of pg_try_advisory_xact_lock(int, int) locks taken to update hits of a
+# cache entry. the row lock is held until the end of the transaction, which waits
+# for Presto, so a backend skips the update instead of waiting for another one.
+RESULT_CACHE_HIT_LOCK_CLASS = 0x50750000
+
+def _lookup_result_cache(cache_key):
+    plan = _get_plan(
+        "select column_names, column_types, rows from prestogres_catalog.result_cache"
+        " where cache_key = $1 and created_at > now() - $2 * interval '1 second'", ["text", "integer"])
+    rows = plpy.execute(plan, [cache_key, int(_get_setting("prestogres.result_cache_ttl"))])
+    if len(rows) == 0:
+        _increment_result_cache_counter("misses")
+        return None
+    _increment_result_cache_counter("hits")
+
+    # last_hit_at orders eviction. hits is approximate
+    plan = _get_plan(
+        "update prestogres_catalog.result_cache set hits = hits + 1, last_hit_at = now()"
+        " where cache_key = $1 and pg_catalog.pg_try_advisory_xact_lock($2, pg_catalog.hashtext($1))",
+        ["text", "integer"])
+    plpy.execute(plan, [cache_key, RESULT_CACHE_HIT_LOCK_CLASS])
+    return rows[0]
+
+def _store_result_cache(cache_key, query, column_names, column_types, rows, size):
+    plan = _get_plan(
+        "delete from prestogres_catalog.result_cache"
+        " where cache_key = $1 or created_at <= now() - $2 * interval '1 second'", ["text", "integer"])
+    plpy.execute(plan, [cache_key, int(_get_setting("prestogres.result_cache_ttl"))])
+
+    plan = _get_plan(
+        "insert into prestogres_catalog.result_cache"
+        " (cache_key, query, column_names, column_types, rows, bytes)"
+        " values ($1, $2, $3, $4, $5, $6)", ["text", "text", "text[]", "text[]", "text", "bigint"])
+    try:
+        plpy.execute(plan, [cache_key, query, column_names, column_types, rows, size])
+    except plpy.SPIError:
+        # another backend stored the same query concurrently
+        return
+
+    # evict least recently used entries
+    plan = _get_plan(
+        "with evicted as ("
+        " delete from prestogres_catalog.result_cache where cache_key in ("
+        "  select cache_key from ("
+        "   select cache_key, sum(bytes) over (order by last_hit_at desc, created_at desc) as total"
+        "   from prestogres_catalog.result_cache) s"
+        "  where total > $1)"
+        " returning 1"
+        ")"
+        " select count(pg_catalog.nextval('prestogres_catalog.result_cache_evictions')) as evictions"
+        " from evicted", ["bigint"])
+    plpy.execute(plan, [int(_get_setting("prestogres.result_cache_max_bytes"))])
+    _increment_result_cache_counter("stores")
+
+# hits, misses, stores and evictions are sequences so that all backends count them
+# without locking a shared row. nextval isn't rolled back with the transaction.
+def _increment_result_cache_counter(name):
+    plan = _get_plan("select pg_catalog.nextval('prestogres_catalog.result_cache_%s')" % name, [])
+    plpy.execute(plan)
+
+# entries of the shared result cache, and hits, misses, stores and evictions of all backends
+def get_result_cache_stats():
+    counters = ["(select case when is_called then last_value else 0 end"
+                " from prestogres_catalog.result_cache_%s) as %s" % (name, name)
+                for name in ["hits", "misses", "stores", "evictions"]]
+    plan = _get_plan(
+        "select count(*) as entries, coalesce(sum(bytes), 0)::bigint as bytes, %s"
+        " from prestogres_catalog.result_cache" % ", ".join(counters), [])
+    return plpy.execute(plan)[0]
+
+# X-Presto-Source of queries of clients which don't set application_name
+DEFAULT_SOURCE = "prestogres"
+
+# running queries hold flock(2) locks on files in prestogres.admission_dir:
+# global.<slot> for global slots and user.<hash of user>.<slot> for per-user
+# slots. closing the file releases a slot without SPI, so a query abandoned by
+# PostgreSQL releases it in the finalizer, and the lock doesn't outlive the
+# backend. unlike advisory locks, a backend holding a slot can't lock it again
+# for another open query. backends waiting for a slot hold the advisory lock
+# (ADMISSION_QUEUE_LOCK_CLASS + lane, pid) so that
+# prestogres_catalog.admission_stats() can count them in pg_locks.
+ADMISSION_QUEUE_LOCK_CLASS = 0x50720010
+ADMISSION_LANES = ["default", "priority"]
+
+# polling interval to wait for a slot in seconds
+ADMISSION_MIN_POLL_INTERVAL = 0.01
+ADMISSION_MAX_POLL_INTERVAL = 0.2
+
+class PrestoAdmissionException(presto_client.PrestoException):
+    def __init__(self, message, admission):
+        presto_client.PrestoException.__init__(self, message)
+        self.admission = admission  # AdmissionSlot without locks
+
+class AdmissionSlot(object):
+    """Slot files locked by a backend while its Presto query runs. They are
+    released by release() or when the backend exits."""
+
+    def __init__(self, source, lane, locks, wait_time):
+        self.source = source
+        self.lane = lane
+        self.locks = locks  # file descriptors
+        self.wait_time = wait_time
+
+    def release(self):
+        locks = self.locks
+        self.locks = []
+        for fd in locks:
+            os.close(fd)
+
+def _get_admission_dir():
+    directory = _get_setting("prestogres.admission_dir")
+    try:
+        os.makedirs(directory, 0700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return directory
+
+# returns a file descriptor of the locked slot file, or None if another query holds it
+def _try_lock_slot(path):
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        os.close(fd)
+        if e.errno not in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+            raise
+        return None
+    except:
+        os.close(fd)
+        raise
+    return fd
+
+def _try_lock_global_slot(directory, first, last):
+    for slot in xrange(first, last + 1):
+        fd = _try_lock_slot(os.path.join(directory, "global.%d" % slot))
+        if fd is not None:
+            return fd
+    return None
+
+def _try_lock_user_slot(directory, presto_user, limit):
+    if isinstance(presto_user, unicode):
+        presto_user = presto_user.encode("utf-8")
+    user_hash = hashlib.sha1(presto_user).hexdigest()[:16]
+    for slot in xrange(limit):
+        fd = _try_lock_slot(os.path.join(directory, "user.%s.%d" % (user_hash, slot)))
+        if fd is not None:
+            return fd
+    return None
+
+# number of slot files locked by running queries of which names start with prefix
+def _count_locked_slots(directory, prefix):
+    count = 0
+    for name in os.listdir(directory):
+        if not name.startswith(prefix):
+            continue
+        try:
+            fd = os.open(os.path.join(directory, name), os.O_RDONLY)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            continue
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+                raise
+            count += 1
+        finally:
+            os.close(fd)
+    return count
+
+# waits for a slot to run a Presto query. Returns an AdmissionSlot or None if
+# admission control is disabled. Waiting backends poll slots, so a slot is not
+# necessarily given to the backend waiting longest.
+def _admit_query(presto_user, source):
+    max_running = int(_get_setting("prestogres.max_running_queries"))
+    max_per_user = int(_get_setting("prestogres.max_running_queries_per_user"))
+    if max_running <= 0 and max_per_user <= 0:
+        return None
+
+    priority_sources = [s.strip() for s in _get_setting("prestogres.priority_sources").split(",")]
+    lane = 1 if source in priority_sources else 0
+    if lane == 0 and max_running > 0:
+        # the default lane can't use reserved slots but keeps at least one slot
+        first_slot = max(min(int(_get_setting("prestogres.priority_reserved_queries")), max_running - 1), 0)
+    else:
+        first_slot = 0
+
+    directory = _get_admission_dir()
+    started_at = time.time()
+    deadline = started_at + int(_get_setting("prestogres.admission_timeout")) / 1000.0
+    poll_interval = ADMISSION_MIN_POLL_INTERVAL
+    queued = False
+    try:
+        while True:
+            slot = AdmissionSlot(source, ADMISSION_LANES[lane], [], None)
+            try:
+                user_lock = None
+                if max_per_user > 0:
+                    user_lock = _try_lock_user_slot(directory, presto_user, max_per_user)
+                    if user_lock is not None:
+                        slot.locks.append(user_lock)
+                if max_per_user <= 0 or user_lock is not None:
+                    if max_running > 0:
+                        global_lock = _try_lock_global_slot(directory, first_slot, max_running - 1)
+                        if global_lock is not None:
+                            slot.locks.append(global_lock)
+                        else:
+                            # don't hold the per-user slot while waiting for a global slot
+                            slot.release()
+                    if slot.locks:
+                        slot.wait_time = time.time() - started_at
+                        return slot
+            except:
+                slot.release()
+                raise
+
+            now = time.time()
+            if now >= deadline:
+                raise PrestoAdmissionException(
+                        "Too many Presto queries are running. Query was rejected after waiting %.0f ms for a slot"
+                        " (prestogres.max_running_queries = %d, prestogres.max_running_queries_per_user = %d)" % \
+                        ((now - started_at) * 1000, max_running, max_per_user),
+                        AdmissionSlot(source, ADMISSION_LANES[lane], [], now - started_at))
+            if not queued:
+                plpy.execute(_get_plan("select pg_catalog.pg_advisory_lock($1, pg_catalog.pg_backend_pid())",
+                    ["integer"]), [ADMISSION_QUEUE_LOCK_CLASS + lane])
+                queued = True
+            # pg_sleep can be interrupted by statement_timeout or cancel requests
+            plpy.execute(_get_plan("select pg_catalog.pg_sleep($1)", ["double precision"]),
+                    [min(poll_interval, deadline - now)])
+            poll_interval = min(poll_interval * 2, ADMISSION_MAX_POLL_INTERVAL)
+    finally:
+        if queued:
+            plpy.execute(_get_plan("select pg_catalog.pg_advisory_unlock($1, pg_catalog.pg_backend_pid())",
+                ["integer"]), [ADMISSION_QUEUE_LOCK_CLASS + lane])
+
+# running queries and queued queries per lane across backends
+def get_admission_stats():
+    plan = _get_plan(
+        "select count(case when classid = $1::oid then 1 end) as queued,"
+        " count(case when classid = ($1 + 1)::oid then 1 end) as priority_queued"
+        " from pg_catalog.pg_locks where locktype = 'advisory' and objsubid = 2 and granted",
+        ["integer"])
+    stats = plpy.execute(plan, [ADMISSION_QUEUE_LOCK_CLASS])[0]
+    # every admitted query holds a global slot if the global limit is set
+    prefix = "global." if int(_get_setting("prestogres.max_running_queries")) > 0 else "user."
+    stats["running"] = _count_locked_slots(_get_admission_dir(), prefix)
+    return stats
+
+NULL_PATTERN = {0: None}  # unicode.translate takes ordinals
 
 def remove_null(bs):
     if isinstance(bs, str):
@@ -122,98 +556,869 @@ def remove_null(bs):
         return bs
 
 class QueryAutoClose(object):
-    def __init__(self, query):
+    def __init__(self, query, query_text, started_at, admission=None, session_info=None):
         self.query = query
+        self.query_text = query_text
+        self.started_at = started_at
+        self.admission = admission
+        self.session_info = session_info  # dict of server, user, catalog, schema, time_zone and source
         self.column_names = None
         self.column_types = None
+        self.presto_columns = None  # [(name, Presto type)]
+        self.result_cache_writer = None
+        self.rows = 0
+        self.time_to_first_row = None
+        self.saved_splits = None
+        self.saved_cpu_millis = None
+        self.spool = None
+        self.coalesce = None  # CoalescedSpoolWriter if other backends read rows of the query
+        self.closed = False
+        session.open_queries.add(self)
+
+    def close(self, state, error=None):
+        """Closes the query, cancelling it on Presto if it's still running, and
+        records its stats. state is the state recorded if the query has ended.
+        error is the exception which failed the query."""
+        if self.closed:
+            return
+        self.closed = True
+        session.open_queries.discard(self)
+
+        if self.coalesce is not None:
+            self.coalesce.end(state, error, self.query)
+
+        client = getattr(self.query, "client", None)
+        if client is not None and client.is_query_succeeded and client.has_next:
+            state = "CANCELLED"
+            stats = client.results.stats
+            if stats is not None and stats.total_splits is not None and stats.completed_splits is not None:
+                # splits which won't run. CPU time of them is estimated from completed splits
+                self.saved_splits = max(stats.total_splits - stats.completed_splits, 0)
+                if stats.completed_splits > 0 and stats.cpu_time_millis is not None:
+                    self.saved_cpu_millis = stats.cpu_time_millis * self.saved_splits // stats.completed_splits
+
+        try:
+            if self.query is not None:
+                self.query.close()
+        except Exception as e:
+            # the query is abandoned anyway. don't fail the caller
+            plpy.log("prestogres: failed to cancel query %s: %s" % (client.results.id if client else None, e))
+        finally:
+            if self.spool is not None:
+                self.spool.close()
+            if self.admission is not None:
+                self.admission.release()
+            _record_query_stats(self, state)
 
     def __del__(self):
-        self.query.close()
+        # the iterator is dropped before all rows are read (e.g. LIMIT or errors)
+        self.close("CLOSED")
+
+class CachedQuery(object):
+    """Query-compatible object that returns rows stored in the result cache."""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def results(self):
+        return iter(json.loads(self.rows))
+
+    def close(self):
+        pass
+
+# maximum number of finished queries kept for prestogres_catalog.query_stats() per session
+MAX_QUERY_HISTORY = 100
+
+def _millis(seconds):
+    if seconds is None:
+        return None
+    return round(seconds * 1000.0, 3)
+
+def _record_query_stats(query_auto_close, state):
+    finished_at = time.time()
+    query = query_auto_close.query
+    total_time = finished_at - query_auto_close.started_at
+
+    entry = {
+        "query_id": None,
+        "started_at": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(query_auto_close.started_at)) +
+            (".%06d+00" % int((query_auto_close.started_at % 1) * 1000000)),
+        "query": query_auto_close.query_text,
+        "state": state,
+        "cached": isinstance(query, CachedQuery),
+        "coalesced": isinstance(query, CoalescedQuery),
+        "source": None,
+        "lane": None,
+        "admission_wait_ms": None,
+        "total_ms": _millis(total_time),
+        "time_to_first_row_ms": _millis(query_auto_close.time_to_first_row),
+        "rows": query_auto_close.rows,
+        "submit_ms": None,
+        "time_to_first_page_ms": None,
+        "time_to_columns_ms": None,
+        "time_to_first_data_ms": None,
+        "pages": None,
+        "bytes": None,
+        "transferred_bytes": None,
+        "fetch_ms": None,
+        "decode_ms": None,
+        "wait_ms": None,
+        "retries": None,
+        "reconnects": None,
+        "spooled_bytes": query_auto_close.spool.bytes if query_auto_close.spool is not None else None,
+        "saved_splits": query_auto_close.saved_splits,
+        "saved_cpu_ms": query_auto_close.saved_cpu_millis,
+        "presto_state": None,
+        "presto_cpu_ms": None,
+        "presto_wall_ms": None,
+        "presto_processed_rows": None,
+        "presto_processed_bytes": None,
+    }
+
+    admission = query_auto_close.admission
+    if admission is not None:
+        entry["source"] = admission.source
+        entry["lane"] = admission.lane
+        entry["admission_wait_ms"] = _millis(admission.wait_time)
+
+    if isinstance(query, CoalescedQuery):
+        entry["query_id"] = query.query_id
+
+    client = getattr(query, "client", None)
+    if client is not None:
+        metrics = client.metrics
+        entry["submit_ms"] = _millis(metrics.submit_time)
+        entry["time_to_first_page_ms"] = _millis(metrics.time_to_first_page)
+        entry["time_to_columns_ms"] = _millis(metrics.time_to_columns)
+        entry["time_to_first_data_ms"] = _millis(metrics.time_to_first_data)
+        entry["pages"] = metrics.pages
+        entry["bytes"] = metrics.bytes
+        entry["transferred_bytes"] = metrics.transferred_bytes
+        entry["fetch_ms"] = _millis(metrics.fetch_time)
+        entry["decode_ms"] = _millis(metrics.decode_time)
+        entry["wait_ms"] = _millis(metrics.wait_time)
+        entry["retries"] = metrics.retries
+        entry["reconnects"] = metrics.reconnects
+        if client.results is not None:
+            entry["query_id"] = client.results.id
+            stats = client.results.stats
+            if stats is not None:
+                entry["presto_state"] = stats.state
+                entry["presto_cpu_ms"] = stats.cpu_time_millis
+                entry["presto_wall_ms"] = stats.wall_time_millis
+                entry["presto_processed_rows"] = stats.processed_rows
+                entry["presto_processed_bytes"] = stats.processed_bytes
+
+    session.query_history.append(entry)
+
+    capture_file = _get_setting("prestogres.capture_file")
+    if capture_file:
+        _capture_query(capture_file, query_auto_close, entry)
+
+    min_duration = int(_get_setting("prestogres.slow_query_log_min_duration"))
+    if min_duration >= 0 and total_time * 1000.0 >= min_duration:
+        plpy.log("prestogres: duration: %.3f ms  query id: %s  state: %s  rows: %d  pages: %s  bytes: %s  "
+                "admission wait: %s ms  submit: %s ms  first page: %s ms  columns: %s ms  first data: %s ms  first row: %s ms  "
+                "fetch: %s ms  decode: %s ms  wait: %s ms  retries: %s  saved splits: %s  query: %s" % \
+                (entry["total_ms"], entry["query_id"], state, entry["rows"], entry["pages"], entry["bytes"],
+                    entry["admission_wait_ms"], entry["submit_ms"], entry["time_to_first_page_ms"], entry["time_to_columns_ms"],
+                    entry["time_to_first_data_ms"], entry["time_to_first_row_ms"],
+                    entry["fetch_ms"], entry["decode_ms"], entry["wait_ms"], entry["retries"],
+                    entry["saved_splits"], entry["query"]))
+
+# fields of query_stats() entries written to the capture file
+CAPTURED_STATS = [
+    "query_id", "state", "cached", "admission_wait_ms", "total_ms", "time_to_first_row_ms", "rows",
+    "submit_ms", "time_to_first_page_ms", "time_to_columns_ms", "time_to_first_data_ms",
+    "pages", "bytes", "transferred_bytes", "fetch_ms", "decode_ms", "wait_ms", "retries"]
+
+def _capture_query(capture_file, query_auto_close, entry):
+    record = OrderedDict()
+    record["ts"] = query_auto_close.started_at
+    record["pid"] = os.getpid()
+    if query_auto_close.session_info is not None:
+        record.update(query_auto_close.session_info)
+    record["query"] = query_auto_close.query_text
+    record["columns"] = query_auto_close.presto_columns
+    for name in CAPTURED_STATS:
+        record[name] = entry[name]
+    line = json.dumps(record, separators=(",", ":")) + "\n"
+    try:
+        # O_APPEND and a single write keep lines of concurrent backends intact
+        fd = os.open(capture_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    except (IOError, OSError) as e:
+        plpy.log("prestogres: failed to write to %s: %s" % (capture_file, e))
+
+def get_query_stats():
+    return list(session.query_history)
+
+# closes queries of this session. called when pgpool resets the backend
+# connection (reset_query_list) so that the next client of the pooled
+# connection doesn't leave them running nor see their stats.
+def reset_session():
+    query_auto_close = session.query_auto_close
+    session.query_auto_close = None
+    if query_auto_close is not None:
+        query_auto_close.close("CANCELLED")
+    for query_auto_close in list(session.open_queries):
+        query_auto_close.close("CANCELLED")
+    session.query_history.clear()
+    session.presto_connection = None
+
+class ResultCacheWriter(object):
+    def __init__(self, cache_key, query, column_names, column_types, max_bytes):
+        self.cache_key = cache_key
+        self.query = query
+        self.column_names = column_names
+        self.column_types = column_types
+        self.max_bytes = max_bytes
+        self.encoded_rows = []
+        self.size = 2
+
+    def add(self, row):
+        if self.encoded_rows is None:
+            return
+        encoded = json.dumps(row)
+        self.size += len(encoded) + 1
+        if self.size > self.max_bytes:
+            # too large to cache
+            self.encoded_rows = None
+        else:
+            self.encoded_rows.append(encoded)
+
+    def store(self):
+        if self.encoded_rows is None:
+            return
+        rows = "[" + ",".join(self.encoded_rows) + "]"
+        self.encoded_rows = None
+        _store_result_cache(self.cache_key, self.query, self.column_names, self.column_types, rows, len(rows))
+
+# pages kept in memory by a spool before they're written to the temporary file
+SPOOL_MEMORY_BYTES = 4*1024*1024
+
+# reads pages of the query into a spool until max_bytes, and returns rows of the
+# spool followed by rows of the remaining pages. Presto releases resources of the
+# query as soon as all pages are read, while PostgreSQL may read rows slowly (e.g.
+# FETCH of a cursor). pages are read when the first row is requested.
+def _spooled_results(query_auto_close, max_bytes):
+    spool = query_auto_close.spool = presto_client.PageSpool(SPOOL_MEMORY_BYTES, compress=True)
+    pages = query_auto_close.query.pages()
+    for data in pages:
+        spool.add(data)
+        if spool.bytes >= max_bytes:
+            break
+    for row in spool:
+        yield row
+    for data in pages:
+        for row in data:
+            yield row
+
+# stores raw rows of the query to the result cache when all rows are read
+def _result_cache_filling_iterator(results, writer):
+    for row in results:
+        writer.add(row)
+        yield row
+    writer.store()
+
+# rows of a coalesced query written to its shared spool at once
+COALESCE_BATCH_ROWS = 1000
+# seconds after which buffered rows are written even if the batch isn't full
+COALESCE_BATCH_INTERVAL = 0.05
+# polling interval of followers waiting for rows in seconds
+COALESCE_MIN_POLL_INTERVAL = 0.005
+COALESCE_MAX_POLL_INTERVAL = 0.05
+# byte of a shared spool on which followers hold fcntl(2) read locks. they're
+# independent of the flock(2) lock of the leader
+COALESCE_FOLLOWER_LOCK_OFFSET = 1 << 40
+
+class CoalescedSpoolWriter(object):
+    """Shared spool of a Presto query run by this backend (the leader) for other
+    backends running the same query at the same time (followers).
+
+    The spool is a file of JSON lines: a header with the query id and columns,
+    arrays of rows and the end with the final state. The leader holds flock(2)
+    on it until the end is written and unlinks it at the end, so that backends
+    starting the query later run it again.
+    """
+
+    def __init__(self, path, fd):
+        self.path = path
+        self.fd = fd
+        self.batch = []  # JSON-encoded rows not written yet
+        self.flushed_at = time.time()
+        self.source = None  # rows of the query given to rows()
+        self.ended = False
+
+    def _write(self, data):
+        while data:
+            data = data[os.write(self.fd, data):]
+
+    def start(self, query_id, columns):
+        self._write(json.dumps({"query_id": query_id, "columns": columns}) + "\n")
+
+    def _add(self, row):
+        # rows are encoded before they're converted for PostgreSQL
+        self.batch.append(json.dumps(row))
+        if len(self.batch) >= COALESCE_BATCH_ROWS or time.time() - self.flushed_at >= COALESCE_BATCH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self._write("[" + ",".join(self.batch) + "]\n")
+            self.batch = []
+        self.flushed_at = time.time()
+
+    def rows(self, results):
+        """Returns rows of results, writing them to the spool."""
+        self.source = results
+        for row in results:
+            self._add(row)
+            yield row
+        self.flush()
+
+    def has_followers(self):
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, COALESCE_FOLLOWER_LOCK_OFFSET)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return True
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, COALESCE_FOLLOWER_LOCK_OFFSET)
+        return False
+
+    def end(self, state, error, query):
+        """Writes the end and releases the spool. If the leader stops reading
+        rows while followers are reading the spool, remaining rows are read
+        from Presto for up to prestogres.coalesce_drain_timeout. Followers
+        fail if rows remain after that."""
+        if self.ended:
+            return
+        self.ended = True
+        try:
+            end = {"state": state}
+            if state in ("CLOSED", "CANCELLED") and query is not None and self.has_followers():
+                deadline = time.time() + int(_get_setting("prestogres.coalesce_drain_timeout")) / 1000.0
+                try:
+                    for row in (self.source if self.source is not None else query.results()):
+                        if time.time() >= deadline:
+                            error = presto_client.PrestoException(
+                                    "Query %s was cancelled because the backend running it stopped reading rows" % \
+                                    query.client.results.id)
+                            break
+                        self._add(row)
+                    else:
+                        self.flush()
+                        end["state"] = "FINISHED"
+                except presto_client.PrestoException as e:
+                    end["state"] = "FAILED"
+                    error = e
+            if error is not None:
+                end["error"] = error.args[0] if error.args else None
+                end["query_id"] = getattr(error, "query_id", None)
+                end["error_code"] = getattr(error, "error_code", None)
+            self._write(json.dumps(end) + "\n")
+        except (IOError, OSError) as e:
+            plpy.log("prestogres: failed to write to %s: %s" % (self.path, e))
+        finally:
+            os.unlink(self.path)
+            os.close(self.fd)
+
+class CoalescedQuery(object):
+    """Query-compatible object that returns rows of a query run by another
+    backend, read from its shared spool."""
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.buffer = ""
+        self.pos = 0
+        self.query_id = None
+        self.presto_columns = None
+
+    def _leader_running(self):
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return True
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return False
+
+    def _next_record(self):
+        """Returns the next line of the spool, waiting for the leader to write
+        it. Returns None if the leader exited without writing the end."""
+        poll_interval = COALESCE_MIN_POLL_INTERVAL
+        while True:
+            line_end = self.buffer.find("\n", self.pos)
+            if line_end >= 0:
+                line = self.buffer[self.pos:line_end]
+                self.pos = line_end + 1
+                return json.loads(line)
+            # check the leader before reading so that rows written before it ended aren't missed
+            running = self._leader_running()
+            data = os.read(self.fd, 1024*1024)
+            if data:
+                self.buffer = self.buffer[self.pos:] + data
+                self.pos = 0
+                poll_interval = COALESCE_MIN_POLL_INTERVAL
+                continue
+            if not running:
+                return None
+            # pg_sleep can be interrupted by statement_timeout or cancel requests
+            plpy.execute(_get_plan("select pg_catalog.pg_sleep($1)", ["double precision"]), [poll_interval])
+            poll_interval = min(poll_interval * 2, COALESCE_MAX_POLL_INTERVAL)
+
+    def _error(self, end):
+        if end is None:
+            return presto_client.PrestoException(
+                    "Backend running query %s exited before the query finished" % self.query_id)
+        if end.get("error") is not None:
+            if end["query_id"] is not None:
+                return presto_client.PrestoQueryException(end["error"], end["query_id"], end["error_code"], None)
+            return presto_client.PrestoException(end["error"])
+        return presto_client.PrestoException(
+                "Query %s was %s by the backend running it" % (self.query_id, end["state"].lower()))
+
+    def read_header(self):
+        """Waits for columns of the query. Returns False if the leader ended the
+        query without returning columns nor errors (e.g. it was rejected by
+        admission control)."""
+        record = self._next_record()
+        if isinstance(record, dict) and "columns" in record:
+            self.query_id = record["query_id"]
+            self.presto_columns = record["columns"]
+            return True
+        if record is not None and record.get("error") is not None:
+            raise self._error(record)
+        return False
+
+    def columns(self):
+        return [presto_client.Column(name, type) for name, type in self.presto_columns]
+
+    def results(self):
+        while True:
+            record = self._next_record()
+            if isinstance(record, list):
+                for row in record:
+                    yield row
+            elif record is not None and record["state"] == "FINISHED":
+                return
+            else:
+                raise self._error(record)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+# opens the shared spool of a query. returns (fd, True) if this backend runs the
+# query, or (fd, False) if another backend is running it
+def _open_coalesced_spool(path):
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            # tell the leader that a follower may be reading the spool before checking the leader
+            fcntl.lockf(fd, fcntl.LOCK_SH, 1, COALESCE_FOLLOWER_LOCK_OFFSET)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return fd, False
+            stat = os.fstat(fd)
+            if stat.st_nlink > 0 and stat.st_size == 0:
+                fcntl.lockf(fd, fcntl.LOCK_UN, 1, COALESCE_FOLLOWER_LOCK_OFFSET)
+                return fd, True
+            if stat.st_nlink > 0:
+                # left by a backend which exited while running the query
+                os.unlink(path)
+        except:
+            os.close(fd)
+            raise
+        # the spool has ended. retry with a new file
+        os.close(fd)
+
+# returns a CoalescedQuery if another backend is running the same query, or a
+# CoalescedSpoolWriter to share results of the query which this backend runs
+def _coalesce_query(cache_key):
+    directory = _get_setting("prestogres.coalesce_dir")
+    try:
+        os.makedirs(directory, 0700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    path = os.path.join(directory, cache_key)
+    while True:
+        fd, leader = _open_coalesced_spool(path)
+        if leader:
+            return CoalescedSpoolWriter(path, fd)
+        query = CoalescedQuery(fd)
+        try:
+            if query.read_header():
+                return query
+        except:
+            query.close()
+            raise
+        # the leader ended without results. run or follow the query again
+        query.close()
+
+# build (column index, converter) pairs of columns of which values need conversion
+# before returned to PostgreSQL. other columns are returned as-is.
+def _build_row_converters(column_types):
+    converters = []
+    for i, t in enumerate(column_types):
+        if t == "json":
+            converters.append((i, json.dumps))
+        elif t == "bytea":
+            # Presto returns varbinary as a base64-encoded string
+            converters.append((i, base64.b64decode))
+        elif t not in NON_STRING_RESULT_TYPES:
+            converters.append((i, remove_null))
+    return converters
 
 class QueryAutoCloseIterator(object):
-    def __init__(self, gen, query_auto_close):
+    def __init__(self, gen, query_auto_close, converters):
         self.gen = gen
         self.query_auto_close = query_auto_close
+        self.converters = converters
 
     def __iter__(self):
         return self
 
     def next(self):
-        row = next(self.gen)
-        for i, v in enumerate(row):
-            row[i] = remove_null(v)
+        query_auto_close = self.query_auto_close
+        if query_auto_close.closed:
+            # closed by reset_session
+            raise StopIteration
+        try:
+            row = next(self.gen)
+        except StopIteration:
+            query_auto_close.close("FINISHED")
+            raise
+        except Exception as e:
+            query_auto_close.close("FAILED", e)
+            raise
+        if query_auto_close.rows == 0:
+            query_auto_close.time_to_first_row = time.time() - query_auto_close.started_at
+        query_auto_close.rows += 1
+        for i, convert in self.converters:
+            v = row[i]
+            if v is not None:
+                row[i] = convert(v)
         return row
 
-class QueryAutoCloseIteratorWithJsonConvert(QueryAutoCloseIterator):
-    def __init__(self, gen, query_auto_close, json_columns):
-        QueryAutoCloseIterator.__init__(self, gen, query_auto_close)
-        self.json_columns = json_columns
-
-    def next(self):
-        row = next(self.gen)
-        for i, v in enumerate(row):
-            row[i] = remove_null(v)
-        for i in self.json_columns:
-            row[i] = json.dumps(row[i])
-        return row
+# string literals, quoted identifiers, comments and numbers. queries which differ only in
+# them share the fingerprint and the rewrite result
+LITERAL_PATTERN = re.compile(r"""(?=['"\-/.0-9eE$])(?:%s|"(?:[^"]|"")*"|--[^\n]*|/\*.*?\*/|(?<![\w$])(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)""" % STRING_LITERAL, re.DOTALL)
+# literals are replaced by these control characters in fingerprints
+LITERAL_PLACEHOLDERS = {"'": "\x01", "E": "\x01", "e": "\x01", "$": "\x01", '"': "\x02", "-": "\x03", "/": "\x03"}
+NUMBER_PLACEHOLDER = "\x04"
+PLACEHOLDER_PATTERN = re.compile("[\x01-\x04]")
+
+# tokens of a fingerprint given to rewrite rules
+QUERY_TOKEN_PATTERN = re.compile(r"""
+      (?P<space>\s+|\x03)
+    | (?P<string>\x01)
+    | (?P<quoted>\x02)
+    | (?P<number>\x04)
+    | (?P<word>[a-zA-Z_][a-zA-Z0-9_$]*)
+    | (?P<op>.)
+    """, re.VERBOSE | re.DOTALL)
+
+# rewrite of a token: replacement (None keeps the token) followed by suffix
+RewriteEdit = namedtuple("RewriteEdit", ["position", "replacement", "suffix"])
+
+AUTO_LIMIT_ROWS = 1000
+
+# some BI tools assume that PostgreSQL supports INTEGER and FLOAT types but Presto
+# supports only BIGINT and DOUBLE
+def _cast_type_rule(type_name, replacement):
+    def rule(tokens):
+        edits = []
+        for i in xrange(1, len(tokens) - 1):
+            if tokens[i] == ("word", type_name) and tokens[i - 1] == ("word", "as") and tokens[i + 1] == ("op", ")"):
+                edits.append(RewriteEdit(i, replacement, ""))
+        return edits
+    return rule
+
+# SELECT * FROM table reads the whole table. BI tools run it to preview tables
+def _auto_limit_rule(tokens):
+    names = ("word", "quoted")
+    end = len(tokens)
+    while end > 0 and tokens[end - 1] == ("op", ";"):
+        end -= 1
+    if end not in (4, 6) or tokens[:3] != [("word", "select"), ("op", "*"), ("word", "from")]:
+        return []
+    if tokens[3][0] not in names or (end == 6 and (tokens[4] != ("op", ".") or tokens[5][0] not in names)):
+        return []
+    return [RewriteEdit(end - 1, None, " limit %d" % AUTO_LIMIT_ROWS)]
+
+# compatibility rewrites applied to queries in order. a rule takes tokens excepting
+# whitespace and comments as (kind, text) tuples with lower-cased words and returns
+# RewriteEdits. texts of literals and quoted identifiers are hidden from rules because
+# queries of the same fingerprint share the result.
+REWRITE_RULES = [
+    _cast_type_rule("integer", "bigint"),
+    _cast_type_rule("float", "double"),
+    _auto_limit_rule,
+]
+
+_rewrite_cache = OrderedDict()  # fingerprint -> texts between literals after rewrite, or None
+_rewrite_cache_stats = {"hits": 0, "misses": 0}
+
+def _query_fingerprint(query):
+    """Returns the query of which literals are replaced by placeholders, and the literals."""
+    parts = []
+    literals = []
+    pos = 0
+    for m in LITERAL_PATTERN.finditer(query):
+        literal = m.group(0)
+        parts.append(query[pos:m.start()])
+        parts.append(LITERAL_PLACEHOLDERS.get(literal[0], NUMBER_PLACEHOLDER))
+        literals.append(literal)
+        pos = m.end()
+    parts.append(query[pos:])
+    return "".join(parts), literals
+
+def _apply_rewrite_rules(fingerprint):
+    matches = [(m.lastgroup, m.group(0)) for m in QUERY_TOKEN_PATTERN.finditer(fingerprint)]
+    positions = [i for i, (kind, text) in enumerate(matches) if kind != "space"]
+    tokens = [(matches[i][0], matches[i][1].lower()) for i in positions]
+
+    edits = []
+    for rule in REWRITE_RULES:
+        edits.extend(rule(tokens))
+    if not edits:
+        return None
+
+    texts = [text for kind, text in matches]
+    for edit in edits:
+        i = positions[edit.position]
+        texts[i] = (texts[i] if edit.replacement is None else edit.replacement) + edit.suffix
+    # texts between literals
+    return PLACEHOLDER_PATTERN.split("".join(texts))
+
+def _rewrite_query(query):
+    if PLACEHOLDER_PATTERN.search(query):
+        # placeholders can't be distinguished from the query
+        return query
+
+    fingerprint, literals = _query_fingerprint(query)
+    if fingerprint in _rewrite_cache:
+        _rewrite_cache_stats["hits"] += 1
+        rewritten = _rewrite_cache.pop(fingerprint)
+    else:
+        _rewrite_cache_stats["misses"] += 1
+        rewritten = _apply_rewrite_rules(fingerprint)
+
+    cache_size = int(_get_setting("prestogres.rewrite_cache_size"))
+    if cache_size > 0:
+        _rewrite_cache[fingerprint] = rewritten
+        while len(_rewrite_cache) > cache_size:
+            _rewrite_cache.popitem(last=False)
+
+    if rewritten is None:
+        return query
+
+    # put literals back between the rewritten texts
+    pieces = [None] * (len(rewritten) + len(literals))
+    pieces[0::2] = rewritten
+    pieces[1::2] = literals
+    query = "".join(pieces)
+    plpy.debug("rewrote query for Presto: %s" % query)
+    return query
+
+# entries of the rewrite cache of this backend and its hits and misses
+def get_rewrite_cache_stats():
+    return {"entries": len(_rewrite_cache),
+            "hits": _rewrite_cache_stats["hits"], "misses": _rewrite_cache_stats["misses"]}
+
+# maximum number of result types kept in pg_temp per session
+MAX_RESULT_TYPES = 32
 
 class SessionData(object):
     def __init__(self):
         self.query_auto_close = None
+        self.result_types = OrderedDict()  # result type names created by this session
+        self.query_history = deque(maxlen=MAX_QUERY_HISTORY)  # stats of finished queries
+        self.open_queries = weakref.WeakSet()  # QueryAutoClose of queries not closed yet
+        self.presto_connection = None  # (server, user, catalog, schema) given by pgpool
+        self.catalog_access_role = None  # access_role given to setup_system_catalog
+        self.catalog_schemas = set()  # schemas on Presto
+        self.lazy_schemas = set()  # schemas of which tables are not created yet
+        self.uncommitted_schemas = {}  # schemas loaded by a transaction that may roll back -> now() of it
+        self.catalog_snapshot = None  # CatalogSnapshot used by setup_system_catalog
 
 session = SessionData()
 
+def _create_fetch_function(function_name, type_name, column_names, column_types, function_exists, security_definer):
+    statements = []
+
+    # CREATE TABLE for return type of the function
+    statements.append(_build_create_temp_table_sql(type_name, column_names, column_types, if_not_exists=True))
+
+    # CREATE FUNCTION
+    # security definer only if the function writes results to prestogres_catalog.result_cache.
+    # it's owned by the owner of start_presto_query.
+    if function_exists:
+        statements.append("drop function pg_temp.%s()" % plpy.quote_ident(function_name))
+    statements.append(
+        """
+        create function pg_temp.%s()
+        returns setof pg_temp.%s as $$
+            import prestogres
+            return prestogres.fetch_presto_query_results()
+        $$ language plpythonu
+        %s
+        """ % \
+        (plpy.quote_ident(function_name), plpy.quote_ident(type_name),
+            "security definer" if security_definer else "security invoker"))
+
+    # drop least recently used result types
+    result_types = session.result_types
+    while len(result_types) >= MAX_RESULT_TYPES:
+        old_type_name, _ = result_types.popitem(last=False)
+        if old_type_name != type_name:
+            statements.append("drop table if exists pg_temp.%s" % plpy.quote_ident(old_type_name))
+
+    # run statements
+    plpy.execute(";\n".join(statements))
+
 def start_presto_query(presto_server, presto_user, presto_catalog, presto_schema, function_name, query):
+    started_at = time.time()
+
+    # the previous query was started but its results were never fetched
+    if session.query_auto_close is not None:
+        session.query_auto_close.close("CANCELLED")
+        session.query_auto_close = None
+
+    session.presto_connection = (presto_server, presto_user, presto_catalog, presto_schema)
+
     try:
+        query = _rewrite_query(query)
+
+        state = _get_session_state(function_name)
+
         # preserve search_path if explicitly set
-        search_path = _get_session_search_path_array()
+        search_path = state["search_path"]
         if search_path != ['$user', 'public'] and len(search_path) > 0:
             # search_path is changed explicitly. use the first schema
             presto_schema = search_path[0]
 
-        # start query
-        client = presto_client.Client(server=presto_server, user=presto_user, catalog=presto_catalog, schema=presto_schema, time_zone=_get_session_time_zone())
+        time_zone = state["time_zone"]
+        source = state["application_name"] or DEFAULT_SOURCE
+        session_info = OrderedDict([("server", presto_server), ("user", presto_user), ("catalog", presto_catalog),
+            ("schema", presto_schema), ("time_zone", time_zone), ("source", source)])
+
+        if session.lazy_schemas or session.uncommitted_schemas:
+            _load_referenced_schemas(presto_schema, query)
+
+        cache_key = None
+        cached = None
+        if int(_get_setting("prestogres.result_cache_ttl")) > 0:
+            cache_key = _result_cache_key(presto_server, presto_user, presto_catalog, presto_schema, time_zone, query)
+            if cache_key is not None:
+                cached = _lookup_result_cache(cache_key)
+
+        coalesce = None
+        if cached is None and _get_setting("prestogres.coalesce_queries") == "on":
+            coalesce_key = cache_key or \
+                    _result_cache_key(presto_server, presto_user, presto_catalog, presto_schema, time_zone, query)
+            if coalesce_key is not None:
+                coalesce = _coalesce_query(coalesce_key)
+
+        if cached is not None:
+            query_text = query
+            query = CachedQuery(cached["rows"])
+            session.query_auto_close = QueryAutoClose(query, query_text, started_at, session_info=session_info)
+            column_names = cached["column_names"]
+            column_types = cached["column_types"]
+
+        elif isinstance(coalesce, CoalescedQuery):
+            # another backend is running the query
+            query_text = query
+            query = coalesce
+            session.query_auto_close = QueryAutoClose(query, query_text, started_at, session_info=session_info)
 
-        query = client.query(query)
-        session.query_auto_close = QueryAutoClose(query)
+        else:
+            try:
+                admission = _admit_query(presto_user, source)
+            except PrestoAdmissionException as e:
+                if coalesce is not None:
+                    # followers run the query again
+                    coalesce.end("REJECTED", None, None)
+                QueryAutoClose(None, query, started_at, e.admission, session_info).close("REJECTED")
+                raise
+            except:
+                if coalesce is not None:
+                    coalesce.end("FAILED", None, None)
+                raise
+
+            # start query
+            try:
+                client = _new_client(presto_server, presto_user, presto_catalog, presto_schema, time_zone, source)
+
+                query_text = query
+                query = client.query(query)
+            except:
+                if coalesce is not None:
+                    # followers raise the same error instead of running the query again
+                    error = sys.exc_info()[1]
+                    coalesce.end("FAILED", error if isinstance(error, presto_client.PrestoException) else None, None)
+                if admission is not None:
+                    admission.release()
+                raise
+            session.query_auto_close = QueryAutoClose(query, query_text, started_at, admission, session_info)
+            session.query_auto_close.coalesce = coalesce
+
+        error = None
         try:
-            # result schema
-            column_names = []
-            column_types = []
-            for column in query.columns():
-                column_names.append(column.name)
-                column_types.append(_pg_result_type(column.type))
+            if cached is None:
+                # result schema
+                column_names = []
+                column_types = []
+                presto_columns = []
+                for column in query.columns():
+                    column_names.append(column.name)
+                    column_types.append(_pg_result_type(column.type))
+                    presto_columns.append((column.name, column.type))
+                session.query_auto_close.presto_columns = presto_columns
+                if session.query_auto_close.coalesce is not None:
+                    session.query_auto_close.coalesce.start(query.client.results.id, presto_columns)
+
+                column_names = _rename_duplicated_column_names(column_names, "a query result")
+
+                if cache_key is not None and not isinstance(query, CoalescedQuery):
+                    session.query_auto_close.result_cache_writer = ResultCacheWriter(
+                            cache_key, query_text, column_names, column_types,
+                            int(_get_setting("prestogres.result_cache_max_entry_bytes")))
 
-            column_names = _rename_duplicated_column_names(column_names, "a query result")
             session.query_auto_close.column_names = column_names
             session.query_auto_close.column_types = column_types
 
-            # CREATE TABLE for return type of the function
-            type_name = function_name + "_type"
-            create_type_sql = _build_create_temp_table_sql(type_name, column_names, column_types)
-
-            # CREATE FUNCTION
-            create_function_sql = \
-                """
-                create or replace function pg_temp.%s()
-                returns setof pg_temp.%s as $$
-                    import prestogres
-                    return prestogres.fetch_presto_query_results()
-                $$ language plpythonu
-                """ % \
-                (plpy.quote_ident(function_name), plpy.quote_ident(type_name))
-
-            # run statements
-            plpy.execute("drop table if exists pg_temp.%s cascade" % \
-                    (plpy.quote_ident(type_name)))
-            plpy.execute(create_type_sql)
-            plpy.execute(create_function_sql)
+            # the function already returns the same result type. skip DDL
+            type_name = _result_type_name(function_name, column_names, column_types)
+            security_definer = session.query_auto_close.result_cache_writer is not None
+            if state["result_type"] != type_name or bool(state["security_definer"]) != security_definer:
+                _create_fetch_function(function_name, type_name, column_names, column_types,
+                        state["result_type"] is not None, security_definer)
+            session.result_types.pop(type_name, None)
+            session.result_types[type_name] = True
 
             query = None
 
+        except presto_client.PrestoException as e:
+            error = e
+            raise
+
         finally:
             if query is not None:
                 # close query
+                session.query_auto_close.close("FAILED", error)
                 session.query_auto_close = None
 
     except (plpy.SPIError, presto_client.PrestoException) as e:
@@ -232,16 +1437,139 @@ def fetch_presto_query_results():
         query_auto_close = session.query_auto_close
         session.query_auto_close = None  # close of the iterator closes query
 
-        results = query_auto_close.query.results()
-        json_columns = []
-        for i, t in enumerate(query_auto_close.column_types):
-            if t == "json":
-                json_columns.append(i)
+        spool_max_bytes = int(_get_setting("prestogres.spool_max_bytes"))
+        # cached rows are in memory and followers of a coalesced query read the file of the leader
+        if spool_max_bytes > 0 and not isinstance(query_auto_close.query, (CachedQuery, CoalescedQuery)):
+            results = _spooled_results(query_auto_close, spool_max_bytes)
+        else:
+            results = query_auto_close.query.results()
+        if query_auto_close.coalesce is not None:
+            results = query_auto_close.coalesce.rows(results)
+        if query_auto_close.result_cache_writer is not None:
+            results = _result_cache_filling_iterator(results, query_auto_close.result_cache_writer)
+        converters = _build_row_converters(query_auto_close.column_types)
+
+        return QueryAutoCloseIterator(results, query_auto_close, converters)
 
-        if json_columns:
-            return QueryAutoCloseIteratorWithJsonConvert(results, query_auto_close, json_columns)
+    except (plpy.SPIError, presto_client.PrestoException) as e:
+        e.__class__.__module__ = "__main__"
+        raise
+
+# schema of unlogged and regular tables created by materialize_presto_query.
+# pgpool runs queries referencing it (or pg_temp) on PostgreSQL
+MATERIALIZED_SCHEMA = "prestogres_materialized"
+
+# maximum size of JSON rows inserted by a statement at materialize_presto_query
+MATERIALIZE_BATCH_BYTES = 4*1024*1024
+
+# \u0000 escapes which PostgreSQL's json can't convert to text
+JSON_NULL_CHARACTER_PATTERN = re.compile(r"(?<!\\)((?:\\\\)*)\\u0000")
+
+def _build_materialize_insert_sql(table, column_types):
+    # rows are passed as a JSON array of Presto's JSON rows
+    values = []
+    for i, column_type in enumerate(column_types):
+        if column_type == "json":
+            values.append("e->%d" % i)
+        elif column_type == "bytea":
+            values.append("pg_catalog.decode(e->>%d, 'base64')" % i)
         else:
-            return QueryAutoCloseIterator(results, query_auto_close)
+            values.append("(e->>%d)::%s" % (i, column_type))
+    return "insert into %s select %s from pg_catalog.json_array_elements($1::json) e" % (table, ", ".join(values))
+
+def _page_json(data):
+    if isinstance(data, presto_client.PageRows):
+        text = data.body[data.start:data.end]
+    else:
+        text = json.dumps(data)
+    return JSON_NULL_CHARACTER_PATTERN.sub(r"\1", text.strip()[1:-1].strip())
+
+def materialize_presto_query(table_name, query, persistence, replace):
+    try:
+        if session.presto_connection is None:
+            plpy.error("Presto connection of this session is unknown. Run a query on Presto first")
+        presto_server, presto_user, presto_catalog, presto_schema = session.presto_connection
+
+        if persistence == "temp":
+            table = "pg_temp.%s" % plpy.quote_ident(table_name)
+            create = "create temporary table"
+            namespace = "pg_catalog.pg_my_temp_schema()"
+        elif persistence in ("unlogged", "regular"):
+            table = "%s.%s" % (plpy.quote_ident(MATERIALIZED_SCHEMA), plpy.quote_ident(table_name))
+            create = "create unlogged table" if persistence == "unlogged" else "create table"
+            namespace = "(select oid from pg_catalog.pg_namespace where nspname = %s)" % plpy.quote_literal(MATERIALIZED_SCHEMA)
+        else:
+            plpy.error("persistence must be either of temp, unlogged or regular: %s" % persistence)
+
+        state = _get_session_state(None)
+        search_path = state["search_path"]
+        if search_path != ['$user', 'public'] and len(search_path) > 0:
+            presto_schema = search_path[0]
+
+        source = state["application_name"] or DEFAULT_SOURCE
+        admission = _admit_query(presto_user, source)
+        try:
+            client = _new_client(presto_server, presto_user, presto_catalog, presto_schema, state["time_zone"], source)
+            query = client.query(query)
+        except:
+            if admission is not None:
+                admission.release()
+            raise
+        try:
+            column_names = []
+            column_types = []
+            for column in query.columns():
+                column_names.append(column.name)
+                column_types.append(_pg_result_type(column.type))
+            column_names = _rename_duplicated_column_names(column_names, "a query result")
+
+            owner = plpy.execute("select session_user as name")[0]["name"]
+            if replace:
+                # this function is security definer. drop only tables of the session user
+                existing = plpy.execute(plpy.prepare(
+                    "select pg_catalog.pg_get_userbyid(relowner) as owner from pg_catalog.pg_class" \
+                    " where relname = $1 and relnamespace = %s" % namespace, ["text"]), [table_name])
+                if existing:
+                    if existing[0]["owner"] != owner:
+                        plpy.error("Table %s is owned by another user" % table)
+                    plpy.execute("drop table %s" % table)
+
+            create_sql = [create, " ", table, " ("]
+            create_sql.append(", ".join(["%s %s" % (plpy.quote_ident(name), column_type)
+                for name, column_type in zip(column_names, column_types)]))
+            create_sql.append(")")
+            plpy.execute("".join(create_sql))
+
+            plan = plpy.prepare(_build_materialize_insert_sql(table, column_types), ["text"])
+            rows = 0
+            size = 0
+            batch = []
+            batch_size = 0
+            for data in query.pages():
+                text = _page_json(data)
+                if not text:
+                    continue
+                batch.append(text)
+                batch_size += len(text)
+                if batch_size >= MATERIALIZE_BATCH_BYTES:
+                    rows += plpy.execute(plan, ["[" + ",".join(batch) + "]"]).nrows()
+                    size += batch_size
+                    batch = []
+                    batch_size = 0
+            if batch:
+                rows += plpy.execute(plan, ["[" + ",".join(batch) + "]"]).nrows()
+                size += batch_size
+
+            # let the user create indexes on it, drop it, etc.
+            plpy.execute("alter table %s owner to %s" % (table, plpy.quote_ident(owner)))
+
+            return {"rows": rows, "bytes": size}
+        finally:
+            try:
+                query.close()
+            finally:
+                if admission is not None:
+                    admission.release()
 
     except (plpy.SPIError, presto_client.PrestoException) as e:
         e.__class__.__module__ = "__main__"
@@ -249,94 +1577,371 @@ def fetch_presto_query_results():
 
 Column = namedtuple("Column", ("name", "type", "nullable"))
 
-def setup_system_catalog(presto_server, presto_user, presto_catalog, presto_schema, access_role):
-    search_path = _get_session_search_path_array()
-    if search_path == ['$user', 'public']:
-        # search_path is default value.
-        plpy.execute("set search_path to %s" % plpy.quote_ident(presto_schema))
+# maximum number of DDL statements sent to PostgreSQL at once
+DDL_BATCH_SIZE = 500
+
+# build (column name, PostgreSQL type, not null) list of each table in a schema
+def _build_table_definitions(schema_name, tables):
+    definitions = {}
+    for table_name, columns in tables.items():
+        column_names = []
+        column_types = []
+        not_nulls = []
+
+        if len(columns) >= 1600:
+            plpy.warning("Table %s.%s contains more than 1600 columns. Some columns will be inaccessible" % (plpy.quote_ident(schema_name), plpy.quote_ident(table_name)))
+
+        for column in columns[0:1600]:
+            column_names.append(column.name)
+            column_types.append(_pg_table_type(column.type))
+            not_nulls.append(not column.nullable)
+
+        # change columns
+        column_names = _rename_duplicated_column_names(column_names,
+                "%s.%s table" % (plpy.quote_ident(schema_name), plpy.quote_ident(table_name)))
+        definitions[table_name] = zip(column_names, column_types, not_nulls)
+    return definitions
+
+# get {schema_name: {table_name: [(column name, type, not null)]}} of existing tables.
+# if schema_names is given, tables of other schemas are not included.
+def _get_existing_tables(schema_names=None):
+    sql = "select n.nspname as schema_name, c.relname as table_name, a.attname as column_name," \
+          " pg_catalog.format_type(a.atttypid, a.atttypmod) as column_type, a.attnotnull as not_null" \
+          " from pg_catalog.pg_namespace n" \
+          " left join pg_catalog.pg_class c on c.relnamespace = n.oid and c.relkind = 'r'" \
+          " and ($1::text[] is null or n.nspname = any($1))" \
+          " left join pg_catalog.pg_attribute a on a.attrelid = c.oid and a.attnum > 0 and not a.attisdropped" \
+          " where n.nspname not in ('prestogres_catalog', 'prestogres_materialized', 'information_schema')" \
+          " and n.nspname not like 'pg_%'" \
+          " order by n.nspname, c.relname, a.attnum"
+    existing = {}
+    for row in plpy.cursor(plpy.prepare(sql, ["text[]"]), [schema_names]):
+        tables = existing.setdefault(row["schema_name"], {})
+        if row["table_name"] is None:
+            continue
+        columns = tables.setdefault(row["table_name"], [])
+        if row["column_name"] is not None:
+            columns.append((row["column_name"], row["column_type"], row["not_null"]))
+    return existing
+
+# map type names to the canonical names that format_type returns (e.g. varchar(255)
+# to character varying(255)) by creating a temporary table using the types
+def _get_canonical_type_names(type_names):
+    canonical = {}
+    type_names = sorted(type_names)
+    for i in xrange(0, len(type_names), 1600):
+        chunk = type_names[i:i+1600]
+        column_names = ["c%d" % j for j in xrange(len(chunk))]
+        plpy.execute("drop table if exists pg_temp.prestogres_type_probe")
+        plpy.execute(_build_create_temp_table_sql("prestogres_type_probe", column_names, chunk))
+        sql = "select a.attnum, pg_catalog.format_type(a.atttypid, a.atttypmod) as column_type" \
+              " from pg_catalog.pg_attribute a" \
+              " where a.attrelid = 'pg_temp.prestogres_type_probe'::regclass and a.attnum > 0"
+        for row in plpy.execute(sql):
+            canonical[chunk[row["attnum"] - 1]] = row["column_type"]
+        plpy.execute("drop table pg_temp.prestogres_type_probe")
+    return canonical
+
+# build DDL statements to change existing tables in a schema to the definitions
+def _build_sync_schema_statements(schema_name, definitions, existing_tables, canonical_types):
+    statements = []
+    quoted_schema = plpy.quote_ident(schema_name)
+
+    if existing_tables is None:
+        statements.append("create schema %s" % quoted_schema)
+        existing_tables = {}
+
+    dropped = [name for name in existing_tables if name not in definitions]
+    if dropped:
+        statements.append("drop table %s cascade" % \
+                ", ".join(["%s.%s" % (quoted_schema, plpy.quote_ident(name)) for name in sorted(dropped)]))
+
+    for table_name, columns in sorted(definitions.items()):
+        canonical_columns = [(name, canonical_types[column_type], not_null) for name, column_type, not_null in columns]
+        existing_columns = existing_tables.get(table_name)
+        if existing_columns == canonical_columns:
+            continue
+
+        quoted_table = "%s.%s" % (quoted_schema, plpy.quote_ident(table_name))
+        if existing_columns is not None and existing_columns == canonical_columns[:len(existing_columns)]:
+            # new columns are added at the end
+            statements.append("alter table %s %s" % (quoted_table, ", ".join([
+                "add column %s %s%s" % (plpy.quote_ident(name), column_type, " not null" if not_null else "")
+                for name, column_type, not_null in columns[len(existing_columns):]])))
+            continue
+
+        if existing_columns is not None:
+            statements.append("drop table %s cascade" % quoted_table)
+        statements.append(_build_create_table(schema_name, table_name,
+            [c[0] for c in columns], [c[1] for c in columns], [c[2] for c in columns]))
+
+    return statements
 
-    client = presto_client.Client(server=presto_server, user=presto_user, catalog=presto_catalog, schema='default')
+def _execute_batched(statements):
+    for i in xrange(0, len(statements), DDL_BATCH_SIZE):
+        plpy.execute(";\n".join(statements[i:i+DDL_BATCH_SIZE]))
 
-    # get table list
-    sql = "select table_schema, table_name, column_name, is_nullable, data_type" \
-          " from information_schema.columns"
-    columns, rows = client.run(sql)
-    if rows is None:
-        rows = []
+class SchemaColumnsFetcher(object):
+    """Fetches columns of schemas from Presto in batches of schemas.
 
-    schemas = {}
+    Iterating this object returns (schema_name, tables, warnings) of schemas
+    in the given order. Each batch is one query ordered by schema so that a
+    schema is returned as soon as its rows are read and the caller creates its
+    tables while the rest is streamed. A warning is a (message format, names)
+    tuple to quote and log by the caller.
 
+    This doesn't use threads. PL/Python holds the GIL while the caller runs
+    SPI, so worker threads would make little progress in parallel.
+    """
+
+    def __init__(self, client, schema_names, batch_size):
+        self.client = client
+        self.schema_names = schema_names
+        self.batch_size = max(batch_size, 1)
+        self.query = None
+
+    def __iter__(self):
+        for i in xrange(0, len(self.schema_names), self.batch_size):
+            for schema in self._fetch_batch(self.schema_names[i:i + self.batch_size]):
+                yield schema
+
+    def _fetch_batch(self, schema_names):
+        sql = "select table_schema, table_name, column_name, is_nullable, data_type" \
+              " from information_schema.columns" \
+              " where table_schema in (%s)" \
+              " order by table_schema" % ", ".join("'%s'" % name.replace("'", "''") for name in schema_names)
+        remaining = set(schema_names)
+        schema_name = None
+        tables = {}
+        warnings = []
+
+        self.query = self.client.query(sql)
+        try:
+            for row in self.query.results():
+                if row[0] != schema_name:
+                    if schema_name is not None:
+                        yield schema_name, tables, warnings
+                    schema_name = row[0]
+                    remaining.discard(schema_name)
+                    tables = {}
+                    warnings = []
+                table_name = row[1]
+                column_name = row[2]
+                is_nullable = row[3]
+                column_type = row[4]
+
+                if len(table_name) > PG_NAMEDATALEN - 1:
+                    warnings.append(("Table %s.%s is skipped because its name is longer than %d characters",
+                        (schema_name, table_name)))
+                    continue
+
+                columns = tables.setdefault(table_name, [])
+
+                if len(column_name) > PG_NAMEDATALEN - 1:
+                    warnings.append(("Column %s.%s.%s is skipped because its name is longer than %d characters",
+                        (schema_name, table_name, column_name)))
+                    continue
+
+                columns.append(Column(column_name, column_type, is_nullable))
+        finally:
+            self.stop()
+
+        if schema_name is not None:
+            yield schema_name, tables, warnings
+        # schemas without tables
+        for schema_name in schema_names:
+            if schema_name in remaining:
+                yield schema_name, {}, []
+
+    def stop(self):
+        if self.query is not None:
+            self.query.close()
+            self.query = None
+
+# returns (schema names, warnings) of a catalog. worker threads may call this
+def _fetch_schema_names(client):
+    columns, rows = client.stream("select schema_name from information_schema.schemata")
+
+    schema_names = []
+    warnings = []
     for row in rows:
         schema_name = row[0]
-        table_name = row[1]
-        column_name = row[2]
-        is_nullable = row[3]
-        column_type = row[4]
 
         if schema_name == "sys" or schema_name == "information_schema":
             # skip system schemas
             continue
 
         if len(schema_name) > PG_NAMEDATALEN - 1:
-            plpy.warning("Schema %s is skipped because its name is longer than %d characters" % \
-                    (plpy.quote_ident(schema_name), PG_NAMEDATALEN - 1))
+            warnings.append(("Schema %s is skipped because its name is longer than %d characters", (schema_name,)))
             continue
 
-        tables = schemas.setdefault(schema_name, {})
+        schema_names.append(schema_name)
 
-        if len(table_name) > PG_NAMEDATALEN - 1:
-            plpy.warning("Table %s.%s is skipped because its name is longer than %d characters" % \
-                    (plpy.quote_ident(schema_name), plpy.quote_ident(table_name), PG_NAMEDATALEN - 1))
-            continue
+    return schema_names, warnings
 
-        columns = tables.setdefault(table_name, [])
+# version of the file format of catalog snapshots
+CATALOG_SNAPSHOT_VERSION = 1
 
-        if len(column_name) > PG_NAMEDATALEN - 1:
-            plpy.warning("Column %s.%s.%s is skipped because its name is longer than %d characters" % \
-                    (plpy.quote_ident(schema_name), plpy.quote_ident(table_name), \
-                     plpy.quote_ident(column_name), PG_NAMEDATALEN - 1))
-            continue
+class CatalogSnapshot(object):
+    """Schemas and columns of a Presto catalog saved in a gzipped JSON file.
 
-        columns.append(Column(column_name, column_type, is_nullable))
+    Any backend on the host reads the file instead of querying Presto while
+    it's fresh. Files are replaced atomically by rename(2).
+    """
 
-    # drop all schemas excepting prestogres_catalog, information_schema and pg_%
-    sql = "select n.nspname as schema_name from pg_catalog.pg_namespace n" \
-          " where n.nspname not in ('prestogres_catalog', 'information_schema')" \
-          " and n.nspname not like 'pg_%'"
-    for row in plpy.cursor(sql):
-        plpy.execute("drop schema %s cascade" % plpy.quote_ident(row["schema_name"]))
+    def __init__(self, created_at, schema_names, warnings, schemas):
+        self.created_at = created_at
+        self.schema_names = schema_names
+        self.warnings = warnings  # warnings of schema names
+        self.schemas = schemas  # {schema_name: (tables, warnings)}
 
-    # create schema and tables
-    for schema_name, tables in sorted(schemas.items(), key=lambda (k,v): k):
+    @classmethod
+    def read(cls, path):
+        """Returns None if the file doesn't exist or has another version."""
+        try:
+            with gzip.open(path, "rb") as f:
+                dic = json.load(f)
+        except (IOError, OSError, ValueError, EOFError):
+            return None
+        if dic.get("version") != CATALOG_SNAPSHOT_VERSION:
+            return None
+        schemas = {}
+        for schema_name, (tables, warnings) in dic["schemas"].items():
+            tables = dict([(table_name, [Column(*column) for column in columns])
+                for table_name, columns in tables.items()])
+            schemas[schema_name] = (tables, [(message, tuple(names)) for message, names in warnings])
+        return cls(dic["created_at"], dic["schema_names"],
+                [(message, tuple(names)) for message, names in dic["warnings"]], schemas)
+
+    def write(self, path):
+        directory = os.path.dirname(path)
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=directory)
         try:
-            plpy.execute("create schema %s" % (plpy.quote_ident(schema_name)))
+            with os.fdopen(fd, "wb") as f:
+                with gzip.GzipFile(fileobj=f, mode="wb", compresslevel=6) as z:
+                    json.dump({
+                        "version": CATALOG_SNAPSHOT_VERSION,
+                        "created_at": self.created_at,
+                        "schema_names": self.schema_names,
+                        "warnings": self.warnings,
+                        "schemas": self.schemas,
+                        }, z, separators=(",", ":"))
+            os.rename(tmp_path, path)
         except:
-            # ignore error?
-            pass
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def fetch(cls, client):
+        created_at = time.time()
+        schema_names, warnings = _fetch_schema_names(client)
+        schemas = {}
+        fetcher = SchemaColumnsFetcher(client, schema_names,
+                int(_get_setting("prestogres.catalog_fetch_batch_size")))
+        try:
+            for schema_name, tables, schema_warnings in fetcher:
+                schemas[schema_name] = (tables, schema_warnings)
+        finally:
+            fetcher.stop()
+        return cls(created_at, schema_names, warnings, schemas)
+
+    def iter_schemas(self, schema_names):
+        for schema_name in schema_names:
+            tables, warnings = self.schemas.get(schema_name, ({}, []))
+            yield schema_name, tables, warnings
+
+# returns a fresh CatalogSnapshot, fetching it from Presto if this backend can lock
+# the snapshot file. if another backend is refreshing it, returns the stale one
+# (or None if it doesn't exist) without waiting. PL/Python doesn't run threads
+# after a function returns, so the refresh isn't left to a background thread.
+def _get_catalog_snapshot(client, presto_server, presto_user, presto_catalog):
+    directory = _get_setting("prestogres.catalog_snapshot_dir")
+    try:
+        os.makedirs(directory, 0700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    key = "\0".join([presto_server, presto_user, presto_catalog])
+    path = os.path.join(directory, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json.gz")
+    ttl = int(_get_setting("prestogres.catalog_snapshot_ttl"))
+
+    snapshot = CatalogSnapshot.read(path)
+    if snapshot is not None and snapshot.created_at + ttl > time.time():
+        return snapshot
+
+    with open(path + ".lock", "a") as lock:
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return snapshot
 
-        for table_name, columns in sorted(tables.items(), key=lambda (k,v): k):
-            column_names = []
-            column_types = []
-            not_nulls = []
+        # another backend may have refreshed it before the lock is taken
+        latest = CatalogSnapshot.read(path)
+        if latest is not None and latest.created_at + ttl > time.time():
+            return latest
 
-            if len(columns) >= 1600:
-                plpy.warning("Table %s.%s contains more than 1600 columns. Some columns will be inaccessible" % (plpy.quote_ident(schema_name), plpy.quote_ident(table_name)))
+        try:
+            snapshot = CatalogSnapshot.fetch(client)
+        except presto_client.PrestoException as e:
+            if snapshot is None:
+                raise
+            plpy.warning("Failed to refresh the catalog snapshot. Using a snapshot created %d seconds ago: %s" % \
+                    (time.time() - snapshot.created_at, e))
+            return snapshot
+        snapshot.write(path)
+        return snapshot
+
+def _new_catalog_client(presto_server, presto_user, presto_catalog):
+    return presto_client.Client(server=presto_server, user=presto_user, catalog=presto_catalog, schema='default',
+            compression=_get_compression(presto_server))
+
+# create, alter or drop tables of the schemas to match definitions on Presto
+# or a CatalogSnapshot. statements run before tables are created.
+def _sync_schemas(client, snapshot, schema_names, existing, statements, access_role):
+    if snapshot is not None:
+        fetcher = snapshot.iter_schemas(schema_names)
+    else:
+        # tables of a schema are created while rows of the next schemas are
+        # read from Presto
+        fetcher = SchemaColumnsFetcher(client, schema_names,
+                int(_get_setting("prestogres.catalog_fetch_batch_size")))
+    try:
+        canonical_types = {}
 
-            for column in columns[0:1600]:
-                column_names.append(column.name)
-                column_types.append(_pg_table_type(column.type))
-                not_nulls.append(not column.nullable)
+        for schema_name, tables, warnings in fetcher:
+            for message, names in warnings:
+                plpy.warning(message % (tuple(map(plpy.quote_ident, names)) + (PG_NAMEDATALEN - 1,)))
+
+            definitions = _build_table_definitions(schema_name, tables)
 
-            # change columns
-            column_names = _rename_duplicated_column_names(column_names,
-                    "%s.%s table" % (plpy.quote_ident(schema_name), plpy.quote_ident(table_name)))
-            create_sql = _build_create_table(schema_name, table_name, column_names, column_types, not_nulls)
-            plpy.execute(create_sql)
+            type_names = set()
+            for columns in definitions.values():
+                type_names.update([column_type for name, column_type, not_null in columns if column_type not in canonical_types])
+            if type_names:
+                canonical_types.update(_get_canonical_type_names(type_names))
 
+            # create, alter or drop only changed tables
+            statements.extend(_build_sync_schema_statements(schema_name, definitions,
+                existing.get(schema_name), canonical_types))
+
+            if len(statements) >= DDL_BATCH_SIZE:
+                _execute_batched(statements)
+                statements = []
+
+        _execute_batched(statements)
+
+    finally:
+        if snapshot is None:
+            fetcher.stop()
+
+    if schema_names:
+        quoted_schemas = ", ".join([plpy.quote_ident(name) for name in sorted(schema_names)])
         # grant access on the schema to the restricted user so that
         # pg_table_is_visible(reloid) used by \d of psql command returns true
         plpy.execute("grant usage on schema %s to %s" % \
-                (plpy.quote_ident(schema_name), plpy.quote_ident(access_role)))
+                (quoted_schemas, plpy.quote_ident(access_role)))
         # this SELECT privilege is unnecessary because queries against those tables
         # won't run on PostgreSQL. causing an exception is good if Prestogres has
         # a bug sending a presto query to PostgreSQL without rewriting.
@@ -344,7 +1949,62 @@ def setup_system_catalog(presto_server, presto_user, presto_catalog, presto_sche
         #      has_table_privilege. the best solution is to grant privilege but
         #      actually selecting from those tables causes an exception.
         plpy.execute("grant select on all tables in schema %s to %s" % \
-                (plpy.quote_ident(schema_name), plpy.quote_ident(access_role)))
+                (quoted_schemas, plpy.quote_ident(access_role)))
+
+def setup_system_catalog(presto_server, presto_user, presto_catalog, presto_schema, access_role):
+    session.presto_connection = (presto_server, presto_user, presto_catalog, presto_schema)
+    session.catalog_access_role = access_role
+
+    search_path = _get_session_search_path_array()
+    if search_path == ['$user', 'public']:
+        # search_path is default value.
+        plpy.execute("set search_path to %s" % plpy.quote_ident(presto_schema))
+        search_path = [presto_schema]
+
+    client = _new_catalog_client(presto_server, presto_user, presto_catalog)
+
+    snapshot = None
+    if int(_get_setting("prestogres.catalog_snapshot_ttl")) > 0:
+        snapshot = _get_catalog_snapshot(client, presto_server, presto_user, presto_catalog)
+    session.catalog_snapshot = snapshot
+
+    if snapshot is not None:
+        schema_names = snapshot.schema_names
+        warnings = snapshot.warnings
+    else:
+        schema_names, warnings = _fetch_schema_names(client)
+    for message, names in warnings:
+        plpy.warning(message % (tuple(map(plpy.quote_ident, names)) + (PG_NAMEDATALEN - 1,)))
+
+    session.catalog_schemas = set(schema_names)
+
+    if _get_setting("prestogres.catalog_mode") == "lazy":
+        loaded = [name for name in schema_names if name in search_path]
+        session.lazy_schemas = set(schema_names).difference(loaded)
+        existing = _get_existing_tables(loaded)
+    else:
+        loaded = schema_names
+        session.lazy_schemas = set()
+        existing = _get_existing_tables()
+    session.uncommitted_schemas = {}
+
+    # drop schemas excepting prestogres_catalog, prestogres_materialized, information_schema and pg_% which
+    # don't exist on Presto any more
+    statements = []
+    dropped = [name for name in existing if name not in session.catalog_schemas]
+    if dropped:
+        statements.append("drop schema %s cascade" % ", ".join([plpy.quote_ident(name) for name in sorted(dropped)]))
+
+    lazy_schemas = sorted(session.lazy_schemas)
+    for schema_name in lazy_schemas:
+        # tables created by previous sessions are left until the schema is loaded
+        if schema_name not in existing:
+            statements.append("create schema %s" % plpy.quote_ident(schema_name))
+    if lazy_schemas:
+        statements.append("grant usage on schema %s to %s" % \
+                (", ".join(map(plpy.quote_ident, lazy_schemas)), plpy.quote_ident(access_role)))
+
+    _sync_schemas(client, snapshot, loaded, existing, statements, access_role)
 
     # fake current_database() to return Presto's catalog name to be compatible with some
     # applications that use db.schema.table syntax to identify a table
@@ -353,3 +2013,102 @@ def setup_system_catalog(presto_server, presto_user, presto_catalog, presto_sche
         plpy.execute("create function pg_catalog.current_database() returns name as $$begin return %s::name; end$$ language plpgsql stable strict" % \
                 plpy.quote_literal(presto_catalog))
 
+# create tables of schemas not loaded by setup_system_catalog yet (prestogres.catalog_mode = lazy)
+def _load_schemas(schema_names):
+    presto_server, presto_user, presto_catalog, presto_schema = session.presto_connection
+    client = _new_catalog_client(presto_server, presto_user, presto_catalog)
+    _sync_schemas(client, session.catalog_snapshot, schema_names, _get_existing_tables(schema_names), [],
+            session.catalog_access_role)
+    session.lazy_schemas.difference_update(schema_names)
+
+    # DDL runs in the caller's transaction. _check_uncommitted_schemas loads
+    # the schemas again if it rolls back
+    now, with_tables = _get_schemas_with_tables(schema_names)
+    for schema_name in with_tables:
+        session.uncommitted_schemas[schema_name] = now
+
+# returns now() of the current transaction and names of the schemas which have tables
+def _get_schemas_with_tables(schema_names):
+    plan = _get_plan(
+        "select pg_catalog.now()::text as now, array(select n.nspname::text from pg_catalog.pg_namespace n"
+        " where n.nspname = any($1::text[])"
+        " and exists (select 1 from pg_catalog.pg_class c where c.relnamespace = n.oid and c.relkind = 'r'))"
+        " as schema_names", ["text[]"])
+    row = plpy.execute(plan, [list(schema_names)])[0]
+    return row["now"], set(row["schema_names"])
+
+# marks schemas as lazy again if the transaction which loaded them rolled back
+def _check_uncommitted_schemas(schema_names):
+    schema_names = schema_names.intersection(session.uncommitted_schemas)
+    if not schema_names:
+        return
+    now, with_tables = _get_schemas_with_tables(sorted(schema_names))
+    for schema_name in schema_names:
+        if session.uncommitted_schemas[schema_name] == now:
+            # loaded by this transaction
+            continue
+        del session.uncommitted_schemas[schema_name]
+        if schema_name not in with_tables:
+            session.lazy_schemas.add(schema_name)
+
+# schema names qualifying tables referenced by a query (or table aliases qualifying columns)
+def _get_qualifier_names(query):
+    names = set()
+    for m in QUALIFIER_PATTERN.finditer(STRING_LITERAL_PATTERN.sub("''", query)):
+        name = m.group(1)
+        if name.startswith('"'):
+            names.add(name[1:-1].replace('""', '"'))
+        else:
+            names.add(name.lower())
+    return names
+
+# load lazily created schemas which a query may reference. DDL runs in the transaction
+# of the query.
+def _load_referenced_schemas(presto_schema, query):
+    referenced = _get_qualifier_names(query)
+    referenced.add(presto_schema)
+    if session.uncommitted_schemas:
+        _check_uncommitted_schemas(referenced)
+    schema_names = referenced.intersection(session.lazy_schemas)
+    if schema_names:
+        _load_schemas(sorted(schema_names))
+
+def load_schema(schema_name):
+    try:
+        if session.presto_connection is None or session.catalog_access_role is None:
+            plpy.error("Presto connection of this session is unknown. Run a query on Presto first")
+        if schema_name not in session.catalog_schemas:
+            plpy.error("Schema %s doesn't exist on Presto" % plpy.quote_ident(schema_name))
+        # reloads the schema if it's loaded already
+        _load_schemas([schema_name])
+
+    except (plpy.SPIError, presto_client.PrestoException) as e:
+        e.__class__.__module__ = "__main__"
+        raise
+
+# loads the given schemas which are created lazily and not loaded yet. the others
+# are ignored. pgpool calls this before a statement reading pg_class, pg_attribute
+# or pg_tables looks them up.
+def load_lazy_schemas(schema_names):
+    try:
+        schema_names = set(schema_names)
+        if session.uncommitted_schemas:
+            _check_uncommitted_schemas(schema_names)
+        schema_names.intersection_update(session.lazy_schemas)
+        if schema_names:
+            _load_schemas(sorted(schema_names))
+
+    except (plpy.SPIError, presto_client.PrestoException) as e:
+        e.__class__.__module__ = "__main__"
+        raise
+
+def load_all_schemas():
+    try:
+        if session.uncommitted_schemas:
+            _check_uncommitted_schemas(set(session.uncommitted_schemas))
+        if session.lazy_schemas:
+            _load_schemas(sorted(session.lazy_schemas))
+
+    except (plpy.SPIError, presto_client.PrestoException) as e:
+        e.__class__.__module__ = "__main__"
+        raise
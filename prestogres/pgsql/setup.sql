@@ -35,11 +35,114 @@ begin
         $$ language plpythonu
         security definer;
 
+        create or replace function prestogres_catalog.load_schema(schema_name text)
+        returns void as $$
+            import prestogres
+            prestogres.load_schema(schema_name)
+        $$ language plpythonu
+        security definer;
+
+        create or replace function prestogres_catalog.load_lazy_schemas(schema_names text[])
+        returns void as $$
+            import prestogres
+            prestogres.load_lazy_schemas(schema_names)
+        $$ language plpythonu
+        security definer;
+
+        create or replace function prestogres_catalog.load_all_schemas()
+        returns void as $$
+            import prestogres
+            prestogres.load_all_schemas()
+        $$ language plpythonu
+        security definer;
+
+        if not exists (select * from pg_namespace where nspname = \'prestogres_materialized\') then
+            create schema prestogres_materialized;
+        end if;
+
+        create or replace function prestogres_catalog.materialize_presto_query(
+            table_name text, query text,
+            persistence text default \'temp\', replace boolean default false,
+            out rows bigint, out bytes bigint)
+        returns record as $$
+            import prestogres
+            return prestogres.materialize_presto_query(table_name, query, persistence, replace)
+        $$ language plpythonu
+        security definer;
+
+        create unlogged table if not exists prestogres_catalog.result_cache (
+            cache_key text primary key,
+            query text not null,
+            column_names text[] not null,
+            column_types text[] not null,
+            rows text not null,
+            bytes bigint not null,
+            created_at timestamptz not null default now(),
+            last_hit_at timestamptz not null default now(),
+            hits bigint not null default 0);
+
+        -- the shared row of counters serialized cache lookups. they are sequences now
+        drop table if exists prestogres_catalog.result_cache_stats;
+
+        if not exists (select * from pg_class c join pg_namespace n on n.oid = c.relnamespace
+                where n.nspname = \'prestogres_catalog\' and c.relname = \'result_cache_hits\') then
+            create sequence prestogres_catalog.result_cache_hits;
+            create sequence prestogres_catalog.result_cache_misses;
+            create sequence prestogres_catalog.result_cache_stores;
+            create sequence prestogres_catalog.result_cache_evictions;
+        end if;
+
+        create or replace function prestogres_catalog.result_cache_stats(
+            out entries bigint, out bytes bigint,
+            out hits bigint, out misses bigint, out stores bigint, out evictions bigint)
+        returns record as $$
+            import prestogres
+            return prestogres.get_result_cache_stats()
+        $$ language plpythonu
+        security definer;
+
+        create or replace function prestogres_catalog.query_stats()
+        returns table (
+            query_id text, started_at timestamptz, query text, state text, cached boolean, coalesced boolean,
+            source text, lane text, admission_wait_ms double precision,
+            total_ms double precision, time_to_first_row_ms double precision, rows bigint,
+            submit_ms double precision, time_to_first_page_ms double precision,
+            time_to_columns_ms double precision, time_to_first_data_ms double precision,
+            pages bigint, bytes bigint, transferred_bytes bigint,
+            fetch_ms double precision, decode_ms double precision, wait_ms double precision,
+            retries bigint, reconnects bigint, spooled_bytes bigint, saved_splits bigint, saved_cpu_ms bigint,
+            presto_state text, presto_cpu_ms bigint, presto_wall_ms bigint,
+            presto_processed_rows bigint, presto_processed_bytes bigint) as $$
+            import prestogres
+            return prestogres.get_query_stats()
+        $$ language plpythonu;
+
+        create or replace function prestogres_catalog.admission_stats(
+            out running bigint, out queued bigint, out priority_queued bigint)
+        returns record as $$
+            import prestogres
+            return prestogres.get_admission_stats()
+        $$ language plpythonu;
+
+        create or replace function prestogres_catalog.rewrite_cache_stats(
+            out entries bigint, out hits bigint, out misses bigint)
+        returns record as $$
+            import prestogres
+            return prestogres.get_rewrite_cache_stats()
+        $$ language plpythonu;
+
+        create or replace function prestogres_catalog.reset_session()
+        returns void as $$
+            import prestogres
+            prestogres.reset_session()
+        $$ language plpythonu;
+
         revoke temporary on database "' || target_db || E'" from public;  -- reject CREATE TEMPORARY TABLE
         revoke select on pg_catalog.pg_roles from public;
         revoke select on pg_catalog.pg_authid from public;
         revoke select on pg_catalog.pg_auth_members from public;
         grant usage on schema prestogres_catalog to "' || access_role || E'";
+        grant usage on schema prestogres_materialized to "' || access_role || E'";
         grant execute on all functions in schema prestogres_catalog to "' || access_role || E'";
 
     end $INIT$ language plpgsql');
@@ -0,0 +1,76 @@
+"""Tests of presto_async_client against the fake coordinator of prestogres/bench.
+
+The fake coordinator runs in this Python 2.7 process and the client runs in
+Python 3.6 or later given by $PYTHON3 (default python3):
+
+    python -m unittest discover -s prestogres/test/pgsql -p 'test_*.py'
+"""
+
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PGSQL_DIR = os.path.join(HERE, "..", "..", "pgsql")
+sys.path[:0] = [PGSQL_DIR, os.path.join(HERE, "..", "..", "bench")]
+
+import fake_presto
+
+PYTHON3 = os.environ.get("PYTHON3", "python3")
+
+# stops iteration after 3 rows and prints whether the query is closed
+EARLY_BREAK_SCRIPT = """
+import asyncio, json, sys
+sys.path.insert(0, sys.argv[1])
+from presto_async_client import AsyncClient
+
+async def main(server):
+    client = AsyncClient(server=server, user="test")
+    closed = {}
+
+    async with await client.query("select * from test") as query:
+        rows = []
+        async for row in query:
+            rows.append(row[0])
+            if len(rows) == 3:
+                break
+    closed["async_with"] = query.client.closed
+
+    query = await client.query("select * from test")
+    async for row in query.results():
+        break
+    await query.close()
+    closed["close"] = query.client.closed
+
+    columns, rows = await client.run("select * from test")
+    await client.close()
+    return {"closed": closed, "rows": len(rows)}
+
+loop = asyncio.new_event_loop()
+print(json.dumps(loop.run_until_complete(main(sys.argv[2]))))
+"""
+
+def _python3_available():
+    try:
+        version = subprocess.check_output([PYTHON3, "-c", "import sys; print(sys.version_info >= (3, 6))"])
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return version.strip() == "True"
+
+@unittest.skipUnless(_python3_available(), "Python 3.6 or later is not available")
+class EarlyBreakTest(unittest.TestCase):
+    def test_query_is_closed_after_break(self):
+        server = fake_presto.FakePrestoServer(fake_presto.FakePrestoConfig(rows=1000, page_rows=100)).start()
+        self.addCleanup(server.stop)
+
+        result = json.loads(subprocess.check_output([PYTHON3, "-c", EARLY_BREAK_SCRIPT, PGSQL_DIR, server.address]))
+
+        self.assertEqual(result["closed"], {"async_with": True, "close": True})
+        self.assertEqual(result["rows"], 1000)
+        # both queries which stopped early were cancelled on the coordinator
+        self.assertEqual(server.stats["cancels"], 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,348 @@
+"""Tests of presto_client against the fake coordinator of prestogres/bench.
+
+Run with Python 2.7:
+
+    python -m unittest discover -s prestogres/test/pgsql -p 'test_*.py'
+"""
+
+import collections
+import httplib
+import json
+import os
+import socket
+import sys
+import time
+import unittest
+import zlib
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, "..", "..", "pgsql"), os.path.join(HERE, "..", "..", "bench")]
+
+import fake_presto
+import presto_client
+
+class FakeServerTestCase(unittest.TestCase):
+    def start_server(self, **config):
+        server = fake_presto.FakePrestoServer(fake_presto.FakePrestoConfig(**config)).start()
+        self.addCleanup(server.stop)
+        return server
+
+    def assertRowSequence(self, rows, total):
+        # the first column of the fake coordinator is the row number
+        self.assertEqual([row[0] for row in rows], range(total))
+
+class DecodeBodyTest(unittest.TestCase):
+    columns = [{"name": "c0", "type": "bigint"}, {"name": "data", "type": "varchar"}]
+    stats = {"state": "RUNNING", "queued": False, "scheduled": True}
+
+    def page(self, data, **kwargs):
+        page = collections.OrderedDict([("id", "q1"), ("nextUri", "http://localhost/v1/statement/q1/2"),
+                                        ("columns", self.columns)])
+        if data is not None:
+            page["data"] = data
+        page["stats"] = self.stats
+        page.update(kwargs)
+        return page
+
+    def assertDecoded(self, body, lazy=True):
+        results = presto_client.QueryResults.decode_body(body)
+        expected = json.loads(body)
+        self.assertEqual(results.id, expected["id"])
+        self.assertEqual(results.next_uri, expected.get("nextUri"))
+        self.assertEqual([column.name for column in results.columns], [c["name"] for c in expected["columns"]])
+        self.assertEqual(results.stats.state, expected["stats"]["state"])
+        if "data" not in expected:
+            self.assertIsNone(results.data)
+            return results
+        self.assertEqual(isinstance(results.data, presto_client.PageRows), lazy)
+        self.assertEqual(list(results.data), expected["data"])
+        return results
+
+    def test_rows_are_decoded_lazily(self):
+        data = [[1, "a"], [2, None], [3, "[\"x\", {\"y\": 1}]"]]
+        self.assertDecoded(json.dumps(self.page(data)))
+        self.assertDecoded(json.dumps(self.page(data), indent=2))
+        self.assertDecoded(json.dumps(self.page(data), separators=(",", ":")))
+
+    def test_empty_data(self):
+        self.assertDecoded(json.dumps(self.page([])))
+        self.assertDecoded(json.dumps(self.page([]), indent=2))
+
+    def test_no_data(self):
+        self.assertDecoded(json.dumps(self.page(None)))
+
+    def test_keys_in_values(self):
+        data = [[1, '"stats": ,'], [2, '"data": [']]
+        self.assertDecoded(json.dumps(self.page(data)))
+
+    def test_error_after_stats(self):
+        error = {"message": "boom", "errorCode": 1, "errorLocation": {"lineNumber": 1, "columnNumber": 8}}
+        results = self.assertDecoded(json.dumps(self.page([[1, "a"]], error=error)))
+        self.assertEqual(results.error.message, "boom")
+        self.assertEqual(results.error.error_location.column_number, 8)
+
+    def test_other_layout_is_decoded_entirely(self):
+        page = collections.OrderedDict([("id", "q1"), ("stats", self.stats), ("columns", self.columns),
+                                        ("data", [[1, "a"]])])
+        self.assertDecoded(json.dumps(page), lazy=False)
+
+class ChunkedResponse(object):
+    def __init__(self, body, content_encoding, chunk_size):
+        self.body = body
+        self.content_encoding = content_encoding
+        self.chunk_size = chunk_size
+
+    def getheader(self, name):
+        return self.content_encoding if name == "Content-Encoding" else None
+
+    def read(self, size=None):
+        chunk, self.body = self.body[:self.chunk_size], self.body[self.chunk_size:]
+        return chunk
+
+class DecompressTest(unittest.TestCase):
+    body = '{"id":"q1","data":[%s]}' % ",".join(["[%d,\"value\"]" % i for i in xrange(1000)])
+
+    def compress(self, wbits):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+        return compressor.compress(self.body) + compressor.flush()
+
+    def test_encodings(self):
+        for content_encoding, wbits in [("gzip", 16 + zlib.MAX_WBITS), ("deflate", zlib.MAX_WBITS),
+                                        ("Deflate", -zlib.MAX_WBITS)]:
+            compressed = self.compress(wbits)
+            self.assertEqual(presto_client.decompress_body(compressed, content_encoding), self.body)
+            response = ChunkedResponse(compressed, content_encoding, 100)
+            self.assertEqual(presto_client.read_body(response), (self.body, len(compressed)))
+
+    def test_unknown_encoding(self):
+        self.assertEqual(presto_client.decompress_body(self.body, "identity"), self.body)
+
+class PageSpoolTest(unittest.TestCase):
+    pages = [[[1, "a"], [2, "b\nc"]], [], [[3, None]], [[4, u"\u3042"]]]
+    rows = [[1, "a"], [2, "b\nc"], [3, None], [4, u"\u3042"]]
+
+    def fill(self, spool):
+        self.addCleanup(spool.close)
+        for page in self.pages:
+            spool.add(page)
+        return spool
+
+    def test_rows_in_memory(self):
+        spool = self.fill(presto_client.PageSpool(1024))
+        self.assertFalse(spool.spilled)
+        self.assertEqual(list(spool), self.rows)
+        # replayed from the beginning
+        self.assertEqual(list(spool), self.rows)
+
+    def test_rows_spilled_to_file(self):
+        for compress in [False, True]:
+            spool = self.fill(presto_client.PageSpool(20, compress=compress))
+            self.assertTrue(spool.spilled)
+            self.assertIsNone(spool.pages)
+            self.assertEqual(list(spool), self.rows)
+            self.assertEqual(list(spool), self.rows)
+
+    def test_page_rows_are_kept_as_text(self):
+        body = '{"id":"q1","data":[[1,"a"],[2,"b"]],"stats":{}}'
+        results = presto_client.QueryResults.decode_body(body)
+        spool = presto_client.PageSpool(1024)
+        spool.add(results.data)
+        self.assertEqual(spool.pages, ['[[1,"a"],[2,"b"]]'])
+        self.assertEqual(spool.bytes, 17)
+        self.assertEqual(list(spool), [[1, "a"], [2, "b"]])
+
+    def test_close(self):
+        spool = self.fill(presto_client.PageSpool(20))
+        f = spool.file
+        spool.close()
+        self.assertTrue(f.closed)
+        self.assertEqual(list(spool), [])
+
+class PrefetchTest(FakeServerTestCase):
+    def test_rows_in_order(self):
+        server = self.start_server(rows=5000, page_rows=100)
+        client = presto_client.Client(server=server.address, user="test", prefetch_pages=2)
+        for i in xrange(50):
+            query = client.query("select * from test")
+            try:
+                self.assertRowSequence(list(query.results()), 5000)
+            finally:
+                query.close()
+
+    def test_rows_in_order_after_queued_pages(self):
+        server = self.start_server(rows=1000, page_rows=100, queued_pages=2, page_delay=0.001)
+        client = presto_client.Client(server=server.address, user="test", prefetch_pages=3)
+        for i in xrange(20):
+            columns, rows = client.run("select * from test")
+            self.assertRowSequence(rows, 1000)
+
+class DropSecondPostHandler(fake_presto.FakePrestoHandler):
+    def do_POST(self):
+        if self.server.stats["queries"] != 1:
+            return fake_presto.FakePrestoHandler.do_POST(self)
+        # the query is accepted but the connection is closed before the response
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.stats["queries"] += 1
+        self.close_connection = 1
+        self.connection.shutdown(socket.SHUT_RDWR)
+
+class RetryTest(FakeServerTestCase):
+    def test_post_is_not_retried_on_reused_connection(self):
+        server = self.start_server(rows=10, page_rows=10)
+        server.RequestHandlerClass = DropSecondPostHandler
+        pool = presto_client.HttpConnectionPool()
+        self.addCleanup(pool.clear)
+        client = presto_client.Client(server=server.address, user="test", connection_pool=pool)
+
+        columns, rows = client.run("select * from test")
+        self.assertRowSequence(rows, 10)
+        self.assertEqual(server.stats["connections"], 1)
+
+        with self.assertRaises((httplib.HTTPException, socket.error)):
+            client.run("select * from test")
+        self.assertEqual(server.stats["queries"], 2)
+
+class ReconnectTest(FakeServerTestCase):
+    def run_query(self, server, **options):
+        client = presto_client.Client(server=server.address, user="test", **options)
+        query = client.query("select * from test")
+        try:
+            return list(query.results()), query.client.metrics
+        finally:
+            query.close()
+
+    def test_drops_on_every_page(self):
+        # 10 data pages. drops alternate between no response and a truncated body
+        for prefetch_pages in [0, 2]:
+            server = self.start_server(rows=1000, page_rows=100, connection_faults=2)
+            rows, metrics = self.run_query(server, prefetch_pages=prefetch_pages)
+            self.assertRowSequence(rows, 1000)
+            self.assertEqual(server.stats["faults"], 20)
+            self.assertEqual(metrics.reconnects, 20)
+
+    def test_drop_on_first_page(self):
+        # token 0 is the response of POST. token 1 is the first page of rows
+        server = self.start_server(rows=1000, page_rows=100, connection_faults=2, fault_pages=[1])
+        rows, metrics = self.run_query(server)
+        self.assertRowSequence(rows, 1000)
+        self.assertEqual(metrics.reconnects, 2)
+
+    def test_drop_on_last_page(self):
+        server = self.start_server(rows=1000, page_rows=100, connection_faults=2, fault_pages=[10])
+        rows, metrics = self.run_query(server)
+        self.assertRowSequence(rows, 1000)
+        self.assertEqual(metrics.reconnects, 2)
+
+    def test_drop_after_queued_pages(self):
+        # a queued page, the first page of rows and the last page
+        server = self.start_server(rows=1000, page_rows=100, queued_pages=2, connection_faults=1, fault_pages=[1, 3, 12])
+        rows, metrics = self.run_query(server, prefetch_pages=3)
+        self.assertRowSequence(rows, 1000)
+        self.assertEqual(metrics.reconnects, 3)
+
+    def test_too_many_drops(self):
+        server = self.start_server(rows=1000, page_rows=100, connection_faults=3, fault_pages=[5])
+        rows = []
+        client = presto_client.Client(server=server.address, user="test", max_reconnects=2)
+        query = client.query("select * from test")
+        try:
+            with self.assertRaises((httplib.HTTPException, socket.error)):
+                for row in query.results():
+                    rows.append(row)
+        finally:
+            query.close()
+        # rows before the page are returned once
+        self.assertRowSequence(rows, 400)
+
+class SlowClusterStatsHandler(fake_presto.FakePrestoHandler):
+    def do_GET(self):
+        if self.path == "/v1/cluster":
+            time.sleep(0.5)
+        return fake_presto.FakePrestoHandler.do_GET(self)
+
+class NoResponsePostHandler(fake_presto.FakePrestoHandler):
+    def do_POST(self):
+        # the query is accepted but the response is late
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.stats["queries"] += 1
+        time.sleep(1)
+        self.close_connection = 1
+
+class FailoverTest(FakeServerTestCase):
+    def setUp(self):
+        # cluster stats are refreshed once so that the order stays the same
+        self.router = presto_client.CoordinatorRouter(stats_interval=60)
+        self.pool = presto_client.HttpConnectionPool()
+        self.addCleanup(self.pool.clear)
+
+    def client(self, servers, **options):
+        return presto_client.Client(server=",".join(server.address for server in servers), user="test",
+                router=self.router, connection_pool=self.pool, **options)
+
+    def wait_for_cluster_stats(self, servers):
+        self.router.order([server.address for server in servers])
+        deadline = time.time() + 5
+        while any(self.router.coordinators[server.address].cluster_stats_at == 0 for server in servers):
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+    def run_queries(self, servers, count):
+        client = self.client(servers)
+        for i in xrange(count):
+            columns, rows = client.run("select * from test")
+            self.assertRowSequence(rows, 100)
+
+    def test_routes_to_least_queued_and_fails_over(self):
+        busy = self.start_server(rows=100, page_rows=50, cluster_queued=5)
+        idle = self.start_server(rows=100, page_rows=50)
+        spare = self.start_server(rows=100, page_rows=50, cluster_queued=10)
+        servers = [busy, idle, spare]
+        self.wait_for_cluster_stats(servers)
+
+        self.run_queries(servers, 3)
+        self.assertEqual([server.stats["queries"] for server in servers], [0, 3, 0])
+
+        # the coordinator goes down. its idle connections are closed
+        idle.stop()
+        self.pool.clear()
+        self.run_queries(servers, 3)
+        self.assertEqual([server.stats["queries"] for server in servers], [3, 3, 0])
+        self.assertEqual(self.router.coordinators[idle.address].failures, 1)
+        self.assertTrue(self.router.coordinators[idle.address].unhealthy_until > time.time())
+
+    def test_cluster_stats_are_refreshed_in_background(self):
+        slow = self.start_server(rows=100, page_rows=50, cluster_queued=5)
+        slow.RequestHandlerClass = SlowClusterStatsHandler
+        other = self.start_server(rows=100, page_rows=50)
+        servers = [slow, other]
+
+        # ordered by the last known stats, which are none yet
+        started_at = time.time()
+        self.run_queries(servers, 1)
+        self.assertLess(time.time() - started_at, 0.4)
+        self.assertEqual([server.stats["queries"] for server in servers], [1, 0])
+
+        self.wait_for_cluster_stats(servers)
+        self.run_queries(servers, 1)
+        self.assertEqual([server.stats["queries"] for server in servers], [1, 1])
+
+    def test_no_failover_after_statement_is_sent(self):
+        late = self.start_server(rows=100, page_rows=50)
+        late.RequestHandlerClass = NoResponsePostHandler
+        other = self.start_server(rows=100, page_rows=50, cluster_queued=5)
+        servers = [late, other]
+        self.wait_for_cluster_stats(servers)
+
+        # the late coordinator may be running the statement. it isn't started again
+        with self.assertRaises(socket.timeout):
+            self.client(servers, http_timeout=0.2).run("select * from test")
+        self.assertEqual([server.stats["queries"] for server in servers], [1, 0])
+
+    def test_no_coordinator(self):
+        for server in ["", " , "]:
+            with self.assertRaises(presto_client.PrestoException) as cm:
+                presto_client.Client(server=server, user="test", router=self.router).query("select 1")
+            self.assertEqual(cm.exception.args[0], "no coordinator available: empty server list")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,620 @@
+"""Tests of prestogres.py with the plpy stand-in of prestogres/bench.
+
+Run with Python 2.7:
+
+    python -m unittest discover -s prestogres/test/pgsql -p 'test_*.py'
+"""
+
+import BaseHTTPServer
+import fcntl
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, "..", "..", "pgsql"), os.path.join(HERE, "..", "..", "bench")]
+
+import fake_presto
+import plpy
+import presto_client
+import prestogres
+
+class PrestogresTestCase(unittest.TestCase):
+    server_config = {"rows": 10, "page_rows": 5}
+
+    def setUp(self):
+        plpy.reset()
+        prestogres._settings = None
+        prestogres.session = prestogres.SessionData()
+        self.server = fake_presto.FakePrestoServer(fake_presto.FakePrestoConfig(**self.server_config)).start()
+        self.addCleanup(self.server.stop)
+
+    def set(self, **settings):
+        for name, value in settings.items():
+            plpy.settings["prestogres." + name] = value
+        prestogres._settings = None
+
+    def run_query(self, query):
+        prestogres.start_presto_query(self.server.address, "test", "hive", "default", "presto_fetch", query)
+        return list(prestogres.fetch_presto_query_results())
+
+    def executed(self, text):
+        return [sql for sql in plpy.executed if text in sql]
+
+class RowConverterTest(PrestogresTestCase):
+    server_config = {"rows": 3, "page_rows": 2, "column_types": ("bigint", "varbinary", "array<bigint>", "varchar")}
+
+    def convert(self, column_types, row):
+        for i, convert in prestogres._build_row_converters(column_types):
+            if row[i] is not None:
+                row[i] = convert(row[i])
+        return row
+
+    def test_conversions(self):
+        self.assertEqual(self.convert(["json", "bytea", "varchar", "text"],
+                                      [{"a": [1, None]}, "AGJ5dGVz", "a\0b", u"c\0d\u3042"]),
+                         ['{"a": [1, null]}', "\0bytes", "ab", u"cd\u3042"])
+
+    def test_nulls_are_kept(self):
+        self.assertEqual(self.convert(["json", "bytea", "varchar"], [None, None, None]), [None, None, None])
+
+    def test_non_string_types_are_not_converted(self):
+        self.assertEqual(prestogres._build_row_converters(sorted(prestogres.NON_STRING_RESULT_TYPES)), [])
+
+    def test_rows_of_presto(self):
+        rows = self.run_query("select * from test")
+        self.assertEqual(rows[1], [1, "bytes-1", "[1, 2, 3, 4]", "value-1"])
+
+class ResultCacheTest(PrestogresTestCase):
+    def test_stats_are_counted_by_sequences(self):
+        self.set(result_cache_ttl="60")
+        self.assertEqual(len(self.run_query("select * from test")), 10)
+
+        # no shared row is updated
+        self.assertEqual([sql for sql in self.executed("prestogres_catalog.result_cache")
+                          if sql.lstrip().startswith("update")], [])
+        self.assertEqual(plpy.sequences, {"prestogres_catalog.result_cache_misses": 1,
+                                          "prestogres_catalog.result_cache_stores": 1})
+
+        # a monitoring session sees counts of all backends
+        prestogres.session = prestogres.SessionData()
+        self.assertEqual(prestogres.get_result_cache_stats(),
+                         {"entries": 0, "bytes": 0, "hits": 0, "misses": 1, "stores": 1, "evictions": 0})
+
+    def test_key_keeps_case_of_literals(self):
+        self.assertEqual(prestogres._normalize_query("SELECT  E'A\\'B', $$C  D$$ FROM T;"),
+                         "select E'A\\'B', $$C  D$$ from t")
+
+    def test_fetch_function_is_security_definer_only_to_store_results(self):
+        self.run_query("select * from test")
+        self.assertEqual(len(self.executed("security invoker")), 1)
+        self.assertEqual(self.executed("security definer"), [])
+
+        self.set(result_cache_ttl="60")
+        self.run_query("select * from test")
+        self.assertEqual(len(self.executed("security definer")), 1)
+
+        # same result type. the function is reused
+        self.run_query("select * from test limit 10")
+        self.assertEqual(len(self.executed("create function")), 2)
+
+class RewriteTest(PrestogresTestCase):
+    def setUp(self):
+        PrestogresTestCase.setUp(self)
+        prestogres._rewrite_cache.clear()
+        prestogres._rewrite_cache_stats.update(hits=0, misses=0)
+
+    def test_cast_types(self):
+        self.assertEqual(prestogres._rewrite_query("select cast(a as integer), cast(b AS Float) from t"),
+                         "select cast(a as bigint), cast(b AS double) from t")
+        self.assertEqual(prestogres._rewrite_query("select cast(a as integer_type) from t"),
+                         "select cast(a as integer_type) from t")
+
+    def test_auto_limit(self):
+        self.assertEqual(prestogres._rewrite_query("select * from t"), "select * from t limit 1000")
+        self.assertEqual(prestogres._rewrite_query('SELECT * FROM s."t";'), 'SELECT * FROM s."t" limit 1000;')
+        self.assertEqual(prestogres._rewrite_query("select * from t where a = 1"), "select * from t where a = 1")
+
+    def test_literals_are_not_rewritten(self):
+        for literal in ["'as integer)'", "E'it\\'s as integer)'", "$$as integer)$$", "$q$it's $$ as integer)$q$",
+                        '"as integer)"']:
+            query = "select cast(a as integer), %s from t -- as integer)" % literal
+            self.assertEqual(prestogres._rewrite_query(query),
+                             "select cast(a as bigint), %s from t -- as integer)" % literal)
+
+    def test_fingerprint(self):
+        fingerprint, literals = prestogres._query_fingerprint("select E'a\\'b', $x$c$x$, 'd', x$y$, 1.5 from t")
+        self.assertEqual(fingerprint, "select \x01, \x01, \x01, x$y$, \x04 from t")
+        self.assertEqual(literals, ["E'a\\'b'", "$x$c$x$", "'d'", "1.5"])
+        self.assertEqual(prestogres._query_fingerprint("select E'x', $$y$$, 'z', x$y$, 2 from t")[0], fingerprint)
+
+    def test_queries_differing_in_literals_share_cache_entry(self):
+        self.assertEqual(prestogres._rewrite_query("select cast(a as integer) from t where b = 'x'"),
+                         "select cast(a as bigint) from t where b = 'x'")
+        self.assertEqual(prestogres._rewrite_query("select cast(a as integer) from t where b = $$y$$"),
+                         "select cast(a as bigint) from t where b = $$y$$")
+        self.assertEqual(prestogres.get_rewrite_cache_stats(), {"entries": 1, "hits": 1, "misses": 1})
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.set(rewrite_cache_size="2")
+        for query in ["select 1", "select a from t", "select 2", "select b from t"]:
+            prestogres._rewrite_query(query)
+        self.assertEqual(list(prestogres._rewrite_cache), ["select \x04", "select b from t"])
+        self.assertEqual(prestogres.get_rewrite_cache_stats(), {"entries": 2, "hits": 1, "misses": 3})
+
+    def test_cache_can_be_disabled(self):
+        self.set(rewrite_cache_size="0")
+        self.assertEqual(prestogres._rewrite_query("select * from t"), "select * from t limit 1000")
+        self.assertEqual(prestogres.get_rewrite_cache_stats(), {"entries": 0, "hits": 0, "misses": 1})
+
+    def test_query_with_placeholder_characters_is_not_rewritten(self):
+        self.assertEqual(prestogres._rewrite_query("select * from \x01"), "select * from \x01")
+        self.assertEqual(prestogres.get_rewrite_cache_stats(), {"entries": 0, "hits": 0, "misses": 0})
+
+class ResultTypeTest(PrestogresTestCase):
+    def run_with_types(self, *column_types):
+        self.server.config.column_types = column_types
+        self.run_query("select * from test")
+        return plpy.temp_function_result_type[0]
+
+    def test_same_result_type_is_reused(self):
+        type_name = self.run_with_types("bigint", "varchar")
+        self.assertEqual(self.run_with_types("bigint", "varchar"), type_name)
+        self.assertEqual(len(self.executed("create temporary table if not exists")), 1)
+        self.assertEqual(len(self.executed("create function")), 1)
+
+    def test_function_is_replaced_for_another_result_type(self):
+        first = self.run_with_types("bigint")
+        second = self.run_with_types("double")
+        self.assertNotEqual(first, second)
+        self.assertEqual(len(self.executed("drop function pg_temp.")), 1)
+        # the type of the first result is kept for the next query returning it
+        self.assertEqual(self.executed("drop table"), [])
+        self.assertEqual(list(prestogres.session.result_types), [first, second])
+
+    def test_least_recently_used_result_type_is_dropped(self):
+        self.addCleanup(setattr, prestogres, "MAX_RESULT_TYPES", prestogres.MAX_RESULT_TYPES)
+        prestogres.MAX_RESULT_TYPES = 2
+        first = self.run_with_types("bigint")
+        second = self.run_with_types("double")
+        self.assertEqual(self.run_with_types("bigint"), first)
+        third = self.run_with_types("boolean")
+
+        self.assertEqual(len(self.executed("drop table")), 1)
+        self.assertIn("drop table if exists pg_temp.\"%s\"" % second, self.executed("drop table")[0])
+        self.assertEqual(list(prestogres.session.result_types), [first, third])
+
+class MaterializeTest(PrestogresTestCase):
+    server_config = {"rows": 10, "page_rows": 3, "column_types": ("bigint", "varchar", "varbinary", "array<bigint>")}
+
+    def setUp(self):
+        PrestogresTestCase.setUp(self)
+        prestogres.session.presto_connection = (self.server.address, "test", "hive", "default")
+
+    def test_rows_are_inserted_as_json(self):
+        result = prestogres.materialize_presto_query("t", "select * from test", "temp", False)
+        self.assertEqual(result["rows"], 10)
+        self.assertEqual(self.executed("create temporary table pg_temp."),
+                         ['create temporary table pg_temp."t" ("c0" bigint, "c1" varchar(255), "c2" bytea, "c3" json)'])
+        self.assertEqual(self.executed("insert into"), [
+            'insert into pg_temp."t" select (e->>0)::bigint, (e->>1)::varchar(255),'
+            " pg_catalog.decode(e->>2, 'base64'), e->3 from pg_catalog.json_array_elements($1::json) e"])
+        self.assertEqual(plpy.inserted_rows[9], [9, "value-9", "Ynl0ZXMtOQ==", [9, 10, 11, 12]])
+        self.assertEqual(self.executed("owner to"), ['alter table pg_temp."t" owner to "test"'])
+
+    def test_pages_are_inserted_in_batches(self):
+        self.addCleanup(setattr, prestogres, "MATERIALIZE_BATCH_BYTES", prestogres.MATERIALIZE_BATCH_BYTES)
+        prestogres.MATERIALIZE_BATCH_BYTES = 250
+        result = prestogres.materialize_presto_query("t", "select * from test", "unlogged", False)
+        self.assertEqual(result["rows"], 10)
+        self.assertEqual(len(self.executed("json_array_elements")), 2)
+        self.assertEqual([row[0] for row in plpy.inserted_rows], range(10))
+        self.assertEqual(len(self.executed('create unlogged table "prestogres_materialized"."t" (')), 1)
+
+    def test_replace_drops_only_tables_of_session_user(self):
+        plpy.table_owners["t"] = "test"
+        prestogres.materialize_presto_query("t", "select * from test", "regular", True)
+        self.assertEqual(self.executed("drop table"), ['drop table "prestogres_materialized"."t"'])
+
+        plpy.table_owners["t"] = "other"
+        with self.assertRaisesRegexp(plpy.Error, "owned by another user"):
+            prestogres.materialize_presto_query("t", "select * from test", "regular", True)
+
+    def test_unknown_persistence(self):
+        with self.assertRaisesRegexp(plpy.Error, "persistence must be"):
+            prestogres.materialize_presto_query("t", "select * from test", "permanent", False)
+
+    def test_null_characters_are_removed(self):
+        # an escaped backslash followed by u0000 is kept
+        self.assertEqual(prestogres._page_json([["a\x00b", "\\u0000"]]), r'["ab", "\\u0000"]')
+
+class SpoolTest(PrestogresTestCase):
+    server_config = {"rows": 100, "page_rows": 10}
+
+    def start(self):
+        prestogres.start_presto_query(self.server.address, "test", "hive", "default", "presto_fetch",
+                "select * from test")
+        return prestogres.fetch_presto_query_results()
+
+    def read_pages(self, results):
+        pages = self.server.stats["pages"]
+        self.assertEqual([row[0] for row in results], range(100))
+        return self.server.stats["pages"] - pages
+
+    def test_pages_are_read_while_rows_are_returned_without_spool(self):
+        results = self.start()
+        pages = self.server.stats["pages"]
+        next(results)
+        self.assertLess(self.server.stats["pages"] - pages, 3)
+        list(results)
+        self.assertIsNone(prestogres.get_query_stats()[-1]["spooled_bytes"])
+
+    def test_all_pages_are_read_before_first_row(self):
+        total = self.read_pages(self.start())
+        self.set(spool_max_bytes="1048576")
+        results = self.start()
+        pages = self.server.stats["pages"]
+        rows = [next(results)]
+        self.assertEqual(self.server.stats["pages"] - pages, total)
+        rows.extend(results)
+        self.assertEqual([row[0] for row in rows], range(100))
+        self.assertGreater(prestogres.get_query_stats()[-1]["spooled_bytes"], 0)
+
+    def test_rest_of_pages_are_read_after_spool_is_full(self):
+        total = self.read_pages(self.start())
+        self.set(spool_max_bytes="200")
+        results = self.start()
+        pages = self.server.stats["pages"]
+        rows = [next(results)]
+        self.assertLess(self.server.stats["pages"] - pages, total)
+        rows.extend(results)
+        self.assertEqual([row[0] for row in rows], range(100))
+        self.assertEqual(self.server.stats["pages"] - pages, total)
+
+class AdmissionTest(PrestogresTestCase):
+    def setUp(self):
+        PrestogresTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.set(admission_dir=self.directory, max_running_queries="1")
+
+    def assertRunning(self, running):
+        self.assertEqual(prestogres.get_admission_stats()["running"], running)
+
+    def test_abandoned_query_releases_slot(self):
+        prestogres.start_presto_query(self.server.address, "test", "hive", "default", "presto_fetch",
+                "select * from test")
+        results = prestogres.fetch_presto_query_results()
+        next(results)
+        self.assertRunning(1)
+
+        # e.g. LIMIT drops the iterator. the finalizer doesn't use SPI
+        del plpy.executed[:]
+        del results
+        self.assertEqual(plpy.executed, [])
+        self.assertEqual(prestogres.get_query_stats()[-1]["state"], "CANCELLED")
+        self.assertRunning(0)
+
+        # another backend can take the slot
+        fd = prestogres._try_lock_global_slot(self.directory, 0, 0)
+        self.assertIsNotNone(fd)
+        os.close(fd)
+
+    def test_close_releases_slot(self):
+        self.assertEqual(len(self.run_query("select * from test")), 10)
+        self.assertRunning(0)
+
+    def start(self):
+        prestogres.start_presto_query(self.server.address, "test", "hive", "default", "presto_fetch",
+                "select * from test")
+        return prestogres.fetch_presto_query_results()
+
+    def assertRejected(self):
+        with self.assertRaisesRegexp(presto_client.PrestoException, "Too many Presto queries"):
+            self.start()
+
+    def test_open_queries_of_backend_share_slots(self):
+        self.set(max_running_queries="2", admission_timeout="50")
+        first = self.start()
+        second = self.start()
+        self.assertRunning(2)
+        self.assertRejected()
+
+        del first
+        self.assertRunning(1)
+        third = self.start()
+        self.assertRunning(2)
+
+    def test_open_queries_of_backend_share_user_slots(self):
+        self.set(max_running_queries="0", max_running_queries_per_user="1", admission_timeout="50")
+        first = self.start()
+        self.assertRunning(1)
+        self.assertRejected()
+
+class SyncSchemaTest(unittest.TestCase):
+    canonical_types = {"bigint": "bigint", "varchar(255)": "character varying(255)", "json": "json"}
+
+    def sync(self, definitions, existing):
+        return prestogres._build_sync_schema_statements("s", definitions, existing, self.canonical_types)
+
+    def test_new_schema(self):
+        self.assertEqual(self.sync({"t": [("a", "bigint", True)]}, None),
+                         ['create schema "s"', 'create table "s"."t" (\n  "a" bigint not null\n)'])
+
+    def test_unchanged_tables(self):
+        self.assertEqual(self.sync({"t": [("a", "varchar(255)", False)]}, {"t": [("a", "character varying(255)", False)]}),
+                         [])
+
+    def test_dropped_tables(self):
+        self.assertEqual(self.sync({"t": [("a", "bigint", False)]},
+                                   {"t": [("a", "bigint", False)], "u": [], "v": []}),
+                         ['drop table "s"."u", "s"."v" cascade'])
+
+    def test_added_columns(self):
+        self.assertEqual(self.sync({"t": [("a", "bigint", False), ("b", "json", False), ("c", "bigint", True)]},
+                                   {"t": [("a", "bigint", False)]}),
+                         ['alter table "s"."t" add column "b" json, add column "c" bigint not null'])
+
+    def test_changed_columns(self):
+        self.assertEqual(self.sync({"t": [("a", "json", False)], "u": [("a", "bigint", False)]},
+                                   {"t": [("a", "bigint", False)]}),
+                         ['drop table "s"."t" cascade', 'create table "s"."t" (\n  "a" json\n)',
+                          'create table "s"."u" (\n  "a" bigint\n)'])
+
+class CatalogFetchTest(PrestogresTestCase):
+    server_config = {"rows": 10, "page_rows": 5, "schemas": 5, "tables_per_schema": 2, "columns_per_table": 2}
+
+    def test_schemas_are_fetched_in_batches(self):
+        self.set(catalog_fetch_batch_size="2")
+        prestogres.setup_system_catalog(self.server.address, "test", "hive", "schema_0", "prestogres_access")
+
+        # schemata and 3 batches of columns
+        self.assertEqual(self.server.stats["queries"], 4)
+        for i in xrange(5):
+            self.assertEqual(sum(sql.count('create table "schema_%d".' % i) for sql in plpy.executed), 2)
+
+class CatalogSnapshotTest(PrestogresTestCase):
+    server_config = {"rows": 10, "page_rows": 5, "schemas": 2, "tables_per_schema": 2, "columns_per_table": 2}
+
+    def setUp(self):
+        PrestogresTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.set(catalog_snapshot_dir=self.directory, catalog_snapshot_ttl="60")
+        self.client = prestogres._new_catalog_client(self.server.address, "test", "hive")
+
+    def get(self):
+        return prestogres._get_catalog_snapshot(self.client, self.server.address, "test", "hive")
+
+    def test_write_and_read(self):
+        snapshot = prestogres.CatalogSnapshot.fetch(self.client)
+        path = os.path.join(self.directory, "snapshot.json.gz")
+        snapshot.write(path)
+
+        read = prestogres.CatalogSnapshot.read(path)
+        self.assertEqual(read.created_at, snapshot.created_at)
+        self.assertEqual(read.schema_names, ["schema_0", "schema_1"])
+        self.assertEqual(sorted(read.schemas["schema_1"][0]), ["table_0", "table_1"])
+        self.assertIsInstance(read.schemas["schema_1"][0]["table_0"][0], prestogres.Column)
+        self.assertEqual(list(read.iter_schemas(["schema_1", "unknown"])),
+                         [("schema_1",) + snapshot.schemas["schema_1"], ("unknown", {}, [])])
+        self.assertEqual(os.listdir(self.directory), ["snapshot.json.gz"])
+
+    def test_unreadable_files(self):
+        path = os.path.join(self.directory, "snapshot.json.gz")
+        self.assertIsNone(prestogres.CatalogSnapshot.read(path))
+        with open(path, "wb") as f:
+            f.write("broken")
+        self.assertIsNone(prestogres.CatalogSnapshot.read(path))
+
+        self.addCleanup(setattr, prestogres, "CATALOG_SNAPSHOT_VERSION", prestogres.CATALOG_SNAPSHOT_VERSION)
+        prestogres.CatalogSnapshot.fetch(self.client).write(path)
+        prestogres.CATALOG_SNAPSHOT_VERSION += 1
+        self.assertIsNone(prestogres.CatalogSnapshot.read(path))
+
+    def test_fresh_snapshot_is_shared(self):
+        created_at = self.get().created_at
+        queries = self.server.stats["queries"]
+        self.assertEqual(self.get().created_at, created_at)
+        self.assertEqual(self.server.stats["queries"], queries)
+
+    def test_stale_snapshot_is_refreshed(self):
+        created_at = self.get().created_at
+        self.set(catalog_snapshot_ttl="0")
+        self.assertGreater(self.get().created_at, created_at)
+
+    def lock_snapshot(self):
+        name = [name for name in os.listdir(self.directory) if name.endswith(".json.gz")][0]
+        lock = open(os.path.join(self.directory, name + ".lock"), "a")
+        self.addCleanup(lock.close)
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def test_stale_snapshot_is_used_while_another_backend_refreshes_it(self):
+        created_at = self.get().created_at
+        self.set(catalog_snapshot_ttl="0")
+        self.lock_snapshot()
+        queries = self.server.stats["queries"]
+        self.assertEqual(self.get().created_at, created_at)
+        self.assertEqual(self.server.stats["queries"], queries)
+
+    def test_stale_snapshot_is_used_if_presto_fails(self):
+        created_at = self.get().created_at
+        self.set(catalog_snapshot_ttl="0")
+        self.client = prestogres._new_catalog_client("127.0.0.1:1", "test", "hive")
+        self.assertEqual(self.get().created_at, created_at)
+        self.assertEqual(len(plpy.warnings), 1)
+        self.assertIn("Failed to refresh the catalog snapshot", plpy.warnings[0])
+
+class LazyCatalogTest(PrestogresTestCase):
+    server_config = {"rows": 10, "page_rows": 5, "schemas": 3, "tables_per_schema": 2, "columns_per_table": 2}
+
+    def setUp(self):
+        PrestogresTestCase.setUp(self)
+        self.set(catalog_mode="lazy")
+        prestogres.setup_system_catalog(self.server.address, "test", "hive", "schema_0", "prestogres_access")
+        self.assertEqual(prestogres.session.lazy_schemas, set(["schema_1", "schema_2"]))
+
+        self.run_query("select * from schema_1.table_0")
+        self.assertEqual(prestogres.session.lazy_schemas, set(["schema_2"]))
+        del plpy.executed[:]
+
+    def next_transaction(self, commit):
+        if not commit:
+            plpy.schemas_with_tables.discard("schema_1")
+        plpy.transaction_started_at[0] = "2015-01-01 00:00:01+00"
+
+    def test_rolled_back_schema_is_loaded_again(self):
+        self.next_transaction(commit=False)
+        self.run_query("select * from schema_1.table_1")
+        self.assertEqual(len(self.executed('create table "schema_1".')), 1)
+        self.assertEqual(prestogres.session.lazy_schemas, set(["schema_2"]))
+
+    def test_committed_schema_is_not_loaded_again(self):
+        self.next_transaction(commit=True)
+        self.run_query("select * from schema_1.table_1")
+        self.assertEqual(self.executed('create table "schema_1".'), [])
+        self.assertEqual(prestogres.session.uncommitted_schemas, {})
+
+        # no more checks
+        self.run_query("select * from schema_1.table_1")
+        self.assertEqual(len(self.executed("pg_catalog.now()::text as now")), 1)
+
+    def test_schema_is_not_loaded_again_in_same_transaction(self):
+        self.run_query("select * from schema_1.table_1")
+        self.assertEqual(self.executed('create table "schema_1".'), [])
+        self.assertEqual(set(prestogres.session.uncommitted_schemas), set(["schema_1"]))
+
+    def test_catalog_lookup_loads_only_named_schemas(self):
+        # e.g. n.nspname in ('schema_1', 'schema_2', 'pg_catalog') of a BI tool
+        prestogres.load_lazy_schemas(["schema_1", "schema_2", "unknown"])
+        self.assertEqual(self.executed('create table "schema_1".'), [])
+        self.assertEqual(sum(sql.count('create table "schema_2".') for sql in plpy.executed), 2)
+        self.assertEqual(prestogres.session.lazy_schemas, set())
+
+class FailingSubmitHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.server.posts += 1
+        # fail after a follower starts waiting for the result
+        self.server.fail.wait(10)
+        self.send_response(500)
+        self.send_header("Content-Length", "7")
+        self.end_headers()
+        self.wfile.write("no node")
+
+class CoalesceTest(PrestogresTestCase):
+    def setUp(self):
+        PrestogresTestCase.setUp(self)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.set(coalesce_queries="on", coalesce_dir=directory)
+
+    def test_followers_raise_error_of_leader(self):
+        server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), FailingSubmitHandler)
+        server.posts = 0
+        server.fail = threading.Event()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        address = "%s:%d" % server.server_address
+
+        errors = {}
+        def run(name):
+            try:
+                prestogres.start_presto_query(address, "test", "hive", "default", "presto_fetch", "select 1")
+            except presto_client.PrestoException as e:
+                errors[name] = e.args[0]
+        leader = threading.Thread(target=run, args=("leader",))
+        leader.start()
+        while server.posts == 0:
+            time.sleep(0.01)
+
+        follower = threading.Thread(target=run, args=("follower",))
+        follower.start()
+        while not self.executed("pg_catalog.pg_sleep("):
+            time.sleep(0.01)
+        server.fail.set()
+        leader.join()
+        follower.join()
+
+        self.assertEqual(errors, {"leader": "Failed to start query: no node", "follower": "Failed to start query: no node"})
+        self.assertEqual(server.posts, 1)
+
+    def start(self):
+        prestogres.start_presto_query(self.server.address, "test", "hive", "default", "presto_fetch",
+                "select * from test")
+        return prestogres.fetch_presto_query_results()
+
+    def test_follower_with_spool(self):
+        self.set(spool_max_bytes="1048576")
+        leader = self.start()
+        # another open file of the spool follows the leader as another backend does
+        follower = self.start()
+        self.assertIsInstance(follower.query_auto_close.query, prestogres.CoalescedQuery)
+
+        self.assertEqual([row[0] for row in leader], range(10))
+        self.assertEqual([row[0] for row in follower], range(10))
+        self.assertEqual(self.server.stats["queries"], 1)
+
+    def fork_follower(self):
+        """Runs a follower in a child process because leaders find followers by
+        their lockf(3) locks, which are per process. Returns a function which
+        returns its rows or error."""
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(r)
+                follower = self.start()
+                os.write(w, "started\n")
+                try:
+                    result = {"rows": [row[0] for row in follower]}
+                except presto_client.PrestoException as e:
+                    result = {"error": e.args[0]}
+                os.write(w, json.dumps(result) + "\n")
+            finally:
+                os._exit(0)
+        os.close(w)
+        output = os.fdopen(r)
+        self.assertEqual(output.readline(), "started\n")
+        def result():
+            try:
+                return json.loads(output.readline())
+            finally:
+                output.close()
+                os.waitpid(pid, 0)
+        return result
+
+    def test_leader_drains_rows_for_follower(self):
+        leader = self.start()
+        follower = self.fork_follower()
+        next(leader)
+        del leader
+        self.assertEqual(follower(), {"rows": range(10)})
+        self.assertEqual(self.server.stats["queries"], 1)
+
+    def test_leader_drains_rows_for_limited_time(self):
+        self.set(coalesce_drain_timeout="100")
+        self.server.config.rows = 30
+        self.server.config.page_delay = 0.5
+        leader = self.start()
+        follower = self.fork_follower()
+        next(leader)
+        started_at = time.time()
+        del leader
+        # a page instead of 5 pages for 2.5 s
+        self.assertLess(time.time() - started_at, 1.5)
+        self.assertEqual(self.server.stats["cancels"], 1)
+        self.assertRegexpMatches(follower()["error"], "stopped reading rows")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -64,7 +64,6 @@ static bool match_likely_true_parse_error(const char* query);
 static void run_and_rewrite_presto_query(POOL_SESSION_CONTEXT* session_context, POOL_QUERY_CONTEXT* query_context,
 		int partial_rewrite_index, bool has_cursor);
 static void rewrite_error_query_static(POOL_QUERY_CONTEXT* query_context, const char *message, const char* errcode);
-static void replace_ident(char* query, const char* keyword, const char* exact_match, int exact_match_offset, const char* replace);
 
 typedef enum {
 	PRESTOGRES_SYSTEM,
@@ -1830,6 +1829,26 @@ PRESTOGRES_DEST prestogres_send_to_where(Node *node)
 		if (pool_has_system_catalog(node))
 		{
 			ereport(DEBUG1, (errmsg("prestogres_send_to_where: system catalog")));
+
+			/*
+			 * With prestogres.catalog_mode = lazy, create tables of schemas
+			 * the statement looks up before it reads the table list. Tools
+			 * listing all tables see the loaded schemas until
+			 * prestogres_catalog.load_all_schemas() is called.
+			 */
+			if (pool_prestogres_has_table_catalog(node))
+				prestogres_load_lazy_catalog(node);
+
+			return PRESTOGRES_SYSTEM;
+		}
+
+		/*
+		 * Tables created by prestogres_catalog.materialize_presto_query
+		 * exist only on PostgreSQL
+		 */
+		if (pool_prestogres_has_local_relation(node))
+		{
+			ereport(DEBUG1, (errmsg("prestogres_send_to_where: local tables")));
 			return PRESTOGRES_SYSTEM;
 		}
 
@@ -2069,18 +2088,6 @@ static bool match_likely_true_parse_error(const char* query)
 	return false;
 }
 
-/*
- * /\A\s*select\s*\*\s*from\s+(("[^\\"]*([\\"][^\\"]*)*")|[a-zA-Z_][a-zA-Z0-9_]*)(\.(("[^\\"]*([\\"][^\\"]*)*")|[a-zA-Z_][a-zA-Z0-9_]*))?\s*(;|\z)/i
- */
-#define AUTO_LIMIT_QUERY_PATTERN "\\A\\s*select\\s*\\*\\s*from\\s+((\"[^\\\\\"]*([\\\\\"][^\\\\\"]*)*\")|[a-zA-Z_][a-zA-Z0-9_]*)(\\.((\"[^\\\\\"]*([\\\\\"][^\\\\\"]*)*\")|[a-zA-Z_][a-zA-Z0-9_]*))?\\s*(;|\\z)"
-
-static pool_regexp_context AUTO_LIMIT_REGEXP = {0};
-
-static bool match_auto_limit_pattern(const char* query)
-{
-	return prestogres_regexp_match(AUTO_LIMIT_QUERY_PATTERN, &AUTO_LIMIT_REGEXP, query);
-}
-
 static void run_and_rewrite_presto_query(POOL_SESSION_CONTEXT* session_context, POOL_QUERY_CONTEXT* query_context,
 		int partial_rewrite_index, bool has_cursor)
 {
@@ -2128,23 +2135,9 @@ static void run_and_rewrite_presto_query(POOL_SESSION_CONTEXT* session_context,
 			prestogres_regexp_extract("\\A(.*?);(?:(?:--[^\\n]*\\n)|\\s)*\\z", &ctx, query, 1);
 		}
 
-		// TODO query rewriting is necessary because some BI tools assumes PostgreSQL supports INTEGER type
-		//      but Presto supports only BIGINT, for example. However, t's hard work to add rewriting rule
-		//      here in C as new incompatibility is found. An solution is to run lexer here and pass indexes
-		//      of the tokens using int[] type to start_presto_query (PL/Python). We can implement rewriting
-		//      rule in Python and easily change them.
-		replace_ident(query, "integer", "AS INTEGER)", -3, "bigint");
-		// and FLOAT
-		replace_ident(query, "float", "AS FLOAT)", -3, "double");
-
+		/* compatibility rewrites (e.g. CAST(x AS INTEGER) and auto LIMIT) run in start_presto_query */
 		buffer = strcpy_capped_escaped(buffer, bufend - buffer, query, "'\\");
 
-		if (match_auto_limit_pattern(query)) {
-			// TODO send warning message to client
-			ereport(DEBUG1, (errmsg("run_and_rewrite_presto_query: adding 'limit 1000' to a SELECT * query")));
-			buffer = strcpy_capped(buffer, bufend - buffer, " limit 1000");
-		}
-
 		if (fragments.query != NULL)
 			pfree(fragments.query);
 	}
@@ -2438,6 +2431,96 @@ void prestogres_discard_system_catalog()
 	}
 }
 
+static POOL_RELCACHE *prestogres_lazy_catalog_relcache;
+
+/*
+ * prestogres: load schemas named by a statement reading system catalogs
+ * once per session if setup_system_catalog created only some of them
+ * (prestogres.catalog_mode = lazy). Schemas are cached one by one so that
+ * a statement naming a loaded schema doesn't call the backend again.
+ */
+void prestogres_load_lazy_catalog(Node *node)
+{
+	POOL_CONNECTION_POOL *backend;
+	SelectContext ctx;
+	char escaped[POOL_NAMEDATALEN * 2];
+	int i, num_schemas;
+
+	backend = pool_get_session_context(false)->backend;
+
+	/*
+	 * tables created in a transaction block are lost if the transaction
+	 * is rolled back. load them at the next statement outside of it.
+	 */
+	if (TSTATE(backend, MASTER_NODE_ID) != 'I')
+		return;
+
+	num_schemas = pool_prestogres_catalog_schema_names(node, &ctx);
+	if (num_schemas == 0)
+		return;
+
+	if (!prestogres_lazy_catalog_relcache)
+	{
+		prestogres_lazy_catalog_relcache =
+				pool_create_relcache(POOL_MAX_SELECT_OIDS,
+									"select 1 from (select prestogres_catalog.load_lazy_schemas(array[E'%s'])) s;",
+									int_register_func, int_unregister_func, true);
+		if (prestogres_lazy_catalog_relcache == NULL)
+		{
+			ereport(WARNING,
+					(errmsg("prsetogres: unable to create relcache, while loading tables")));
+			return;
+		}
+	}
+
+	for (i = 0; i < num_schemas; i++)
+	{
+		/* the relcache removes double quotes from its keys */
+		if (strchr(ctx.table_names[i], '"') != NULL)
+			continue;
+
+		if (strcpy_capped_escaped(escaped, sizeof(escaped), ctx.table_names[i], "'\\") == NULL)
+			continue;
+
+		pool_search_relcache(prestogres_lazy_catalog_relcache, backend, escaped);
+	}
+}
+
+/*
+ * prestogres: cancel Presto queries left by the session before the backend
+ * connection is closed. Backends exit without running Python finalizers.
+ * With connection_cache, reset_query_list does this instead.
+ */
+void prestogres_reset_session(POOL_CONNECTION_POOL *backend)
+{
+	POOL_SELECT_RESULT *res = NULL;
+	MemoryContext oldContext = CurrentMemoryContext;
+
+	/* the backend may be sending results of a query */
+	if (pool_is_query_in_progress())
+		return;
+
+	PG_TRY();
+	{
+		/* the session may be in an aborted transaction */
+		if (TSTATE(backend, MASTER_NODE_ID) != 'I')
+		{
+			do_query(MASTER(backend), "abort", &res, MAJOR(backend));
+			free_select_result(res);
+			res = NULL;
+		}
+		do_query(MASTER(backend), "select prestogres_catalog.reset_session()", &res, MAJOR(backend));
+		free_select_result(res);
+	}
+	PG_CATCH();
+	{
+		/* ignore the error message */
+		MemoryContextSwitchTo(oldContext);
+		FlushErrorState();
+	}
+	PG_END_TRY();
+}
+
 /* necessary to include parser/gram.h */
 #ifdef CONNECTION
 #undef CONNECTION
@@ -2520,62 +2603,3 @@ int partial_rewrite_next_end_of_statement(void* lex, char** pos)
 		}
 	}
 }
-
-static bool is_keyword_match(const char* query,
-		lex_type* lexp, int pos,
-		const char* keyword, const char* exact_match, int exact_match_offset)
-{
-	if (lexp->lval.keyword == NULL || lexp->lval.str == NULL)
-		return false;
-	if (strcmp(keyword, lexp->lval.keyword) != 0)
-		return false;
-
-	if (exact_match)
-	{
-		int exact_match_pos = lexp->lloc + exact_match_offset;
-		if (exact_match_pos < 0)
-			return false;
-		if (strlen(query) < exact_match_pos + strlen(exact_match))
-			return false;
-		return memcmp(query + exact_match_pos, exact_match, strlen(exact_match)) == 0;
-	} else {
-		return true;
-	}
-}
-
-void replace_ident(char* query, const char* keyword, const char* exact_match, int exact_match_offset, const char* replace)
-{
-	int yychar;
-	int last_copied = 0;
-	StringInfoData str = {0};
-
-	initStringInfo(&str);
-
-	lex_type* lexp = (lex_type*) partial_rewrite_lex_init(query);
-	while (true) {
-		yychar = base_yylex(&lexp->lval, &lexp->lloc, lexp->yyscanner);
-		if (yychar <= 0)
-		{
-			if (last_copied == 0) {
-				/* not replaced */
-				partial_rewrite_lex_destroy(lexp);
-			} else {
-				appendBinaryStringInfo(&str, query + last_copied, lexp->lloc - last_copied);
-				last_copied = lexp->lloc;
-				partial_rewrite_lex_destroy(lexp);
-				memcpy(query, str.data, strlen(str.data) + 1);  // TODO size
-			}
-			pfree(str.data);
-			return;
-		}
-		else if (is_ident(yychar) && is_keyword_match(query, lexp, lexp->lloc, keyword,
-					exact_match, exact_match_offset))
-		{
-			appendBinaryStringInfo(&str, query + last_copied, lexp->lloc - last_copied);
-			last_copied = lexp->lloc;
-			appendStringInfoString(&str, replace);
-			// TODO add space?
-			last_copied += strlen(lexp->lval.keyword);
-		}
-	}
-}
@@ -708,6 +708,10 @@ void prestogres_init_hba(StartupPacket *sp);
 void prestogres_init_system_catalog(void);
 /* prestogres: declared at pool.h called by pool_query_context.c pool_where_to_send */
 void prestogres_discard_system_catalog(void);
+/* prestogres: declared at pool.h called by pool_query_context.c prestogres_send_to_where */
+void prestogres_load_lazy_catalog(Node *node);
+/* prestogres: declared at pool.h called by child.c backend_cleanup */
+void prestogres_reset_session(POOL_CONNECTION_POOL *backend);
 void prestogres_create_database_using_system_db(POOL_CONNECTION *frontend);
 
 /* prestogres: query write implemented at pool_query_context.c */
@@ -52,6 +52,9 @@ extern bool pool_has_non_immutable_function_call(Node *node);
 extern bool pool_has_system_catalog(Node *node);
 extern bool pool_has_temp_table(Node *node);
 extern bool pool_prestogres_has_relation(Node *node);  /* prestogres: */
+extern bool pool_prestogres_has_local_relation(Node *node);  /* prestogres: */
+extern bool pool_prestogres_has_table_catalog(Node *node);  /* prestogres: */
+extern int pool_prestogres_catalog_schema_names(Node *node, SelectContext *ctx);  /* prestogres: */
 extern void discard_temp_table_relcache(void);
 extern bool pool_has_unlogged_table(Node *node);
 extern bool pool_has_view(Node *node);
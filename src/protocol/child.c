@@ -489,6 +489,8 @@ backend_cleanup(POOL_CONNECTION *frontend, POOL_CONNECTION_POOL* volatile backen
     }
     if(cache_connection == false)
     {
+        /* prestogres: cancel Presto queries before the backend exits */
+        prestogres_reset_session(backend);
         reset_connection();
         pool_close(frontend);
         frontend = NULL;
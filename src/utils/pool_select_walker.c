@@ -35,6 +35,12 @@
 static bool function_call_walker(Node *node, void *context);
 static bool system_catalog_walker(Node *node, void *context);
 static bool is_system_catalog(char *table_name);
+static bool local_relation_walker(Node *node, void *context);
+static bool table_catalog_walker(Node *node, void *context);
+static bool catalog_schema_walker(Node *node, void *context);  /* prestogres: */
+static void add_catalog_schema(SelectContext *ctx, const char *schema_name, int length);
+static bool is_schema_name_column(Node *node);
+static void add_catalog_schema_literal(SelectContext *ctx, Node *node, char *op);
 static bool temp_table_walker(Node *node, void *context);
 static bool unlogged_table_walker(Node *node, void *context);
 static bool relation_walker(Node *node, void *context);  /* prestogres: */
@@ -104,6 +110,55 @@ bool pool_has_temp_table(Node *node)
 	return ctx.has_temp_table;
 }
 
+/*
+ * prestogres: Return true if this statement has a table in pg_temp or
+ * prestogres_materialized schema (e.g. created by
+ * prestogres_catalog.materialize_presto_query)
+ */
+bool pool_prestogres_has_local_relation(Node *node)
+{
+
+	SelectContext	ctx;
+
+	ctx.has_temp_table = false;
+
+	raw_expression_tree_walker(node, local_relation_walker, &ctx);
+
+	return ctx.has_temp_table;
+}
+
+/*
+ * prestogres: Return true if this statement reads system catalogs listing
+ * tables and columns (e.g. \d of psql)
+ */
+bool pool_prestogres_has_table_catalog(Node *node)
+{
+
+	SelectContext	ctx;
+
+	ctx.has_system_catalog = false;
+
+	raw_expression_tree_walker(node, table_catalog_walker, &ctx);
+
+	return ctx.has_system_catalog;
+}
+
+/*
+ * prestogres: Collect names of schemas which a statement reading system
+ * catalogs filters by into ctx->table_names and return the number of them.
+ * They are qualifiers of relations, literals compared with schema name
+ * columns (e.g. n.nspname = 'name', table_schema IN ('a', 'b') or
+ * nspname ~ '^(name)$' of psql) and schema parts of regclass literals.
+ */
+int pool_prestogres_catalog_schema_names(Node *node, SelectContext *ctx)
+{
+	ctx->num_oids = 0;
+
+	raw_expression_tree_walker(node, catalog_schema_walker, ctx);
+
+	return ctx->num_oids;
+}
+
 /*
  * prestogres: Return true if this SELECT has at least one FROM
  */
@@ -416,6 +471,214 @@ relation_walker(Node *node, void *context)
 	return raw_expression_tree_walker(node, relation_walker, context);
 }
 
+/*
+ * prestogres: walker function to find a relation qualified by a schema
+ * which exists only on PostgreSQL
+ */
+static bool
+local_relation_walker(Node *node, void *context)
+{
+	SelectContext	*ctx = (SelectContext *) context;
+
+	if (node == NULL)
+		return false;
+
+	if (IsA(node, RangeVar))
+	{
+		RangeVar *rgv = (RangeVar *)node;
+
+		if (rgv->schemaname &&
+			(strcmp(rgv->schemaname, "pg_temp") == 0 ||
+			 strcmp(rgv->schemaname, "prestogres_materialized") == 0))
+		{
+			ctx->has_temp_table = true;
+			return false;
+		}
+	}
+	return raw_expression_tree_walker(node, local_relation_walker, context);
+}
+
+/*
+ * prestogres: Walker function to find pg_class, pg_attribute or pg_tables
+ */
+static bool
+table_catalog_walker(Node *node, void *context)
+{
+	SelectContext	*ctx = (SelectContext *) context;
+
+	if (node == NULL)
+		return false;
+
+	if (IsA(node, RangeVar))
+	{
+		RangeVar *rgv = (RangeVar *)node;
+
+		if ((rgv->schemaname == NULL || strcmp(rgv->schemaname, "pg_catalog") == 0) &&
+			(strcmp(rgv->relname, "pg_class") == 0 ||
+			 strcmp(rgv->relname, "pg_attribute") == 0 ||
+			 strcmp(rgv->relname, "pg_tables") == 0))
+		{
+			ctx->has_system_catalog = true;
+			return false;
+		}
+	}
+	return raw_expression_tree_walker(node, table_catalog_walker, context);
+}
+
+/*
+ * prestogres: Walker function to find schema names of
+ * pool_prestogres_catalog_schema_names
+ */
+static bool
+catalog_schema_walker(Node *node, void *context)
+{
+	SelectContext	*ctx = (SelectContext *) context;
+
+	if (node == NULL)
+		return false;
+
+	if (IsA(node, RangeVar))
+	{
+		RangeVar *rgv = (RangeVar *)node;
+
+		if (rgv->schemaname)
+			add_catalog_schema(ctx, rgv->schemaname, strlen(rgv->schemaname));
+	}
+	else if (IsA(node, A_Expr))
+	{
+		A_Expr *expr = (A_Expr *)node;
+		char *op = (expr->name != NIL) ? strVal(llast(expr->name)) : NULL;
+
+		if (expr->kind == AEXPR_OP && op != NULL &&
+			(strcmp(op, "=") == 0 || strcmp(op, "~") == 0))
+		{
+			if (is_schema_name_column(expr->lexpr))
+				add_catalog_schema_literal(ctx, expr->rexpr, op);
+			else if (is_schema_name_column(expr->rexpr))
+				add_catalog_schema_literal(ctx, expr->lexpr, op);
+		}
+		else if (expr->kind == AEXPR_IN && is_schema_name_column(expr->lexpr) &&
+				 expr->rexpr && IsA(expr->rexpr, List))
+		{
+			ListCell *cell;
+
+			foreach(cell, (List *)expr->rexpr)
+				add_catalog_schema_literal(ctx, lfirst(cell), "=");
+		}
+	}
+	else if (IsA(node, TypeCast))
+	{
+		TypeCast *cast = (TypeCast *)node;
+		char *type_name;
+
+		/* 'schema.table'::regclass */
+		if (cast->typeName && cast->typeName->names != NIL &&
+			cast->arg && IsA(cast->arg, A_Const) &&
+			((A_Const *)cast->arg)->val.type == T_String)
+		{
+			type_name = strVal(llast(cast->typeName->names));
+			if (strcmp(type_name, "regclass") == 0)
+			{
+				char *name = ((A_Const *)cast->arg)->val.val.str;
+				char *dot = strchr(name, '.');
+
+				if (dot != NULL)
+					add_catalog_schema(ctx, name, dot - name);
+			}
+		}
+	}
+	return raw_expression_tree_walker(node, catalog_schema_walker, context);
+}
+
+/*
+ * prestogres: Return true if the node is a column of schema names such as
+ * pg_namespace.nspname, pg_tables.schemaname or
+ * information_schema.tables.table_schema
+ */
+static bool
+is_schema_name_column(Node *node)
+{
+	ColumnRef *ref;
+	Node *field;
+
+	if (node == NULL || !IsA(node, ColumnRef))
+		return false;
+
+	ref = (ColumnRef *)node;
+	field = llast(ref->fields);
+	if (!IsA(field, String))
+		return false;
+
+	return strcmp(strVal(field), "nspname") == 0 ||
+		strcmp(strVal(field), "schemaname") == 0 ||
+		strcmp(strVal(field), "table_schema") == 0;
+}
+
+/*
+ * prestogres: Add a string literal compared with a schema name column.
+ * With ~, only '^(name)$' patterns of psql are names.
+ */
+static void
+add_catalog_schema_literal(SelectContext *ctx, Node *node, char *op)
+{
+	char *value;
+	int length;
+
+	/* 'name'::name or '^(name)$' COLLATE pg_catalog.default */
+	if (node && IsA(node, TypeCast))
+		node = ((TypeCast *)node)->arg;
+	else if (node && IsA(node, CollateClause))
+		node = ((CollateClause *)node)->arg;
+
+	if (node == NULL || !IsA(node, A_Const) || ((A_Const *)node)->val.type != T_String)
+		return;
+
+	value = ((A_Const *)node)->val.val.str;
+	length = strlen(value);
+
+	if (strcmp(op, "~") == 0)
+	{
+		if (length < 4 || strncmp(value, "^(", 2) != 0 || strcmp(value + length - 2, ")$") != 0)
+			return;
+		value += 2;
+		length -= 4;
+		if (strcspn(value, "\\.^$*+?()[]{}|") < length)
+			return;
+	}
+
+	add_catalog_schema(ctx, value, length);
+}
+
+static void
+add_catalog_schema(SelectContext *ctx, const char *schema_name, int length)
+{
+	int i;
+
+	if (length <= 0 || length >= POOL_NAMEDATALEN)
+		return;
+
+	/* schemas which are not Presto schemas */
+	if ((length == 10 && strncmp(schema_name, "pg_catalog", length) == 0) ||
+		(length == 18 && strncmp(schema_name, "information_schema", length) == 0) ||
+		(length == 7 && strncmp(schema_name, "pg_temp", length) == 0) ||
+		(length >= 11 && strncmp(schema_name, "prestogres_", 11) == 0))
+		return;
+
+	for (i = 0; i < ctx->num_oids; i++)
+	{
+		if (strncmp(ctx->table_names[i], schema_name, length) == 0 &&
+			ctx->table_names[i][length] == '\0')
+			return;
+	}
+
+	if (ctx->num_oids >= POOL_MAX_SELECT_OIDS)
+		return;
+
+	memcpy(ctx->table_names[ctx->num_oids], schema_name, length);
+	ctx->table_names[ctx->num_oids][length] = '\0';
+	ctx->num_oids++;
+}
+
 /*
  * Walker function to find a view
  */